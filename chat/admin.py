@@ -1,3 +1,6 @@
 from django.contrib import admin
 
-# Register your models here.
+from chat.models import Room
+
+# rooms, besides allowed ones, are created by staff, see CHAT_ROOMS_ALLOWED
+admin.site.register(Room)
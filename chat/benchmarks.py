@@ -0,0 +1,475 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Benchmarks scenarios
+#
+# Each scenario takes parsed options of `chatbench` command and returns
+# JSON-serializable dict with results.
+#
+# Load scenarios drive `ChatConsumer` in-process with simulated clients
+# through `WebsocketCommunicator`, so whole path -- routing, managers,
+# channel layer and database -- is exercised without a server. They use
+# configured database and channel layer, point settings to local instances
+# to run them off production.
+
+import asyncio
+import datetime
+import itertools
+import math
+import random
+import time
+import typing as tp
+
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.test import override_settings
+
+from chat.codec import dumps, loads
+from chat.const import SEARCH_PAGE_SIZE, SEARCH_PAGES_MAX
+from chat.consumers import ChatConsumer
+from chat import db_async
+from chat.db_executor import db, db_executor
+from chat.db_selectors import chat_message_count
+from chat.db_services import user_get_or_create_many, room_get_or_create, \
+    chat_message_bulk_create, chat_message_create
+from chat.history_cache import history_cache
+from chat.models import ChatMessage
+from chat.routing import websocket_urlpatterns
+from chat.search import message_search
+from chat.utils import datetime_to_dict, datetime_to_epoch_ms
+
+
+def _best_of(repeat: int, func) -> float:
+    """Best wall time of `repeat` runs of func, seconds"""
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        timings.append(time.perf_counter() - start)
+    return min(timings)
+
+
+def bench_wire(options) -> dict:
+    """Size and encoding time of history frame, legacy vs compact timestamps"""
+    count = options['messages']
+    start = datetime.datetime(2020, 7, 9, tzinfo=datetime.timezone.utc)
+    rows = [(f'message {i}', start + datetime.timedelta(seconds=i), 'user')
+            for i in range(count)]
+
+    def frame(serialize_sent):
+        return dumps({
+            'type': 'init.chat_history',
+            'data': [{'message': text,
+                      'sent': serialize_sent(sent),
+                      'author': author,
+                      'service_msg': False} for text, sent, author in rows]
+        })
+
+    results = {}
+    for name, serialize_sent in (('legacy', datetime_to_dict),
+                                 ('compact', datetime_to_epoch_ms)):
+        seconds = _best_of(options['repeat'], lambda: frame(serialize_sent))
+        results[name] = {'bytes': len(frame(serialize_sent).encode()),
+                         'seconds': seconds}
+
+    legacy, compact = results['legacy'], results['compact']
+    results['saved'] = {
+        'bytes': legacy['bytes'] - compact['bytes'],
+        'bytes_per_message': (legacy['bytes'] - compact['bytes']) / count,
+        'seconds': legacy['seconds'] - compact['seconds'],
+    }
+    return {'messages': count, **results}
+
+
+def _percentiles(samples: tp.List[float]) -> dict:
+    """Summary of latencies in seconds, reported in milliseconds"""
+    if not samples:
+        return {'count': 0}
+
+    ordered = sorted(samples)
+
+    def percentile(p):
+        return ordered[max(math.ceil(p / 100 * len(ordered)) - 1, 0)] * 1000
+
+    return {'count': len(ordered),
+            'mean_ms': sum(ordered) / len(ordered) * 1000,
+            'p50_ms': percentile(50),
+            'p95_ms': percentile(95),
+            'p99_ms': percentile(99),
+            'max_ms': ordered[-1] * 1000}
+
+
+class BenchClient:
+    """Simulated chat client, connected through `WebsocketCommunicator`"""
+
+    application = URLRouter(websocket_urlpatterns)
+
+    def __init__(self, user: User, room: str, timeout: float):
+        self.user = user
+        self.room = room
+        self.timeout = timeout
+        self.communicator = None
+
+    async def connect(self) -> float:
+        """Connect and wait for init frames, returns latency"""
+        start = time.perf_counter()
+        self.communicator = WebsocketCommunicator(
+            self.application, f'/ws/chat/{self.room}?v=2'
+        )
+        self.communicator.scope['user'] = self.user
+        connected, _ = await self.communicator.connect(self.timeout)
+        if not connected:
+            raise RuntimeError(f'Connection of {self.user.username} rejected')
+        await self.receive_until('init.online_users')
+        return time.perf_counter() - start
+
+    async def disconnect(self):
+        await self.communicator.disconnect(timeout=self.timeout)
+        self.communicator = None
+
+    async def send(self, event: dict):
+        await self.communicator.send_to(text_data=dumps(event))
+
+    async def receive(self) -> dict:
+        return loads(await self.communicator.receive_from(self.timeout))
+
+    async def receive_until(self, event_type: str) -> dict:
+        while True:
+            event = await self.receive()
+            if event['type'] == event_type:
+                return event
+
+    async def collect(self, event_type: str, count: int,
+                      received: tp.List[tp.Tuple[float, dict]]):
+        """Store arrival time of `count` events of given type"""
+        while count:
+            event = await self.receive_until(event_type)
+            received.append((time.perf_counter(), event))
+            count -= 1
+
+
+async def _bench_setup(options) -> tp.List[User]:
+    """Users for clients, room history of requested size"""
+    room = await db(room_get_or_create)(name=options['room'])
+    missing = options['messages'] - await db(chat_message_count)(room=room)
+    if missing > 0:
+        await db(chat_message_bulk_create)(messages=[
+            ChatMessage(text=f'history {i}', author=None, room=room)
+            for i in range(missing)
+        ])
+
+    return await db(user_get_or_create_many)(
+        usernames=[f'bench{i}' for i in range(options['clients'])]
+    )
+
+
+async def _connect_all(clients: tp.List[BenchClient]) -> tp.List[float]:
+    return list(await asyncio.gather(*[c.connect() for c in clients]))
+
+
+async def _disconnect_all(clients: tp.List[BenchClient]):
+    await asyncio.gather(*[c.disconnect() for c in clients])
+
+
+def _clients(users, options) -> tp.List[BenchClient]:
+    return [BenchClient(user, options['room'], options['timeout'])
+            for user in users]
+
+
+async def _bench_connect(options) -> dict:
+    users = await _bench_setup(options)
+    history_cache.invalidate(options['room'])
+
+    first, *rest = _clients(users, options)
+    cold = await first.connect()
+    start = time.perf_counter()
+    latencies = await _connect_all(rest)
+    elapsed = time.perf_counter() - start
+    await _disconnect_all([first, *rest])
+
+    return {'clients': len(users),
+            'history_messages': options['messages'],
+            'cold_connect_ms': cold * 1000,
+            'connect': _percentiles(latencies),
+            'connects_per_second': len(rest) / elapsed if elapsed else None}
+
+
+def bench_connect(options) -> dict:
+    """Connect latency with init frames, on cold and warm history cache"""
+    return asyncio.run(_bench_connect(options))
+
+
+async def _bench_connect_concurrency(options) -> dict:
+    users = await _bench_setup(options)
+    results = {'clients': len(users),
+               'history_messages': options['messages']}
+
+    for name, concurrent in (('sequential', False), ('concurrent', True)):
+        ChatConsumer.concurrent_managers = concurrent
+        latencies = []
+        try:
+            # one by one, on cold history cache: database bound connects
+            for client in _clients(users, options):
+                history_cache.invalidate(options['room'])
+                latencies.append(await client.connect())
+                await client.disconnect()
+        finally:
+            ChatConsumer.concurrent_managers = True
+        results[name] = _percentiles(latencies)
+
+    sequential, concurrent = results['sequential'], results['concurrent']
+    results['saved'] = {key: sequential[key] - concurrent[key]
+                        for key in ('mean_ms', 'p50_ms', 'p95_ms')}
+    return results
+
+
+def bench_connect_concurrency(options) -> dict:
+    """Connect latency with managers notified sequentially vs concurrently"""
+    return asyncio.run(_bench_connect_concurrency(options))
+
+
+async def _bench_persist(options) -> dict:
+    user, = await _bench_setup({**options, 'clients': 1})
+    room = await db(room_get_or_create)(name=options['room'])
+    count = options['rounds'] * options['clients']
+
+    async def executor(**kwargs):
+        return await db_executor.run(chat_message_create, **kwargs)
+
+    implementations = {'executor': executor}
+    if db_async.asyncpg is not None:
+        implementations['async'] = db_async.chat_message_create
+
+    results = {'messages': count}
+    for name, create in implementations.items():
+        latencies = []
+        for i in range(count):
+            start = time.perf_counter()
+            await create(text=f'persist {i}', author=user, room=room)
+            latencies.append(time.perf_counter() - start)
+        results[name] = _percentiles(latencies)
+
+    await db_async.pool.close()
+    return results
+
+
+def bench_persist(options) -> dict:
+    """Latency of saving single message, database executor vs asyncpg"""
+    return asyncio.run(_bench_persist(options))
+
+
+async def _bench_fanout(options) -> dict:
+    users = await _bench_setup(options)
+    clients = _clients(users, options)
+    await _connect_all(clients)
+
+    rounds = options['rounds']
+    expected = len(clients) * rounds
+    sent_at = {}
+    received = []
+
+    async def send(client, index):
+        for i in range(rounds):
+            seq = f'{index}.{i}'
+            sent_at[seq] = time.perf_counter()
+            await client.send({'type': 'chat.message', 'message': seq})
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[c.collect('chat.message', expected, received) for c in clients],
+        *[send(c, i) for i, c in enumerate(clients)]
+    )
+    elapsed = time.perf_counter() - start
+    await _disconnect_all(clients)
+
+    latencies = [at - sent_at[event['message']] for at, event in received]
+    return {'clients': len(clients),
+            'messages_sent': expected,
+            'deliveries': len(received),
+            'fanout': _percentiles(latencies),
+            'messages_per_second': expected / elapsed,
+            'deliveries_per_second': len(received) / elapsed}
+
+
+def bench_fanout(options) -> dict:
+    """Every client sends `rounds` messages, every client receives all"""
+    return asyncio.run(_bench_fanout(options))
+
+
+# layers selectable by `chatbench --layer`, besides configured one;
+# simulated clients may fall far behind, so events are not dropped
+BENCH_LAYERS = {
+    'memory': {'BACKEND': 'channels.layers.InMemoryChannelLayer',
+               'CONFIG': {'capacity': 100000}},
+    'local': {'BACKEND': 'chat.layers.LocalChannelLayer',
+              'CONFIG': {'capacity': 100000}},
+}
+
+
+def bench_fanout_layers(options) -> dict:
+    """Fanout scenario with channels in-memory, local and configured layer"""
+    configured = settings.CHANNEL_LAYERS['default']
+    layers = {**BENCH_LAYERS, 'configured': {
+        **configured,
+        'CONFIG': {**configured.get('CONFIG', {}), 'capacity': 100000}
+    }}
+    results = {}
+    for name, layer in layers.items():
+        with override_settings(CHANNEL_LAYERS={'default': layer}):
+            try:
+                results[name] = bench_fanout(options)
+            except OSError as e:
+                # configured Redis may be unreachable from bench host
+                results[name] = {'backend': layer['BACKEND'],
+                                 'error': repr(e)}
+                continue
+        results[name]['backend'] = layer['BACKEND']
+    return results
+
+
+async def _bench_reconnect_storm(options) -> dict:
+    users = await _bench_setup(options)
+    room = await db(room_get_or_create)(name=options['room'])
+    clients = _clients(users, options)
+    await _connect_all(clients)
+
+    results = {'clients': len(clients), 'storms': []}
+    for _ in range(options['rounds']):
+        stored = await db(chat_message_count)(room=room)
+        await _disconnect_all(clients)
+        start = time.perf_counter()
+        latencies = await _connect_all(clients)
+        results['storms'].append({
+            'seconds': time.perf_counter() - start,
+            'connect': _percentiles(latencies),
+            # service messages about leaves and joins
+            'messages_stored': await db(chat_message_count)(room=room) - stored
+        })
+
+    await _disconnect_all(clients)
+    return results
+
+
+def bench_reconnect_storm(options) -> dict:
+    """All clients drop and reconnect at once, `rounds` times"""
+    return asyncio.run(_bench_reconnect_storm(options))
+
+
+async def _bench_mentions(options) -> dict:
+    users = await _bench_setup(options)
+    clients = _clients(users, options)
+    await _connect_all(clients)
+
+    # fixed seed keeps runs comparable
+    rand = random.Random(0)
+    per_message = min(3, len(clients) - 1)
+    messages = []
+    expected = [0] * len(clients)
+    for index in range(len(clients)):
+        others = [i for i in range(len(clients)) if i != index]
+        client_messages = []
+        for _ in range(options['rounds']):
+            targets = rand.sample(others, per_message)
+            for target in targets:
+                expected[target] += 1
+            client_messages.append(' '.join(f'@{users[t].username}'
+                                            for t in targets))
+        messages.append(client_messages)
+
+    sent_at = {}
+    received = []
+
+    async def mention(client, index, client_messages):
+        for i, text in enumerate(client_messages):
+            message = f'{text} {index}.{i}'
+            sent_at[message] = time.perf_counter()
+            await client.send({'type': 'chat.message', 'message': message})
+
+    start = time.perf_counter()
+    await asyncio.gather(
+        *[c.collect('user.mention', count, received)
+          for c, count in zip(clients, expected)],
+        *[mention(c, i, m) for i, (c, m) in enumerate(zip(clients, messages))]
+    )
+    elapsed = time.perf_counter() - start
+    await _disconnect_all(clients)
+
+    return {'clients': len(clients),
+            'mentions_per_message': per_message,
+            'mentions': len(received),
+            'delivery': _percentiles([at - sent_at[event['message']]
+                                      for at, event in received]),
+            'mentions_per_second': len(received) / elapsed}
+
+
+def bench_mentions(options) -> dict:
+    """Every client sends `rounds` messages, mentioning random users"""
+    return asyncio.run(_bench_mentions(options))
+
+
+SEARCH_VOCABULARY = 10000
+
+
+def _search_seed(room, count: int, rand: random.Random):
+    """Fill room with messages of random words up to `count`"""
+    # Zipf-like vocabulary: `word0` is the most frequent word
+    words = [f'word{i}' for i in range(SEARCH_VOCABULARY)]
+    weights = list(itertools.accumulate(1 / (i + 1)
+                                        for i in range(len(words))))
+    batch = 10000
+    for start in range(chat_message_count(room=room), count, batch):
+        chat_message_bulk_create(messages=[
+            ChatMessage(text=' '.join(rand.choices(words, cum_weights=weights,
+                                                   k=8)),
+                        author=None, room=room)
+            for _ in range(min(batch, count - start))
+        ])
+
+
+def bench_search(options) -> dict:
+    """Latency of ranked search over `messages` of a separate room"""
+    # fixed seed keeps runs comparable
+    rand = random.Random(0)
+    room = room_get_or_create(name=f"{options['room']}-search")
+    start = time.perf_counter()
+    _search_seed(room, options['messages'], rand)
+    seeded = time.perf_counter() - start
+
+    queries = {'frequent': 'word0',
+               'rare': f'word{SEARCH_VOCABULARY - 1}',
+               'combined': 'word1 word2',
+               'missing': 'nosuchword'}
+    results = {'messages': chat_message_count(room=room),
+               'backend': connections['default'].vendor,
+               'seed_seconds': seeded}
+    # first search of in-memory backend loads the whole room
+    start = time.perf_counter()
+    message_search(room=room, query='word0', limit=SEARCH_PAGE_SIZE)
+    results['first_search_ms'] = (time.perf_counter() - start) * 1000
+
+    for name, query in queries.items():
+        latencies = []
+        for page in range(options['rounds']):
+            start = time.perf_counter()
+            message_search(room=room, query=query, limit=SEARCH_PAGE_SIZE,
+                           offset=page % SEARCH_PAGES_MAX * SEARCH_PAGE_SIZE)
+            latencies.append(time.perf_counter() - start)
+        results[name] = _percentiles(latencies)
+    return results
+
+
+SCENARIOS = {
+    'wire': bench_wire,
+    'connect': bench_connect,
+    'connect_concurrency': bench_connect_concurrency,
+    'fanout': bench_fanout,
+    'fanout_layers': bench_fanout_layers,
+    'persist': bench_persist,
+    'reconnect_storm': bench_reconnect_storm,
+    'mentions': bench_mentions,
+    'search': bench_search,
+}
@@ -0,0 +1,198 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Encoding of websocket frames
+#
+# JSON backend is selected by `CHAT_JSON_BACKEND` setting, stdlib `json` is
+# used if it is not set or selected backend is not installed.
+# Broadcast events are encoded once by sender: channel layer event carries
+# ready frame in `text` field, which consumers forward as is.
+# Frames, which contain timestamps, are additionally encoded in
+# `PROTOCOL_LEGACY` format for clients, which did not request newer one.
+# With `CHAT_BINARY_TRANSPORT` enabled, clients may negotiate MessagePack
+# subprotocol, their frames are binary and always use compact timestamps.
+
+import importlib
+import json
+import logging
+import typing as tp
+import urllib.parse
+
+import msgpack
+from django.conf import settings
+
+from chat.const import PROTOCOL_LEGACY, PROTOCOL_VERSIONS
+from chat.db_selectors import HistoryCursor
+from chat.utils import datetime_to_dict, epoch_ms_to_datetime, \
+    history_cursor_decode
+
+
+log = logging.getLogger(__name__)
+
+
+class StdlibJSONBackend:
+    name = 'json'
+
+    @staticmethod
+    def dumps(obj) -> str:
+        return json.dumps(obj)
+
+    @staticmethod
+    def loads(data):
+        return json.loads(data)
+
+
+class UJSONBackend:
+    name = 'ujson'
+
+    def __init__(self):
+        self._ujson = importlib.import_module('ujson')
+
+    def dumps(self, obj) -> str:
+        return self._ujson.dumps(obj, ensure_ascii=False)
+
+    def loads(self, data):
+        return self._ujson.loads(data)
+
+
+class ORJSONBackend:
+    name = 'orjson'
+
+    def __init__(self):
+        self._orjson = importlib.import_module('orjson')
+
+    def dumps(self, obj) -> str:
+        # orjson produces bytes, websocket text frames are str
+        return self._orjson.dumps(obj).decode()
+
+    def loads(self, data):
+        return self._orjson.loads(data)
+
+
+JSON_BACKENDS = {
+    backend.name: backend
+    for backend in (StdlibJSONBackend, UJSONBackend, ORJSONBackend)
+}
+
+
+def get_json_backend(name: str = None):
+    """Instantiate JSON backend by name, falling back to stdlib `json`"""
+    if name is None:
+        name = getattr(settings, 'CHAT_JSON_BACKEND', 'json')
+
+    if name not in JSON_BACKENDS:
+        log.warning(f'Unknown JSON backend {name}, falling back to json')
+        return StdlibJSONBackend()
+
+    try:
+        return JSON_BACKENDS[name]()
+    except ImportError:
+        log.warning(f'JSON backend {name} is not installed, '
+                    f'falling back to json')
+        return StdlibJSONBackend()
+
+
+json_backend = get_json_backend()
+dumps = json_backend.dumps
+loads = json_backend.loads
+
+
+MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+
+binary_transport = getattr(settings, 'CHAT_BINARY_TRANSPORT', False)
+
+
+def pack(data) -> bytes:
+    return msgpack.packb(data, use_bin_type=True)
+
+
+def unpack(data: bytes):
+    return msgpack.unpackb(data, raw=False)
+
+
+def subprotocol_negotiate(scope) -> tp.Optional[str]:
+    """Subprotocol to accept connection with, None for JSON text frames"""
+    if not binary_transport:
+        return None
+    if MSGPACK_SUBPROTOCOL in scope.get('subprotocols', []):
+        return MSGPACK_SUBPROTOCOL
+    return None
+
+
+def decode(text_data: str = None, bytes_data: bytes = None):
+    """Decode received frame, binary frames are MessagePack"""
+    if bytes_data is not None:
+        return unpack(bytes_data)
+    return loads(text_data)
+
+
+def protocol_negotiate(scope) -> int:
+    """Protocol version, requested in query string, legacy by default"""
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode())
+    try:
+        version = int(query['v'][0])
+    except (KeyError, ValueError):
+        return PROTOCOL_LEGACY
+    return version if version in PROTOCOL_VERSIONS else PROTOCOL_LEGACY
+
+
+def resume_negotiate(scope) -> tp.Optional[HistoryCursor]:
+    """
+    Cursor of the last message, seen by reconnecting client, passed as
+    JSON in `resume` query string parameter. None if client starts anew.
+    """
+    query = urllib.parse.parse_qs(scope.get('query_string', b'').decode())
+    try:
+        return history_cursor_decode(json.loads(query['resume'][0]))
+    except (KeyError, ValueError, RecursionError):
+        return None
+
+
+# frames, carrying list of messages in `data` field
+HISTORY_FRAMES = ('init.chat_history', 'init.resume', 'history.page',
+                  'search.results')
+
+
+def _legacy_message(message: dict) -> dict:
+    if message.get('sent') is None:
+        return message
+    sent = epoch_ms_to_datetime(message['sent'])
+    return {**message, 'sent': datetime_to_dict(sent)}
+
+
+def legacy_payload(data: dict) -> dict:
+    """Convert frame with epoch milliseconds timestamps to legacy format"""
+    if data.get('type') in HISTORY_FRAMES:
+        return {**data, 'data': [_legacy_message(m) for m in data['data']]}
+    return _legacy_message(data)
+
+
+def encode(data: dict, protocol: int) -> str:
+    if protocol == PROTOCOL_LEGACY:
+        data = legacy_payload(data)
+    return dumps(data)
+
+
+def encoded_event(data: dict, **extra) -> dict:
+    """
+    Channel layer event with pre-encoded frame.
+
+    `data` is what clients receive, `extra` fields are visible to
+    consumers only.
+    """
+    event = {'type': data['type'], 'text': dumps(data), **extra}
+
+    legacy = legacy_payload(data)
+    if legacy is not data:
+        event['legacy_text'] = dumps(legacy)
+    if binary_transport:
+        event['bytes'] = pack(data)
+    return event
+
+
+def event_text(event: dict, protocol: int) -> str:
+    """Frame of pre-encoded event for given protocol version"""
+    if protocol == PROTOCOL_LEGACY:
+        return event.get('legacy_text', event['text'])
+    return event['text']
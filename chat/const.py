@@ -2,4 +2,72 @@
 # -*-encoding: utf-8-*-
 # Author: Danil Kovalenko
 
-CHAT_ROOM_NAME = 'chat'
\ No newline at end of file
+# room of clients, connected without room in url
+DEFAULT_ROOM_NAME = 'chat'
+# room names in urls, slugs up to max length of `Room.name`
+ROOM_NAME_PATTERN = r'[-a-zA-Z0-9_]{1,64}'
+
+# number of messages sent on connect and per `history.fetch` page
+HISTORY_PAGE_SIZE = 50
+
+# number of latest messages per room, kept in memory by each worker
+HISTORY_CACHE_SIZE = 500
+
+# search results per `search.query` page, pages beyond SEARCH_PAGES_MAX are
+# not served; queries are limited to SEARCH_QUERY_LENGTH_MAX characters
+SEARCH_PAGE_SIZE = 20
+SEARCH_PAGES_MAX = 50
+SEARCH_QUERY_LENGTH_MAX = 256
+# only so many newest matches are ranked, so frequent words stay cheap
+SEARCH_RANKED_MAX = SEARCH_PAGE_SIZE * SEARCH_PAGES_MAX
+# messages of so many last days are searched, unless `search.query` asks
+# for up to SEARCH_DAYS_MAX; partitions of older months are not scanned
+SEARCH_DAYS = 365
+SEARCH_DAYS_MAX = 3650
+# newest messages per room, indexed in memory by each worker, where database
+# has no full text search; older ones are not found there
+SEARCH_MEMORY_MAX = 10000
+
+# resumed session gets messages missed since the last seen one, unless
+# there are more than RESUME_GAP_MAX of them, full history is sent then
+RESUME_GAP_MAX = 200
+
+# presence leases, seconds: connection renews its lease every
+# PRESENCE_HEARTBEAT_INTERVAL, lease not renewed for PRESENCE_LEASE_TTL is
+# expired by sweeper, running every PRESENCE_SWEEP_INTERVAL in each worker
+PRESENCE_HEARTBEAT_INTERVAL = 10
+PRESENCE_LEASE_TTL = 30
+PRESENCE_SWEEP_INTERVAL = 10
+
+# mentioned users notified per message, the rest of mentions is ignored
+MENTIONS_PER_MESSAGE_MAX = 20
+
+# existing usernames, cached by each worker, and seconds each one is trusted
+KNOWN_USERNAMES_MAX = 10000
+KNOWN_USERNAMES_TTL = 300
+
+# wire protocol versions, requested by client with `v` query string
+# parameter on connect
+PROTOCOL_LEGACY = 1   # timestamps as dicts of strings
+PROTOCOL_COMPACT = 2  # timestamps as epoch milliseconds
+PROTOCOL_VERSIONS = (PROTOCOL_LEGACY, PROTOCOL_COMPACT)
+
+# websocket close code, sent when server is overloaded and client should
+# reconnect later; application range, as 1013 is refused by daphne
+CLOSE_TRY_AGAIN_LATER = 4013
+
+# websocket close code, sent when received frame exceeds size limit;
+# application range, as 1009 is refused by daphne
+CLOSE_MESSAGE_TOO_BIG = 4009
+
+# websocket close code, sent to anonymous users; connection is accepted
+# first, so that client tells it from failed handshake and does not retry
+CLOSE_UNAUTHORIZED = 4003
+
+# websocket close code, sent when room does not exist and user may not
+# create it
+CLOSE_ROOM_NOT_FOUND = 4004
+
+# websocket close code, sent when worker is restarted and client should
+# reconnect to another one; application range, daphne refuses 1012
+CLOSE_SERVICE_RESTART = 4012
@@ -2,12 +2,31 @@
 # -*-encoding: utf-8-*-
 # Author: Danil Kovalenko
 
-import json
+import asyncio
+import logging
 import typing as tp
+import weakref
 from channels.generic.websocket import AsyncWebsocketConsumer
 
 from chat.managers import AbstractManager, ReceiveManager, InitManager, \
     UserTrackManager
+from chat.history_cache import history_cache
+from chat.codec import protocol_negotiate, subprotocol_negotiate, encode, \
+    event_text, pack, resume_negotiate
+from chat.const import DEFAULT_ROOM_NAME, PROTOCOL_LEGACY, PROTOCOL_COMPACT, \
+    CLOSE_TRY_AGAIN_LATER, CLOSE_SERVICE_RESTART, CLOSE_ROOM_NOT_FOUND, \
+    CLOSE_UNAUTHORIZED
+from chat.db_services import room_get_or_create_permitted
+from chat import metrics
+from chat.db_executor import db, DatabaseBusy
+from chat.outbound import OutboundQueue, OutboundOverflow, evictions
+from chat.utils import room_group_name, user_group_name
+
+
+log = logging.getLogger(__name__)
+
+# accepted connections of this process, drained when worker stops
+live_consumers = weakref.WeakSet()
 
 
 class ChatConsumerBase(AsyncWebsocketConsumer):
@@ -23,81 +42,220 @@ class ChatConsumerBase(AsyncWebsocketConsumer):
     Then subclass of `ChatConsumerBase` defines, which managers he wants ho
     employ by defining them in `managers_cls` class attribute.
     On each connect-disconnect all defined managers are notified via calling
-    specific methods.
+    specific methods. Adjacent managers, declared `independent`, are notified
+    concurrently, unless `concurrent_managers` is disabled.
+
+    Frames of accepted connection are sent through bounded `outbound` queue,
+    so slow client never stalls handlers.
     """
 
     managers_cls: tp.Iterable[tp.Type[AbstractManager]] = []
+    _managers: tp.List[AbstractManager] = []
+    protocol = PROTOCOL_LEGACY
+    # whether connection negotiated binary MessagePack frames
+    binary = False
+    accepted = False
+    concurrent_managers = True
+    outbound: tp.Optional[OutboundQueue] = None
+    # connection is closed, so that client reconnects to another worker
+    draining = False
 
     async def handle_auth(self):
         if not self.scope['user'].is_anonymous:
-            await self.accept()
+            subprotocol = subprotocol_negotiate(self.scope)
+            self.binary = subprotocol is not None
+            await self.accept(subprotocol)
+            self.accepted = True
+            self.outbound = OutboundQueue(self.send_now)
+            self.outbound.start()
+            metrics.active_sockets.inc()
+            live_consumers.add(self)
             return True
-        await self.close()
+        await self.accept()
+        await self.close(code=CLOSE_UNAUTHORIZED)
         return False
 
     async def init_managers(self):
         self._managers = [m(self) for m in self.managers_cls]
 
-    async def managers_notify_connect(self):
+    async def _manager_call(self, manager, hook, *args):
+        with metrics.manager_hook_seconds.time(
+                manager=type(manager).__name__, hook=hook):
+            await getattr(manager, hook)(*args)
+
+    async def _managers_gather(self, managers, hook, *args):
+        await asyncio.gather(*[self._manager_call(manager, hook, *args)
+                               for manager in managers])
+
+    async def _managers_notify(self, hook, *args):
+        """
+        Call hook of all managers.
+
+        Runs of adjacent independent managers are gathered, dependent
+        manager waits for all preceding ones and blocks following ones.
+        """
+        pending = []
         for manager in self._managers:
-            await manager.on_connect()
+            if manager.independent and self.concurrent_managers:
+                pending.append(manager)
+            else:
+                await self._managers_gather(pending, hook, *args)
+                pending = []
+                await self._manager_call(manager, hook, *args)
+        await self._managers_gather(pending, hook, *args)
+
+    async def managers_notify_connect(self):
+        await self._managers_notify('on_connect')
 
     async def managers_notify_disconnect(self):
-        for manager in self._managers:
-            await manager.on_disconnect()
+        await self._managers_notify('on_disconnect')
 
     async def managers_notify_receive(self, text_data, bytes_data):
-        for manager in self._managers:
-            await manager.on_receive(text_data, bytes_data)
+        await self._managers_notify('on_receive', text_data, bytes_data)
+
+    async def send(self, text_data=None, bytes_data=None, close=False,
+                   coalesce_key=None):
+        """Queue frame, frames with the same `coalesce_key` may be merged"""
+        if self.outbound is None or close:
+            await self.send_now(text_data, bytes_data, close)
+            return
+        try:
+            self.outbound.put(text_data, bytes_data, coalesce_key)
+        except OutboundOverflow as e:
+            log.warning(f'Slow consumer evicted: {e}')
+            evictions.inc()
+            self.outbound.stop()
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
+
+    async def send_now(self, text_data=None, bytes_data=None, close=False):
+        """Send frame to transport, bypassing queue"""
+        if text_data is not None or bytes_data is not None:
+            metrics.frames.inc(direction='out')
+            metrics.frame_bytes.inc(len(text_data or bytes_data),
+                                    direction='out')
+        await super().send(text_data, bytes_data, close)
+
+    async def send_frame(self, data):
+        """Encode frame according to protocol of this connection and send"""
+        if self.binary:
+            await self.send(bytes_data=pack(data))
+        else:
+            await self.send(text_data=encode(data, self.protocol))
+
+    async def send_encoded(self, event):
+        """Forward frame, pre-encoded by event sender"""
+        key = event.get('coalesce_key')
+        if self.binary:
+            await self.send(bytes_data=event['bytes'], coalesce_key=key)
+        else:
+            await self.send(text_data=event_text(event, self.protocol),
+                            coalesce_key=key)
 
     async def connect(self):
-        if not await self.handle_auth(): return
-        await self.init_managers()
-        await self.managers_notify_connect()
+        try:
+            if not await self.handle_auth(): return
+            if self.binary:
+                self.protocol = PROTOCOL_COMPACT
+            else:
+                self.protocol = protocol_negotiate(self.scope)
+            await self.init_managers()
+            await self.managers_notify_connect()
+        except DatabaseBusy as e:
+            log.warning(f'Connection dropped: {e}')
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
 
     async def receive(self, text_data=None, bytes_data=None):
-        await self.managers_notify_receive(text_data, bytes_data)
+        metrics.frames.inc(direction='in')
+        metrics.frame_bytes.inc(len(text_data or bytes_data or ''),
+                                direction='in')
+        try:
+            await self.managers_notify_receive(text_data, bytes_data)
+        except DatabaseBusy as e:
+            log.warning(f'Connection dropped: {e}')
+            await self.close(code=CLOSE_TRY_AGAIN_LATER)
+
+    async def drain(self):
+        """Ask client to reconnect, presence of connection is kept"""
+        self.draining = True
+        await self.close(code=CLOSE_SERVICE_RESTART)
 
     async def disconnect(self, code):
+        live_consumers.discard(self)
+        if self.accepted:
+            self.accepted = False
+            metrics.active_sockets.dec()
+        if self.outbound is not None:
+            self.outbound.stop()
         await self.managers_notify_disconnect()
-        self._managers.clear()
+        self._managers = []
 
 
 class ChatConsumer(ChatConsumerBase):
 
-    room_name = 'chat'
     managers_cls = [InitManager, UserTrackManager, ReceiveManager]
+    # resolved for authorized connections only
+    room = None
+    # last message seen by client before reconnect
+    resume_cursor = None
 
     async def connect(self):
-        await self.channel_layer.group_add(self.room_name, self.channel_name)
+        kwargs = self.scope.get('url_route', {}).get('kwargs', {})
+        self.room_name = kwargs.get('room', DEFAULT_ROOM_NAME)
+        self.room_group = room_group_name(self.room_name)
+        self.resume_cursor = resume_negotiate(self.scope)
         await super().connect()
 
+    async def handle_auth(self):
+        if not await super().handle_auth():
+            return False
+
+        self.room = await db(room_get_or_create_permitted)(
+            name=self.room_name, user=self.scope['user']
+        )
+        if self.room is None:
+            await self.close(code=CLOSE_ROOM_NOT_FOUND)
+            return False
+        await self.channel_layer.group_add(self.room_group, self.channel_name)
+        history_cache.subscribe(self.room_name)
+
         # add channel to group of channels for given user
         username = self.scope['user'].username
-        await self.channel_layer.group_add(username, self.channel_name)
+        await self.channel_layer.group_add(user_group_name(username),
+                                           self.channel_name)
+        return True
 
     async def disconnect(self, code):
-        await self.channel_layer.group_discard(self.room_name,self.channel_name)
+        if self.room is not None:
+            await self.channel_layer.group_discard(self.room_group,
+                                                   self.channel_name)
+            history_cache.unsubscribe(self.room_name)
         await super().disconnect(code)
 
-        # remove channel from group of channels for given user
-        username = self.scope['user'].username
-        await self.channel_layer.group_discard(username, self.channel_name)
+        if self.room is not None:
+            # remove channel from group of channels for given user
+            username = self.scope['user'].username
+            await self.channel_layer.group_discard(user_group_name(username),
+                                                   self.channel_name)
 
     async def receive(self, text_data=None, bytes_data=None):
         await super().receive(text_data, bytes_data)
 
     async def chat_message(self, event):
-        await self.send(json.dumps(event))
+        history_cache.append_from_event(self.room_name, event)
+        await self.send_encoded(event)
 
     async def chat_servicemessage(self, event):
-        await self.send(json.dumps(event))
+        history_cache.append_from_event(self.room_name, event)
+        await self.send_encoded(event)
 
     async def online_connect(self, event):
-        await self.send(json.dumps(event))
+        await self.send_encoded(event)
 
     async def online_disconnect(self, event):
-        await self.send(json.dumps(event))
+        await self.send_encoded(event)
+
+    async def online_delta(self, event):
+        await self.send_encoded(event)
 
     async def user_mention(self, event):
-        await self.send(json.dumps(event))
+        await self.send_encoded(event)
@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Native async data access
+#
+# Hot path selectors and services, implemented with asyncpg and run on the
+# event loop, without a hop to database executor thread. Enabled by
+# `CHAT_DB_ASYNC` setting, PostgreSQL only. Signatures and results match
+# sync implementations, `db` picks one from `ASYNC_IMPLEMENTATIONS`, so
+# callers are the same in both modes. Connections are waited for as long as
+# executor waits for calls, `CHAT_DB_EXECUTOR_TIMEOUT`, then `DatabaseBusy`
+# is raised, as executor does.
+
+import asyncio
+import contextlib
+import datetime
+import logging
+import typing as tp
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.utils import timezone
+
+from chat import db_selectors, db_services
+from chat.db_selectors import HistoryCursor, HistoryEntry
+from chat.models import ChatMessage, ConnectionLease, Room
+
+try:
+    import asyncpg
+except ImportError:
+    asyncpg = None
+
+
+log = logging.getLogger(__name__)
+
+MESSAGES = ChatMessage._meta.db_table
+LEASES = ConnectionLease._meta.db_table
+USERS = User._meta.db_table
+
+
+# raised by database executor as well
+class DatabaseBusy(Exception): pass
+
+
+def _enabled() -> bool:
+    if not getattr(settings, 'CHAT_DB_ASYNC', False):
+        return False
+    if asyncpg is None:
+        log.warning('asyncpg is not installed, '
+                    'falling back to database executor')
+        return False
+    if connections['default'].vendor != 'postgresql':
+        log.warning('Async database access requires PostgreSQL, '
+                    'falling back to database executor')
+        return False
+    return True
+
+
+class ConnectionPool:
+    """asyncpg pool, created on first use in the running event loop"""
+
+    def __init__(self, min_size: int, max_size: int, timeout: float):
+        self.min_size = min_size
+        self.max_size = max_size
+        self.timeout = timeout
+        self._loop = None
+        self._pool = None
+        self._creating = None
+        # task, terminating the pool on loop shutdown, referenced to be kept
+        self._guard = None
+
+    async def _create(self):
+        params = connections['default'].settings_dict
+        return await asyncpg.create_pool(
+            database=params['NAME'], user=params['USER'] or None,
+            password=params['PASSWORD'] or None,
+            host=params['HOST'] or None, port=params['PORT'] or None,
+            min_size=self.min_size, max_size=self.max_size
+        )
+
+    async def _terminate_on_shutdown(self, loop):
+        # runners, e.g. `asyncio.run`, cancel remaining tasks before they
+        # close the loop, connections are closed while it still runs
+        try:
+            await loop.create_future()
+        except asyncio.CancelledError:
+            if self._loop is loop:
+                self._guard = None
+                self.terminate()
+            raise
+
+    async def get(self):
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:
+            # pool of other event loop is unusable here
+            self.terminate()
+            self._loop = loop
+            self._creating = asyncio.ensure_future(self._create())
+            self._guard = asyncio.ensure_future(
+                self._terminate_on_shutdown(loop))
+        if self._pool is None:
+            # creation is shared by callers, timeout of one does not cancel it
+            self._pool = await asyncio.shield(self._creating)
+        return self._pool
+
+    @contextlib.asynccontextmanager
+    async def acquire(self):
+        try:
+            pool = await asyncio.wait_for(self.get(), self.timeout)
+            conn = await pool.acquire(timeout=self.timeout)
+        except asyncio.TimeoutError:
+            raise DatabaseBusy(f'No database connection '
+                               f'in {self.timeout}s') from None
+        try:
+            yield conn
+        finally:
+            await pool.release(conn)
+
+    async def close(self):
+        pool, guard = self._pool, self._guard
+        self._loop = self._pool = self._creating = self._guard = None
+        if guard is not None:
+            guard.cancel()
+        if pool is not None:
+            await pool.close()
+
+    def terminate(self):
+        """Close all connections immediately, from any thread"""
+        pool, loop, guard = self._pool, self._loop, self._guard
+        self._loop = self._pool = self._creating = self._guard = None
+        if loop is None:
+            return
+        if loop.is_closed():
+            if pool is not None:
+                # not expected, pool is terminated before its loop closes
+                log.warning('Event loop of asyncpg pool is closed, '
+                            'connections are left to garbage collector')
+            return
+
+        def stop():
+            if guard is not None:
+                guard.cancel()
+            if pool is not None:
+                pool.terminate()
+
+        try:
+            running = asyncio.get_running_loop()
+        except RuntimeError:
+            running = None
+        if loop.is_running() and loop is not running:
+            loop.call_soon_threadsafe(stop)
+        else:
+            stop()
+
+
+pool = ConnectionPool(
+    min_size=getattr(settings, 'CHAT_DB_ASYNC_POOL_MIN_SIZE', 2),
+    max_size=getattr(settings, 'CHAT_DB_ASYNC_POOL_MAX_SIZE', 10),
+    timeout=getattr(settings, 'CHAT_DB_EXECUTOR_TIMEOUT', 10)
+)
+
+
+def _affected(status: str) -> int:
+    """Number of rows from command status, e.g. 'DELETE 1'"""
+    return int(status.split()[-1])
+
+
+# selectors
+
+async def connection_lease_online_users_as_dicts(*,
+                                                 room: Room,
+                                                 now: datetime.datetime
+                                                 ) -> tp.List[dict]:
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(
+            f'SELECT u.username, count(*) FROM {LEASES} l '
+            f'JOIN {USERS} u ON u.id = l.user_id '
+            f'WHERE l.room_id = $1 AND l.expires > $2 GROUP BY u.username',
+            room.pk, now
+        )
+    return [{'user': username, 'connections': count}
+            for username, count in rows]
+
+
+async def chat_message_page_entries(*,
+                                    room: Room,
+                                    limit: int,
+                                    before: tp.Optional[HistoryCursor] = None
+                                    ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+    query = (f'SELECT m.id, m.text, m.sent, u.username AS author__username, '
+             f'm.service_msg FROM {MESSAGES} m '
+             f'LEFT JOIN {USERS} u ON u.id = m.author_id '
+             f'WHERE m.room_id = $1 ')
+    args = [room.pk, limit + 1]
+    if before is not None:
+        # plain bound on `sent` prunes partitions, row comparison does not
+        query += 'AND (m.sent, m.id) < ($3, $4) AND m.sent <= $3 '
+        args.extend(before)
+    query += 'ORDER BY m.sent DESC, m.id DESC LIMIT $2'
+
+    async with pool.acquire() as conn:
+        rows = await conn.fetch(query, *args)
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    entries = [((row['sent'], row['id']), ChatMessage.values_as_dict(row))
+               for row in rows]
+    return entries, has_more
+
+
+async def chat_message_page_as_dicts(*,
+                                     room: Room,
+                                     limit: int,
+                                     before: tp.Optional[HistoryCursor] = None
+                                     ) -> tp.Tuple[tp.List[dict],
+                                                   tp.Optional[HistoryCursor]]:
+    entries, has_more = await chat_message_page_entries(room=room,
+                                                        limit=limit,
+                                                        before=before)
+    cursor = None
+    if has_more:
+        cursor = entries[0][0]
+    return [message for _, message in entries], cursor
+
+
+# services
+
+async def _connection_lease_live_count(conn, *, user: User, room: Room,
+                                       now: datetime.datetime) -> int:
+    return await conn.fetchval(
+        f'SELECT count(*) FROM {LEASES} '
+        f'WHERE user_id = $1 AND room_id = $2 AND expires > $3',
+        user.pk, room.pk, now
+    )
+
+
+async def _user_lock(conn, *, user: User):
+    await conn.execute(f'SELECT 1 FROM {USERS} WHERE id = $1 FOR UPDATE',
+                       user.pk)
+
+
+async def connection_lease_acquire(*,
+                                   user: User,
+                                   room: Room,
+                                   channel_name: str,
+                                   expires: datetime.datetime,
+                                   now: datetime.datetime) -> int:
+    async with pool.acquire() as conn, conn.transaction():
+        await _user_lock(conn, user=user)
+        await conn.execute(
+            f'INSERT INTO {LEASES} (user_id, room_id, channel_name, expires) '
+            f'VALUES ($1, $2, $3, $4) ON CONFLICT (channel_name) DO UPDATE '
+            f'SET user_id = $1, room_id = $2, expires = $4',
+            user.pk, room.pk, channel_name, expires
+        )
+        return await _connection_lease_live_count(conn, user=user, room=room,
+                                                  now=now)
+
+
+async def connection_lease_renew(*,
+                                 channel_name: str,
+                                 expires: datetime.datetime) -> bool:
+    async with pool.acquire() as conn:
+        status = await conn.execute(
+            f'UPDATE {LEASES} SET expires = $2 WHERE channel_name = $1',
+            channel_name, expires
+        )
+    return _affected(status) > 0
+
+
+async def connection_lease_release(*,
+                                   user: User,
+                                   room: Room,
+                                   channel_name: str,
+                                   now: datetime.datetime
+                                   ) -> tp.Optional[int]:
+    async with pool.acquire() as conn, conn.transaction():
+        await _user_lock(conn, user=user)
+        status = await conn.execute(
+            f'DELETE FROM {LEASES} WHERE channel_name = $1', channel_name
+        )
+        if not _affected(status):
+            return None
+        return await _connection_lease_live_count(conn, user=user, room=room,
+                                                  now=now)
+
+
+async def chat_message_create(*,
+                              text: str,
+                              author: User,
+                              room: Room,
+                              service_msg: bool = False) -> ChatMessage:
+    msg = ChatMessage(text=text, sent=timezone.now(), author=author,
+                      room=room, service_msg=service_msg)
+    async with pool.acquire() as conn:
+        msg.id = await conn.fetchval(
+            f'INSERT INTO {MESSAGES} (text, sent, author_id, room_id, '
+            f'service_msg) VALUES ($1, $2, $3, $4, $5) RETURNING id',
+            msg.text, msg.sent, msg.author_id, msg.room_id, msg.service_msg
+        )
+    # same state as instance saved by ORM
+    msg._state.adding = False
+    msg._state.db = 'default'
+    return msg
+
+
+ASYNC_IMPLEMENTATIONS = {}
+if _enabled():
+    ASYNC_IMPLEMENTATIONS = {
+        db_selectors.connection_lease_online_users_as_dicts:
+            connection_lease_online_users_as_dicts,
+        db_selectors.chat_message_page_entries: chat_message_page_entries,
+        db_selectors.chat_message_page_as_dicts: chat_message_page_as_dicts,
+        db_services.connection_lease_acquire: connection_lease_acquire,
+        db_services.connection_lease_renew: connection_lease_renew,
+        db_services.connection_lease_release: connection_lease_release,
+        db_services.chat_message_create: chat_message_create,
+    }
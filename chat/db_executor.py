@@ -0,0 +1,122 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Execution of database calls from async code
+#
+# Selectors and services are run by dedicated pool of threads, sized to the
+# number of database connections a worker may hold. Threads are long-lived,
+# so with `CONN_MAX_AGE` each keeps its connection open between calls.
+# Calls over pool and queue capacity, or not finished in time, fail fast
+# with `DatabaseBusy` instead of piling up behind a slow database.
+# Functions with native async implementation bypass the pool, when it is
+# enabled, see `db_async`.
+
+import asyncio
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, connections
+
+from chat.db_async import ASYNC_IMPLEMENTATIONS, DatabaseBusy
+from chat.metrics import db_seconds, registry
+
+
+class DBExecutor:
+    """Bounded thread pool for database calls"""
+
+    def __init__(self, max_workers: int, max_queue: int, timeout: float):
+        self.max_workers = max_workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers,
+                                        thread_name_prefix='chat-db')
+        # submitted calls, not finished yet, are updated from pool threads
+        self._lock = threading.Lock()
+        self.pending = 0
+
+        # metrics
+        self.rejected = 0
+        self.timeouts = 0
+
+    @staticmethod
+    def _call(func, *args, **kwargs):
+        # drops connections, broken or older than CONN_MAX_AGE
+        close_old_connections()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            close_old_connections()
+
+    def _done(self, future):
+        with self._lock:
+            self.pending -= 1
+
+    async def run(self, func, *args, **kwargs):
+        with self._lock:
+            if self.pending >= self.max_workers + self.max_queue:
+                self.rejected += 1
+                raise DatabaseBusy(f'{self.pending} database calls pending, '
+                                   f'{func.__name__} rejected')
+            self.pending += 1
+
+        future = self._pool.submit(self._call, func, *args, **kwargs)
+        future.add_done_callback(self._done)
+        try:
+            # on timeout call is cancelled, if it has not started yet
+            return await asyncio.wait_for(asyncio.wrap_future(future),
+                                          self.timeout)
+        except asyncio.TimeoutError:
+            self.timeouts += 1
+            raise DatabaseBusy(f'{func.__name__} timed out '
+                               f'after {self.timeout}s') from None
+
+    def close_connections(self):
+        """
+        Close connections held by pool threads, e.g. before test database
+        is dropped. Blocks until every thread is idle.
+        """
+        barrier = threading.Barrier(self.max_workers)
+
+        def close():
+            # each call waits for the others, so every thread gets one
+            barrier.wait()
+            connections.close_all()
+
+        for future in [self._pool.submit(close)
+                       for _ in range(self.max_workers)]:
+            future.result()
+
+    def stats(self) -> dict:
+        return {'pending': self.pending,
+                'queue_depth': max(self.pending - self.max_workers, 0),
+                'rejected': self.rejected,
+                'timeouts': self.timeouts}
+
+
+db_executor = DBExecutor(
+    max_workers=getattr(settings, 'CHAT_DB_EXECUTOR_WORKERS', 10),
+    max_queue=getattr(settings, 'CHAT_DB_EXECUTOR_QUEUE', 1000),
+    timeout=getattr(settings, 'CHAT_DB_EXECUTOR_TIMEOUT', 10)
+)
+registry.register_stats('chat_db_executor', db_executor.stats)
+
+
+def db(func):
+    """
+    Async version of selector or service.
+
+    Native async implementation is used if it is enabled and exists,
+    otherwise function is run by `db_executor`.
+    """
+    async_func = ASYNC_IMPLEMENTATIONS.get(func)
+
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        with db_seconds.time(call=func.__name__):
+            if async_func is not None:
+                return await async_func(*args, **kwargs)
+            return await db_executor.run(func, *args, **kwargs)
+    return wrapper
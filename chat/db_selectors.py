@@ -6,25 +6,188 @@
 #
 # All business logic, dedicated to database read is implemented here
 
+import datetime
 import typing as tp
 
 from django.contrib.auth.models import User
+from django.contrib.postgres.search import SearchQuery, SearchRank, \
+    SearchVector
+from django.db.models import Q, Count
 
-from chat.models import ActiveUser, ChatMessage
+from chat.const import SEARCH_RANKED_MAX
+from chat.models import ConnectionLease, ChatMessage, Room
+
+
+HistoryCursor = tp.Tuple[datetime.datetime, int]
+HistoryEntry = tp.Tuple[HistoryCursor, dict]
+
+# text search configuration of message index, no stemming, as messages are
+# in any language
+SEARCH_CONFIG = 'simple'
 
 
 def user_username_taken(*, username: str) -> bool:
     return User.objects.filter(username=username).exists()
 
 
-def active_user_get(*, user: User) -> ActiveUser:
-    active_user = ActiveUser.objects.get(user=user)
-    return active_user
+def user_usernames_existing(*, usernames: tp.Iterable[str]) -> tp.Set[str]:
+    return set(User.objects.filter(username__in=usernames)
+                           .values_list('username', flat=True))
+
+
+def room_get(*, name: str) -> tp.Optional[Room]:
+    return Room.objects.filter(name=name).first()
+
+
+def connection_lease_online_users_as_dicts(*,
+                                           room: Room,
+                                           now: datetime.datetime
+                                           ) -> tp.List[dict]:
+    """Users with unexpired leases in room and number of their connections"""
+    rows = ConnectionLease.objects.filter(room=room, expires__gt=now) \
+                                  .values('user__username') \
+                                  .annotate(connections=Count('id')) \
+                                  .order_by()
+    return [{'user': row['user__username'],
+             'connections': row['connections']} for row in rows]
+
+
+def connection_lease_online_usernames(*,
+                                      room: Room,
+                                      usernames: tp.Iterable[str],
+                                      now: datetime.datetime) -> tp.Set[str]:
+    """Those of given users, who have unexpired leases in room"""
+    return set(ConnectionLease.objects.filter(room=room, expires__gt=now,
+                                              user__username__in=usernames)
+                                      .values_list('user__username',
+                                                   flat=True))
+
+
+def chat_message_count(*, room: Room) -> int:
+    return ChatMessage.objects.filter(room=room).count()
+
+
+def _chat_message_newest_first(room: Room,
+                               before: tp.Optional[HistoryCursor] = None):
+    """Room messages sent before `(sent, id)` cursor, newest first"""
+    qs = ChatMessage.objects.filter(room=room)
+    if before is not None:
+        sent, pk = before
+        # plain bound on `sent` is used for index range and partitions
+        # pruning, unlike the keyset condition
+        qs = qs.filter(Q(sent__lt=sent) | Q(sent=sent, id__lt=pk),
+                       sent__lte=sent)
+    return qs.order_by("-sent", "-id")
+
+
+def chat_message_page_entries(*,
+                              room: Room,
+                              limit: int,
+                              before: tp.Optional[HistoryCursor] = None
+                              ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+    """
+    Keyset-paginated chat history of a room, built with a single query.
+
+    Returns at most `limit` `(cursor, serialized message)` pairs, sent
+    strictly before `before` `(sent, id)` cursor (latest messages if cursor
+    is omitted), in chronological order, and a flag whether older messages
+    exist.
+    """
+    qs = _chat_message_newest_first(room, before) \
+        .values(*ChatMessage.DICT_FIELDS)
+    rows = list(qs[:limit + 1])
+    has_more = len(rows) > limit
+    rows = rows[:limit]
+    rows.reverse()
+
+    entries = [((row['sent'], row['id']), ChatMessage.values_as_dict(row))
+               for row in rows]
+    return entries, has_more
+
+
+def chat_message_page_as_dicts(*,
+                               room: Room,
+                               limit: int,
+                               before: tp.Optional[HistoryCursor] = None
+                               ) -> tp.Tuple[tp.List[dict],
+                                             tp.Optional[HistoryCursor]]:
+    """
+    Same as `chat_message_page_entries`, but returns serialized messages
+    and cursor of the next (older) page, None if there is nothing more
+    to fetch.
+    """
+    entries, has_more = chat_message_page_entries(room=room, limit=limit,
+                                                  before=before)
+
+    cursor = None
+    if has_more:
+        cursor = entries[0][0]
+    return [message for _, message in entries], cursor
+
+
+def chat_message_oldest_cursor(*, room: Room) -> tp.Optional[HistoryCursor]:
+    """Cursor of the oldest message of room, None if it has none"""
+    return ChatMessage.objects.filter(room=room).order_by('sent', 'id') \
+                              .values_list('sent', 'id').first()
+
+
+def chat_message_since_entries(*,
+                               room: Room,
+                               after: tp.Optional[HistoryCursor],
+                               limit: int
+                               ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+    """
+    Room messages sent strictly after `(sent, id)` cursor (from the first
+    one, if cursor is None), oldest first, at most `limit` of them, and
+    a flag whether newer messages exist.
+    """
+    qs = ChatMessage.objects.filter(room=room)
+    if after is not None:
+        sent, pk = after
+        qs = qs.filter(Q(sent__gt=sent) | Q(sent=sent, id__gt=pk),
+                       sent__gte=sent)
+    qs = qs.order_by('sent', 'id').values(*ChatMessage.DICT_FIELDS)
+    rows = list(qs[:limit + 1])
+
+    entries = [((row['sent'], row['id']), ChatMessage.values_as_dict(row))
+               for row in rows[:limit]]
+    return entries, len(rows) > limit
 
 
-def active_user_online_users() -> tp.Iterable[ActiveUser]:
-    return list(ActiveUser.objects.filter(active_connections__gt=0))
+def chat_message_search(*,
+                        room: Room,
+                        query: str,
+                        limit: int,
+                        offset: int = 0,
+                        since: tp.Optional[datetime.datetime] = None
+                        ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+    """
+    Room messages, containing all words of `query`, best ranked first,
+    newer first among equally ranked. Only `SEARCH_RANKED_MAX` newest
+    matches are ranked. PostgreSQL only, served by full text index of
+    messages. Messages sent before `since` are not searched, nor are
+    partitions of them.
 
+    Returns at most `limit` entries after `offset` ones, and a flag whether
+    there are more.
+    """
+    vector = SearchVector('text', config=SEARCH_CONFIG)
+    search_query = SearchQuery(query, config=SEARCH_CONFIG)
+    matching = ChatMessage.objects.annotate(search=vector) \
+        .filter(room=room, service_msg=False, search=search_query)
+    if since is not None:
+        matching = matching.filter(sent__gte=since)
+    candidates = matching.order_by('-sent', '-id') \
+        .values('id')[:SEARCH_RANKED_MAX]
+    # bound on `sent` prunes partitions of outer query as well
+    qs = ChatMessage.objects.filter(id__in=candidates)
+    if since is not None:
+        qs = qs.filter(sent__gte=since)
+    qs = qs.annotate(rank=SearchRank(vector, search_query)) \
+        .order_by('-rank', '-sent', '-id') \
+        .values(*ChatMessage.DICT_FIELDS)
+    rows = list(qs[offset:offset + limit + 1])
 
-def chat_message_all() -> tp.Iterable[ChatMessage]:
-    return list(ChatMessage.objects.order_by("sent"))
\ No newline at end of file
+    entries = [((row['sent'], row['id']), ChatMessage.values_as_dict(row))
+               for row in rows[:limit]]
+    return entries, len(rows) > limit
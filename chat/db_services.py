@@ -7,36 +7,187 @@
 # All business logic, dedicated to database write implemented here
 
 
+import datetime
+import typing as tp
+
+from django.conf import settings
+from django.contrib.auth.hashers import make_password
 from django.contrib.auth.models import User
+from django.db import transaction, connection
+
+from chat.const import DEFAULT_ROOM_NAME
+from chat.db_selectors import room_get
+from chat.models import ConnectionLease, ChatMessage, Room
 
-from chat.models import ActiveUser, ChatMessage
+
+# rooms, which any user may create, others are created by staff only
+ROOMS_ALLOWED = frozenset(getattr(settings, 'CHAT_ROOMS_ALLOWED', ())) | \
+    {DEFAULT_ROOM_NAME}
 
 
 def user_create(*, username: str, password: str) -> User:
-    user = User.objects.create_user(username=username, password=password)
-    active_user_create(user=user)
-    return user
+    return User.objects.create_user(username=username, password=password)
+
+
+def user_get_or_create_many(*, usernames: tp.List[str]) -> tp.List[User]:
+    """Users with given names, missing ones created without password"""
+    User.objects.bulk_create(
+        [User(username=username, password=make_password(None))
+         for username in usernames],
+        ignore_conflicts=True
+    )
+    users = User.objects.in_bulk(usernames, field_name='username')
+    return [users[username] for username in usernames]
+
+
+def room_get_or_create(*, name: str) -> Room:
+    room, _ = Room.objects.get_or_create(name=name)
+    return room
+
+
+def room_get_or_create_permitted(*, name: str,
+                                 user: User) -> tp.Optional[Room]:
+    """Room by name, created if user may create it, None otherwise"""
+    room = room_get(name=name)
+    if room is None and (user.is_staff or name in ROOMS_ALLOWED):
+        room = room_get_or_create(name=name)
+    return room
+
+
+def _connection_lease_live_count(*, user: User, room: Room,
+                                 now: datetime.datetime) -> int:
+    return ConnectionLease.objects.filter(user=user, room=room,
+                                          expires__gt=now).count()
+
+
+def _user_lock(*, user: User):
+    """
+    Lock user row until the end of transaction.
 
+    Serializes presence changes of a single user, so exactly one of
+    concurrent connections observes the first join or the last leave.
+    """
+    list(User.objects.select_for_update().filter(pk=user.pk).values('pk'))
 
-def active_user_create(*, user: User) -> ActiveUser:
-    return ActiveUser.objects.create(user=user)
 
+def connection_lease_acquire(*,
+                             user: User,
+                             room: Room,
+                             channel_name: str,
+                             expires: datetime.datetime,
+                             now: datetime.datetime) -> int:
+    """Create lease for connection, return number of live leases in room"""
+    with transaction.atomic():
+        _user_lock(user=user)
+        ConnectionLease.objects.update_or_create(
+            channel_name=channel_name,
+            defaults={'user': user, 'room': room, 'expires': expires}
+        )
+        return _connection_lease_live_count(user=user, room=room, now=now)
 
-def active_user_connections_incr(*, active_user: ActiveUser):
-    active_user.active_connections += 1
-    active_user.save()
 
+def connection_lease_renew(*,
+                           channel_name: str,
+                           expires: datetime.datetime) -> bool:
+    """Prolong lease, return False if it was already expired by sweeper"""
+    updated = ConnectionLease.objects.filter(channel_name=channel_name) \
+                                     .update(expires=expires)
+    return updated > 0
 
-def active_user_connections_decr(*, active_user: ActiveUser):
-    active_user.active_connections -= 1
-    active_user.save()
+
+def connection_lease_release(*,
+                             user: User,
+                             room: Room,
+                             channel_name: str,
+                             now: datetime.datetime) -> tp.Optional[int]:
+    """
+    Drop lease of closed connection, return number of live leases in room.
+
+    Returns None if lease was already expired by sweeper, which has
+    taken care of the user leave then.
+    """
+    with transaction.atomic():
+        _user_lock(user=user)
+        deleted, _ = ConnectionLease.objects.filter(
+            channel_name=channel_name
+        ).delete()
+        if not deleted:
+            return None
+        return _connection_lease_live_count(user=user, room=room, now=now)
+
+
+def connection_lease_expire(*, now: datetime.datetime
+                            ) -> tp.List[tp.Tuple[Room, str]]:
+    """
+    Drop all expired leases in bulk.
+
+    Returns `(room, username)` pairs of users, who have no live leases left
+    in the room. Rows locked by a concurrent sweeper are skipped, so each
+    leave is reported once.
+    """
+    with transaction.atomic():
+        expired = list(
+            ConnectionLease.objects.select_for_update(skip_locked=True)
+                                   .filter(expires__lte=now)
+                                   .values_list('id', 'user_id', 'room_id')
+        )
+        if not expired:
+            return []
+
+        ConnectionLease.objects.filter(
+            id__in=[pk for pk, _, _ in expired]
+        ).delete()
+
+        user_ids = {user_id for _, user_id, _ in expired}
+        room_ids = {room_id for _, _, room_id in expired}
+        still_online = set(
+            ConnectionLease.objects.filter(user_id__in=user_ids,
+                                           room_id__in=room_ids,
+                                           expires__gt=now)
+                                   .values_list('user_id', 'room_id')
+        )
+        gone = {(user_id, room_id) for _, user_id, room_id in expired} \
+            - still_online
+
+        usernames = dict(User.objects.filter(id__in=user_ids)
+                                     .values_list('id', 'username'))
+        rooms = Room.objects.in_bulk(room_ids)
+        return sorted(((rooms[room_id], usernames[user_id])
+                       for user_id, room_id in gone),
+                      key=lambda pair: (pair[0].name, pair[1]))
 
 
 def chat_message_create(*,
                         text: str,
                         author: User,
+                        room: Room,
                         service_msg: bool = False) -> ChatMessage:
 
     return ChatMessage.objects.create(text=text,
                                       author=author,
+                                      room=room,
                                       service_msg=service_msg)
+
+
+def chat_message_reserve_ids(*, count: int) -> tp.List[int]:
+    """
+    Reserve ids for messages, which are saved later.
+
+    Takes values from primary key sequence, so they never collide with ids
+    given to messages saved by other workers. PostgreSQL only, see
+    `message_writer._enabled`.
+    """
+    table = ChatMessage._meta.db_table
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            "FROM generate_series(1, %s)",
+            [table, count]
+        )
+        return [row[0] for row in cursor.fetchall()]
+
+
+def chat_message_bulk_create(*, messages: tp.List[ChatMessage],
+                             ignore_conflicts: bool = False):
+    ChatMessage.objects.bulk_create(messages,
+                                    ignore_conflicts=ignore_conflicts)
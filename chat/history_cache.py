@@ -0,0 +1,254 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# In-process cache of recent chat history
+#
+# Each worker keeps a bounded ring buffer of the latest serialized messages
+# per room, so connects do not hit the database during reconnect storms.
+# Buffers are kept up to date by write-through from managers and by
+# `history` entries attached to room broadcasts, which every worker with
+# subscribers in the room receives.
+#
+# Buffer is filled from database on miss. Messages, broadcast while it
+# loads, or not saved yet in write-behind mode, may be missing from the
+# loaded snapshot, so every entry received since room subscription is kept
+# in a tail and merged into the snapshot.
+
+import collections
+import time
+import typing as tp
+
+from chat.const import HISTORY_CACHE_SIZE
+from chat.db_selectors import HistoryCursor, HistoryEntry
+from chat.metrics import registry
+from chat.utils import history_cursor_encode, history_cursor_decode
+
+
+def history_event_entry(cursor: HistoryCursor, message: dict) -> dict:
+    """Entry to attach to room broadcast as `history` field"""
+    return {'cursor': history_cursor_encode(*cursor), 'message': message}
+
+
+class RoomHistory:
+    """Ring buffer of latest `(cursor, message)` entries of a single room"""
+
+    def __init__(self, entries: tp.Iterable[HistoryEntry], has_more: bool,
+                 maxlen: int):
+        self.entries = collections.deque(entries, maxlen=maxlen)
+        self._cursors = {cursor for cursor, _ in self.entries}
+        # whether there are messages older than the oldest buffered one
+        self.has_more = has_more
+
+    def append(self, cursor: HistoryCursor, message: dict) -> bool:
+        """
+        Append entry, if it is newer than any buffered one.
+
+        Returns False if entry could not be placed in order, buffer has to
+        be dropped then.
+        """
+        if self.entries and cursor <= self.entries[-1][0]:
+            return cursor in self._cursors
+
+        if len(self.entries) == self.entries.maxlen:
+            self.has_more = True
+            self._cursors.discard(self.entries[0][0])
+        self.entries.append((cursor, message))
+        self._cursors.add(cursor)
+        return True
+
+    def page(self, limit: int, before: tp.Optional[HistoryCursor] = None
+             ) -> tp.Optional[tp.Tuple[tp.List[dict],
+                                       tp.Optional[HistoryCursor]]]:
+        """
+        Page of messages sent before `before` cursor.
+
+        Returns None if page cannot be served from buffer.
+        """
+        end = len(self.entries)
+        if before is not None:
+            while end > 0 and self.entries[end - 1][0] >= before:
+                end -= 1
+            if end == 0:
+                return None
+
+        start = max(end - limit, 0)
+        page = [self.entries[i][1] for i in range(start, end)]
+
+        cursor = None
+        if start > 0 or self.has_more:
+            cursor = self.entries[start][0]
+        return page, cursor
+
+    def since(self, after: HistoryCursor
+              ) -> tp.Optional[tp.List[HistoryEntry]]:
+        """
+        Entries sent after `after` cursor.
+
+        Returns None if older, not buffered, messages may be among them.
+        """
+        if self.entries and after < self.entries[0][0] and self.has_more:
+            return None
+        return [entry for entry in self.entries if entry[0] > after]
+
+    def latest(self) -> tp.Optional[HistoryCursor]:
+        return self.entries[-1][0] if self.entries else None
+
+
+class HistoryCache:
+    """Per-room history buffers with hit/miss counters"""
+
+    def __init__(self, maxlen: int, settle: float = 0):
+        """
+        `settle` is how long broadcast message may stay unsaved, room is
+        not filled until it is subscribed for that long.
+        """
+        self.maxlen = maxlen
+        self.settle = settle
+        self.hits = 0
+        self.misses = 0
+        self._rooms: tp.Dict[str, RoomHistory] = {}
+        self._subscribers: tp.Dict[str, int] = collections.Counter()
+        # entries received since subscription and when it started
+        self._tails: tp.Dict[str, tp.Deque[HistoryEntry]] = {}
+        self._subscribed: tp.Dict[str, float] = {}
+        # encoded cursors of entries applied since subscription, every local
+        # consumer of room receives the same broadcast
+        self._applied: tp.Dict[str, tp.Dict[tp.Tuple[str, int], None]] = {}
+
+    def subscribe(self, room: str):
+        """Register local consumer, receiving broadcasts of given room"""
+        if self._subscribers[room] <= 0:
+            self._tails[room] = collections.deque(maxlen=self.maxlen)
+            self._subscribed[room] = time.monotonic()
+            self._applied[room] = {}
+        self._subscribers[room] += 1
+
+    def unsubscribe(self, room: str):
+        """
+        Unregister local consumer of given room.
+
+        Once the last one is gone, this worker no longer receives room
+        broadcasts, so buffer can not be trusted anymore and is dropped.
+        """
+        self._subscribers[room] -= 1
+        if self._subscribers[room] <= 0:
+            del self._subscribers[room]
+            del self._tails[room]
+            del self._subscribed[room]
+            del self._applied[room]
+            self.invalidate(room)
+
+    def page(self, room: str, limit: int,
+             before: tp.Optional[HistoryCursor] = None
+             ) -> tp.Optional[tp.Tuple[tp.List[dict],
+                                       tp.Optional[HistoryCursor]]]:
+        """Page of room history, None on cache miss"""
+        history = self._rooms.get(room)
+        result = None if history is None else history.page(limit, before)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def since(self, room: str, after: HistoryCursor
+              ) -> tp.Optional[tp.List[HistoryEntry]]:
+        """Room entries sent after `after` cursor, None on cache miss"""
+        history = self._rooms.get(room)
+        result = None if history is None else history.since(after)
+
+        if result is None:
+            self.misses += 1
+        else:
+            self.hits += 1
+        return result
+
+    def latest(self, room: str) -> tp.Optional[HistoryCursor]:
+        """Cursor of the newest buffered message of room"""
+        history = self._rooms.get(room)
+        return None if history is None else history.latest()
+
+    def load_start(self) -> float:
+        """Time to pass to `fill`, taken before snapshot is loaded"""
+        return time.monotonic()
+
+    def fill(self, room: str, entries: tp.Iterable[HistoryEntry],
+             has_more: bool, started: float):
+        """
+        Populate room buffer with entries, loaded from database since
+        `started`, merged with entries received since subscription.
+        """
+        if self._subscribers[room] <= 0:
+            # not receiving updates, buffer would go stale
+            return
+        if started - self._subscribed[room] < self.settle:
+            # messages, broadcast before subscription, may be unsaved yet
+            return
+
+        merged = dict(entries)
+        merged.update(self._tails[room])
+        cursors = sorted(merged)
+        has_more = has_more or len(cursors) > self.maxlen
+        self._rooms[room] = RoomHistory(
+            [(cursor, merged[cursor]) for cursor in cursors[-self.maxlen:]],
+            has_more, self.maxlen
+        )
+
+    def append(self, room: str, cursor: HistoryCursor, message: dict):
+        """Write new message through to room buffer, if it is populated"""
+        tail = self._tails.get(room)
+        if tail is not None:
+            tail.append((cursor, message))
+        history = self._rooms.get(room)
+        if history is not None and not history.append(cursor, message):
+            self.invalidate(room)
+
+    def write_through(self, room: str, msg) -> dict:
+        """
+        Put freshly created message to room buffer.
+
+        Returns entry to attach to room broadcast, so other workers
+        update their buffers as well.
+        """
+        cursor = (msg.sent, msg.id)
+        message = msg.as_dict()
+        entry = history_event_entry(cursor, message)
+        # broadcast comes back to local consumers as well
+        self._mark_applied(room, entry['cursor'])
+        self.append(room, cursor, message)
+        return entry
+
+    def append_from_event(self, room: str, event: dict):
+        """Pop `history` entry from received room broadcast and apply it"""
+        entry = event.pop('history', None)
+        if entry is None or not self._mark_applied(room, entry['cursor']):
+            return
+        cursor = history_cursor_decode(entry['cursor'])
+        self.append(room, cursor, entry['message'])
+
+    def _mark_applied(self, room: str, cursor: dict) -> bool:
+        """Remember entry as applied, False if it already was"""
+        applied = self._applied.get(room)
+        if applied is None:
+            return True
+        key = (cursor['sent'], cursor['id'])
+        if key in applied:
+            return False
+        if len(applied) >= self.maxlen:
+            del applied[next(iter(applied))]
+        applied[key] = None
+        return True
+
+    def invalidate(self, room: str):
+        self._rooms.pop(room, None)
+
+    def stats(self) -> dict:
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'rooms': len(self._rooms)}
+
+
+history_cache = HistoryCache(HISTORY_CACHE_SIZE)
+registry.register_stats('chat_history_cache', history_cache.stats)
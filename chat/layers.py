@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Channel layers
+#
+# `ShardedRedisChannelLayer` spreads groups and channels over several Redis
+# hosts by a hash ring, so adding a host moves only a share of keys to it.
+# `LocalChannelLayer` fans events out inside a single process, without
+# serialization; use it only, when all sockets are served by one process.
+# `CHAT_CHANNEL_LAYER` setting selects one of them.
+
+import asyncio
+import bisect
+import hashlib
+import time
+import typing as tp
+
+from channels.exceptions import ChannelFull
+from channels.layers import InMemoryChannelLayer
+
+try:
+    from channels_redis.core import RedisChannelLayer
+except ImportError:
+    RedisChannelLayer = None
+
+
+def _hash(value: bytes) -> int:
+    return int.from_bytes(hashlib.md5(value).digest()[:8], 'big')
+
+
+class HashRing:
+    """Consistent hashing of keys to `size` nodes"""
+
+    # points per node, more of them spread keys more evenly
+    REPLICAS = 128
+
+    def __init__(self, nodes: tp.Sequence[str]):
+        points = sorted((_hash(f'{node}#{i}'.encode()), index)
+                        for index, node in enumerate(nodes)
+                        for i in range(self.REPLICAS))
+        self._hashes = [point for point, _ in points]
+        self._nodes = [index for _, index in points]
+
+    def node(self, key: bytes) -> int:
+        """Index of node, owning key"""
+        position = bisect.bisect(self._hashes, _hash(key))
+        return self._nodes[position % len(self._nodes)]
+
+
+if RedisChannelLayer is not None:
+    class ShardedRedisChannelLayer(RedisChannelLayer):
+        """
+        Redis layer with groups and channels placed by hash ring of hosts.
+
+        Hosts are identified by address, so each worker must be given the
+        same hosts, in any order.
+        """
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            self._ring = HashRing([str(host.get('address', host))
+                                   for host in self.hosts])
+
+        def consistent_hash(self, value) -> int:
+            if isinstance(value, str):
+                value = value.encode('utf8')
+            return self._ring.node(value)
+
+
+class LocalChannelLayer(InMemoryChannelLayer):
+    """
+    In-process layer for single-process deployments.
+
+    Unlike channels in-memory layer, events are not deep-copied for every
+    receiver, consumers must not change them, and expired events are
+    cleaned up once in `clean_interval` seconds, not on every send and
+    receive.
+    """
+
+    def __init__(self, clean_interval: float = 1, **kwargs):
+        super().__init__(**kwargs)
+        self.clean_interval = clean_interval
+        self._cleaned = 0.
+
+    def _clean_expired(self):
+        now = time.monotonic()
+        if now - self._cleaned >= self.clean_interval:
+            self._cleaned = now
+            super()._clean_expired()
+
+    def _put(self, channel: str, message: dict, expires: float) -> bool:
+        queue = self.channels.get(channel)
+        if queue is None:
+            queue = self.channels[channel] = asyncio.Queue()
+        if queue.qsize() >= self.capacity:
+            return False
+        # top level copy keeps receivers from seeing each other's keys
+        queue.put_nowait((expires, dict(message)))
+        return True
+
+    async def send(self, channel, message):
+        assert isinstance(message, dict), 'message is not a dict'
+        assert self.valid_channel_name(channel), 'Channel name not valid'
+        if not self._put(channel, message, time.time() + self.expiry):
+            raise ChannelFull(channel)
+
+    async def group_send(self, group, message):
+        assert isinstance(message, dict), 'Message is not a dict'
+        assert self.valid_group_name(group), 'Invalid group name'
+        self._clean_expired()
+        # channel names were checked, when they were added to group
+        expires = time.time() + self.expiry
+        for channel in list(self.groups.get(group, ())):
+            # receiver, which is full, misses event, as with other layers
+            self._put(channel, message, expires)
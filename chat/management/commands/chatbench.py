@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+import json
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.test import override_settings
+
+from chat.benchmarks import BENCH_LAYERS, SCENARIOS
+from chat.rate_limit import connection_rate_limit, user_rate_limit
+
+
+class Command(BaseCommand):
+    help = 'Run chat benchmark scenario, report results as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('scenario', choices=sorted(SCENARIOS))
+        parser.add_argument('--messages', type=int, default=10000,
+                            help='Number of messages in history')
+        parser.add_argument('--repeat', type=int, default=5,
+                            help='Number of runs, best one is reported')
+        parser.add_argument('--output',
+                            help='File to write results to, stdout if omitted')
+        parser.add_argument('--clients', type=int, default=50,
+                            help='Number of simulated clients')
+        parser.add_argument('--rounds', type=int, default=10,
+                            help='Messages, mentions or reconnects per client')
+        parser.add_argument('--room', default='bench',
+                            help='Room used by simulated clients')
+        parser.add_argument('--timeout', type=float, default=30,
+                            help='Seconds to wait for a single frame')
+        parser.add_argument('--layer', choices=sorted(BENCH_LAYERS),
+                            help='Use channels in-memory or local channel '
+                                 'layer instead of configured one')
+        parser.add_argument('--in-memory-layer', action='store_const',
+                            dest='layer', const='memory',
+                            help='Same as --layer memory')
+        parser.add_argument('--rate-limits', action='store_true',
+                            help='Keep configured rate limits of received '
+                                 'events, disabled by default')
+
+    def handle(self, *args, **options):
+        if not options['rate_limits']:
+            # simulated clients send as fast as they can
+            connection_rate_limit.rate = user_rate_limit.rate = 0
+
+        overrides = {}
+        if options['layer']:
+            overrides['CHANNEL_LAYERS'] = {
+                'default': BENCH_LAYERS[options['layer']]
+            }
+
+        with override_settings(**overrides):
+            try:
+                scenario_results = SCENARIOS[options['scenario']](options)
+            except OSError as e:
+                # configured Redis may be unreachable from bench host
+                backend = settings.CHANNEL_LAYERS['default']['BACKEND']
+                raise CommandError(
+                    f'Channel layer {backend} is unavailable: {e!r}, '
+                    f'use --layer memory or --layer local'
+                ) from e
+            results = {'scenario': options['scenario'],
+                       'options': {key: options[key]
+                                   for key in ('messages', 'repeat', 'clients',
+                                               'rounds', 'layer',
+                                               'rate_limits')},
+                       'results': scenario_results}
+        report = json.dumps(results, indent=2)
+
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report)
+        else:
+            self.stdout.write(report)
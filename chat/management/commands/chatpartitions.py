@@ -0,0 +1,59 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import partitions
+
+
+class Command(BaseCommand):
+    help = 'Manage monthly partitions of chat messages and their archival'
+
+    def add_arguments(self, parser):
+        parser.add_argument('action', choices=['ensure', 'list', 'archive'],
+                            help='ensure -- create partitions of current and '
+                                 'coming months, list -- show partitions, '
+                                 'archive -- archive and remove old months')
+        parser.add_argument('--ahead', type=int,
+                            default=partitions.PARTITIONS_AHEAD,
+                            help='Months after current one to create '
+                                 'partitions for')
+        parser.add_argument('--older-than', type=int,
+                            default=partitions.RETENTION_MONTHS,
+                            help='Archive months before the last that many '
+                                 'ones, preceding current month')
+        parser.add_argument('--archive-dir', default=partitions.ARCHIVE_DIR,
+                            help='Directory to write archives to')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only show months, which would be archived')
+
+    def handle(self, *args, **options):
+        getattr(self, f"handle_{options['action']}")(options)
+
+    def handle_ensure(self, options):
+        if not partitions.is_partitioned():
+            raise CommandError('Messages table is not partitioned')
+        for month in partitions.partitions_ensure(ahead=options['ahead']):
+            self.stdout.write(f'Created {partitions.partition_name(month)}')
+
+    def handle_list(self, options):
+        if not partitions.is_partitioned():
+            raise CommandError('Messages table is not partitioned')
+        for name, rows in sorted(partitions.partition_rows().items()):
+            self.stdout.write(f'{name}\t~{rows} rows')
+
+    def handle_archive(self, options):
+        if options['older_than'] is None:
+            raise CommandError('Set CHAT_RETENTION_MONTHS or --older-than')
+        if options['older_than'] < 0:
+            raise CommandError('--older-than may not be negative')
+
+        archived = partitions.messages_archive(
+            older_than=options['older_than'],
+            directory=options['archive_dir'],
+            dry_run=options['dry_run']
+        )
+        verb = 'Would archive' if options['dry_run'] else 'Archived'
+        for month, count in archived:
+            self.stdout.write(f'{verb} {month:%Y-%m}: {count} messages')
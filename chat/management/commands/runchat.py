@@ -0,0 +1,134 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+import argparse
+import os
+import shutil
+import socket
+import sys
+import tempfile
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import metrics, workers
+from chat.layers import LocalChannelLayer
+
+
+class Command(BaseCommand):
+    help = 'Run chat server in several worker processes on one port'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--workers', type=int, default=1,
+                            help='Number of worker processes, each one '
+                                 'holds its own database connections, see '
+                                 'CHAT_DB_CONNECTIONS_MAX')
+        parser.add_argument('--bind', default='127.0.0.1',
+                            help='Address to listen on')
+        parser.add_argument('--port', type=int, default=8000,
+                            help='Port to listen on')
+        parser.add_argument('--drain-timeout', type=float, default=10,
+                            help='Seconds stopped worker waits for its '
+                                 'connections to close')
+        parser.add_argument('--report-interval', type=float, default=30,
+                            help='Seconds between connection reports, '
+                                 '0 disables them')
+        parser.add_argument('--metrics-dir',
+                            default=getattr(settings, 'CHAT_METRICS_DIR',
+                                            None),
+                            help='Directory, workers share metrics through, '
+                                 'temporary one by default')
+        # worker process options, set by supervisor
+        parser.add_argument('--worker', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--fd', type=int, help=argparse.SUPPRESS)
+        parser.add_argument('--status-fd', type=int, help=argparse.SUPPRESS)
+
+    def handle(self, *args, **options):
+        if options['worker'] is not None:
+            self.handle_worker(options)
+        else:
+            self.handle_supervisor(options)
+
+    def handle_worker(self, options):
+        if options['fd'] is not None:
+            sock = socket.socket(fileno=options['fd'])
+        else:
+            sock = workers.listen_socket(options['bind'], options['port'],
+                                         reuse_port=True)
+        workers.Worker(index=options['worker'], sock=sock,
+                       drain_timeout=options['drain_timeout'],
+                       status_fd=options['status_fd'],
+                       metrics_dir=options['metrics_dir'],
+                       verbosity=options['verbosity']).run()
+
+    def handle_supervisor(self, options):
+        if options['workers'] < 1:
+            raise CommandError('--workers must be positive')
+        layer = settings.CHANNEL_LAYERS['default']['BACKEND']
+        if options['workers'] > 1 and \
+                layer.endswith(LocalChannelLayer.__name__):
+            raise CommandError('Local channel layer does not reach other '
+                               'workers, set CHAT_CHANNEL_LAYER to redis')
+        per_worker = workers.db_connections_per_worker()
+        db_connections = options['workers'] * per_worker
+        budget = getattr(settings, 'CHAT_DB_CONNECTIONS_MAX', None)
+        if budget is not None and db_connections > budget:
+            raise CommandError(
+                f"{options['workers']} workers may hold {db_connections} "
+                f"database connections, {per_worker} each, over "
+                f"CHAT_DB_CONNECTIONS_MAX of {budget}; run at most "
+                f"{max(budget // per_worker, 1)} workers, or lower "
+                f"CHAT_DB_EXECUTOR_WORKERS or ASGI_THREADS"
+            )
+
+        try:
+            # with SO_REUSEPORT each worker binds its own socket, this one
+            # only checks the address is free
+            sock = workers.listen_socket(options['bind'], options['port'],
+                                         reuse_port=workers.REUSE_PORT,
+                                         listen=not workers.REUSE_PORT)
+        except OSError as e:
+            raise CommandError(f"Can't listen on "
+                               f"{options['bind']}:{options['port']}: {e}")
+        pass_fds = ()
+        if workers.REUSE_PORT:
+            sock.close()
+        else:
+            pass_fds = (sock.fileno(),)
+
+        metrics_dir = options['metrics_dir']
+        temporary_dir = None
+        if metrics.enabled and metrics_dir is None:
+            metrics_dir = temporary_dir = tempfile.mkdtemp(
+                prefix='chat-metrics-')
+        elif metrics_dir is not None:
+            os.makedirs(metrics_dir, exist_ok=True)
+
+        def command(index, status_fd):
+            argv = [sys.executable, sys.argv[0], 'runchat',
+                    '--worker', str(index), '--status-fd', str(status_fd),
+                    '--bind', options['bind'],
+                    '--port', str(options['port']),
+                    '--drain-timeout', str(options['drain_timeout']),
+                    '--verbosity', str(options['verbosity'])]
+            if pass_fds:
+                argv += ['--fd', str(pass_fds[0])]
+            if metrics_dir is not None:
+                argv += ['--metrics-dir', metrics_dir]
+            return argv
+
+        self.stdout.write(f"Serving {options['bind']}:{options['port']} by "
+                          f"{options['workers']} workers, "
+                          f"{'SO_REUSEPORT' if workers.REUSE_PORT else 'shared socket'}, "
+                          f"up to {db_connections} database connections")
+        try:
+            workers.Supervisor(workers=options['workers'], command=command,
+                               pass_fds=pass_fds,
+                               drain_timeout=options['drain_timeout'],
+                               report_interval=options['report_interval'],
+                               metrics_dir=metrics_dir,
+                               out=self.stdout.write).run()
+        finally:
+            if temporary_dir is not None:
+                shutil.rmtree(temporary_dir, ignore_errors=True)
@@ -3,28 +3,114 @@
 # Author: Danil Kovalenko
 
 import abc
-import json
+import asyncio
+import datetime
+import logging
+import typing as tp
 
 from channels.generic.websocket import AsyncWebsocketConsumer
-from channels.db import database_sync_to_async as db
+from django.conf import settings
+from django.utils import timezone
 
-from chat.db_selectors import active_user_get, chat_message_all, \
-    active_user_online_users
-from chat.db_services import active_user_connections_decr, \
-    active_user_connections_incr, chat_message_create
-from chat.utils import datetime_to_dict
-from chat.const import CHAT_ROOM_NAME
+from chat.db_selectors import chat_message_page_as_dicts, \
+    connection_lease_online_users_as_dicts, chat_message_page_entries, \
+    chat_message_since_entries, HistoryCursor, HistoryEntry
+from chat.db_services import connection_lease_acquire, \
+    connection_lease_release, connection_lease_renew
+from chat.models import ChatMessage, Room
+from chat.utils import datetime_to_epoch_ms, history_cursor_encode, \
+    history_cursor_decode, user_group_name
+from chat.codec import decode, encoded_event
+from chat.history_cache import history_cache, RoomHistory
+from chat.message_writer import chat_message_persist
+from chat.db_executor import db
+from chat.mentions import known_usernames, mentions_extract
+from chat.metrics import event_handler_seconds, group_send, \
+    group_send_many, rejected_events
+from chat import presence
+from chat.rate_limit import connection_rate_limit, user_rate_limit
+from chat.search import message_search
+from chat.const import HISTORY_PAGE_SIZE, HISTORY_CACHE_SIZE, \
+    PRESENCE_HEARTBEAT_INTERVAL, CLOSE_MESSAGE_TOO_BIG, RESUME_GAP_MAX, \
+    SEARCH_PAGE_SIZE, SEARCH_PAGES_MAX, SEARCH_QUERY_LENGTH_MAX, \
+    SEARCH_DAYS, SEARCH_DAYS_MAX
 
 
-class ManagerError(Exception): pass
+log = logging.getLogger(__name__)
 
+FRAME_SIZE_MAX = getattr(settings, 'CHAT_FRAME_SIZE_MAX', 64 * 1024)
+MESSAGE_LENGTH_MAX = ChatMessage._meta.get_field('text').max_length
 
-class MessageSchemaError(ManagerError): pass
+
+class ManagerError(Exception):
+    # reported to client in `error` frame, when event is rejected
+    reason = 'error'
+
+
+class MessageSchemaError(ManagerError):
+    reason = 'invalid'
+
+
+class UnknownEventError(MessageSchemaError):
+    reason = 'unknown_type'
+
+
+class RateLimitError(ManagerError):
+    reason = 'rate_limited'
+
+
+async def history_page(room: Room, before=None):
+    """
+    Fetch page of room history, sent before `before` cursor.
+
+    Served from history cache when possible, latest messages are loaded
+    into cache on miss. Returns serialized messages and cursor for the next
+    (older) page, cursor is None if there is nothing more to fetch.
+    """
+    page = history_cache.page(room.name, HISTORY_PAGE_SIZE, before)
+
+    if page is None and before is None:
+        started = history_cache.load_start()
+        entries, has_more = await db(chat_message_page_entries)(
+            room=room, limit=HISTORY_CACHE_SIZE
+        )
+        history_cache.fill(room.name, entries, has_more, started)
+        page = RoomHistory(entries, has_more, HISTORY_CACHE_SIZE) \
+            .page(HISTORY_PAGE_SIZE)
+    elif page is None:
+        page = await db(chat_message_page_as_dicts)(
+            room=room, limit=HISTORY_PAGE_SIZE, before=before
+        )
+
+    data, cursor = page
+    if cursor is not None:
+        cursor = history_cursor_encode(*cursor)
+    return data, cursor
+
+
+async def history_since(room: Room, after: HistoryCursor
+                        ) -> tp.Optional[tp.List[HistoryEntry]]:
+    """
+    Room messages, sent after `after` cursor, served from history cache
+    when possible. None if there are more than `RESUME_GAP_MAX` of them.
+    """
+    entries = history_cache.since(room.name, after)
+    if entries is None:
+        entries, has_more = await db(chat_message_since_entries)(
+            room=room, after=after, limit=RESUME_GAP_MAX
+        )
+        if has_more:
+            return None
+    return entries if len(entries) <= RESUME_GAP_MAX else None
 
 
 class AbstractManager(metaclass=abc.ABCMeta):
     """Manager base class. Implements interface required for all managers"""
 
+    # hooks of independent manager may run concurrently with hooks of
+    # adjacent independent managers, others run strictly in declared order
+    independent = False
+
     @abc.abstractmethod
     def __init__(self, consumer: AsyncWebsocketConsumer):
         pass
@@ -43,129 +129,180 @@ class AbstractManager(metaclass=abc.ABCMeta):
 
 
 class UserTrackManager(AbstractManager):
-    """User track manager, tracks online users"""
+    """
+    User track manager, tracks online users
+
+    Holds presence lease of the connection and renews it by heartbeats.
+    Lease of drained connection is left to expire, so user, reconnecting
+    to another worker in time, stays online without presence events.
+    """
 
     def __init__(self, consumer: AsyncWebsocketConsumer):
         super().__init__(consumer)
+        self.consumer = consumer
         self.scope = consumer.scope
-        self.send = consumer.send
-        self.group_send = consumer.channel_layer.group_send
+        self.room = consumer.room
+        self.send_encoded = consumer.send_encoded
+        self.channel_layer = consumer.channel_layer
+        self.channel_name = consumer.channel_name
+        self.heartbeat = None
 
     async def on_connect(self):
-        active_record = await self.get_user_active_record()
-
-        if active_record.active_connections == 0:
-            event_data = {
-                'type': 'online.connect',
-                'user': self.scope['user'].username
-            }
-            # notify all
-            await self.group_send(CHAT_ROOM_NAME, event_data)
-            await self.send(json.dumps(event_data))
-            await self.send_service_msg_connect()
-
-        await db(active_user_connections_incr)(active_user=active_record)
+        presence.presence_sweeper.ensure_running(self.channel_layer)
+        await self.acquire_lease()
+        self.heartbeat = asyncio.ensure_future(self.heartbeat_loop())
 
     async def on_disconnect(self):
-        active_record = await self.get_user_active_record()
-        await db(active_user_connections_decr)(active_user=active_record)
-
-        if active_record.active_connections == 0:
-            event_data = {
-                'type': 'online.disconnect',
-                'user': self.scope['user'].username
-            }
-            # notify all
-            await self.group_send(CHAT_ROOM_NAME, event_data)
-            await self.send(json.dumps(event_data))
-            await self.send_service_msg_disconnect()
+        if self.heartbeat is not None:
+            self.heartbeat.cancel()
+        if self.consumer.draining:
+            return
+
+        connections = await db(connection_lease_release)(
+            user=self.scope['user'],
+            room=self.room,
+            channel_name=self.channel_name,
+            now=presence.clock()
+        )
+
+        # last connection of the user
+        if connections == 0:
+            await self.announce(joined=False)
 
     async def on_receive(self, text_data=None, bytes_data=None): pass
 
-    async def get_user_active_record(self):
-        """Get record about number of active connections for given user"""
-        return await db(active_user_get)(user=self.scope['user'])
-
-    async def send_service_msg_connect(self):
+    async def acquire_lease(self):
+        connections = await db(connection_lease_acquire)(
+            user=self.scope['user'],
+            room=self.room,
+            channel_name=self.channel_name,
+            expires=presence.lease_expiry(),
+            now=presence.clock()
+        )
+
+        # first connection of the user
+        if connections == 1:
+            await self.announce(joined=True)
+
+    async def heartbeat_loop(self):
+        while True:
+            await asyncio.sleep(PRESENCE_HEARTBEAT_INTERVAL)
+            try:
+                await self.heartbeat_once()
+            except Exception as e:
+                # lease outlives a few missed heartbeats, retried on next one
+                log.warning(f'Presence heartbeat of {self.channel_name} '
+                            f'failed: {e!r}')
+
+    async def heartbeat_once(self):
+        renewed = await db(connection_lease_renew)(
+            channel_name=self.channel_name,
+            expires=presence.lease_expiry()
+        )
+        # lease was expired, while connection is still alive,
+        # e.g. worker was stalled or heartbeats failed
+        if not renewed:
+            await self.acquire_lease()
+
+    async def announce(self, joined: bool):
         username = self.scope['user'].username
-        message = f'User {username} joined'
-        attrs = {'text': message, 'author': None, 'service_msg': True}
-        await db(chat_message_create)(**attrs)
-        await self.group_send(CHAT_ROOM_NAME,
-                              {'type': 'chat.servicemessage',
-                               'message': message})
+        await presence.presence_announce(self.channel_layer, self.room,
+                                         username, joined)
+        if joined:
+            # own connection is not kept waiting for the next delta
+            for event in presence.presence_events([username], []):
+                await self.send_encoded(event)
 
-    async def send_service_msg_disconnect(self):
-        username = self.scope['user'].username
-        message = f'User {username} left'
-        attrs = {'text': message, 'author': None, 'service_msg': True}
-        await db(chat_message_create)(**attrs)
-        await self.group_send(CHAT_ROOM_NAME,
-                              {'type': 'chat.servicemessage',
-                               'message': message})
 
 class InitManager(AbstractManager):
     """
     Initialization manager.
 
-    Sends init message about chat history and current online
+    Sends init message about chat history and current online. Resumed
+    session gets only messages it missed, if there are not too many.
     """
 
+    independent = True
+
     def __init__(self, consumer: AsyncWebsocketConsumer):
         super().__init__(consumer)
         self.consumer = consumer
-        self.send = consumer.send
+        self.send = consumer.send_frame
 
     async def on_connect(self):
         await self.send_whoami()
-        await self.send_chat_history()
-        await self.send_current_online()
+
+        if self.consumer.concurrent_managers:
+            history, online_users = await asyncio.gather(
+                self.get_history(), self.get_online_users()
+            )
+        else:
+            history = await self.get_history()
+            online_users = await self.get_online_users()
+
+        await self.send(history)
+        await self.send_current_online(online_users)
 
     async def on_disconnect(self):
         pass
 
     async def on_receive(self, text_data=None, bytes_data=None): pass
 
-    async def get_chat_messages(self):
-            history = await db(chat_message_all)()
-            return history
-
     async def get_online_users(self):
-        users = await db(active_user_online_users)()
+        users = await db(connection_lease_online_users_as_dicts)(
+            room=self.consumer.room, now=presence.clock()
+        )
         return users
 
+    async def get_history(self) -> dict:
+        """Frame of missed messages if session is resumed, else of latest"""
+        room = self.consumer.room
+        resume = self.consumer.resume_cursor
+        if resume is not None:
+            missed = await history_since(room, resume)
+            if missed is not None:
+                last = missed[-1][0] if missed else resume
+                return {'type': 'init.resume',
+                        'data': [message for _, message in missed],
+                        'last': history_cursor_encode(*last)}
+
+        data, cursor = await history_page(room)
+        # resume point, unknown unless history is cached
+        last = history_cache.latest(room.name)
+        return {'type': 'init.chat_history',
+                'data': data,
+                'cursor': cursor,
+                'last': history_cursor_encode(*last) if last else None}
+
     async def send_whoami(self):
         username = self.consumer.scope['user'].username,
 
         # username is a tuple here
-        response = {'type': 'init.whoami', 'user': username[0]}
-        await self.send(json.dumps(response))
-
-    async def send_chat_history(self):
-        msg_history = await self.get_chat_messages()
-        data = [await db(m.as_dict)() for m in msg_history]
+        response = {'type': 'init.whoami',
+                    'user': username[0],
+                    'protocol': self.consumer.protocol}
+        await self.send(response)
 
-        event_data = {
-            'type': 'init.chat_history',
-            'data': data
-        }
-        await self.send(text_data=json.dumps(event_data))
-
-    async def send_current_online(self):
-        online_users = await self.get_online_users()
+    async def send_current_online(self, online_users):
         event_data = {
             'type': 'init.online_users',
-            'data': [await db(u.as_dict)() for u in online_users]
+            'data': online_users
         }
-        await self.send(text_data=json.dumps(event_data))
+        await self.send(event_data)
 
 
 class ReceiveManager(AbstractManager):
     """
 
     Handles socket.receive events and dispatches them to corresponding handlers
+
+    Frames are checked for size and rate limits before parsing, events of
+    types out of `handlers` are rejected. Rejected events are reported to
+    client by `error` frame, oversized frames close connection.
     """
 
+    independent = True
+
     def __init__(self, consumer: AsyncWebsocketConsumer):
         super().__init__(consumer)
         self.consumer = consumer
@@ -174,44 +311,154 @@ class ReceiveManager(AbstractManager):
         pass
 
     async def on_disconnect(self):
-        pass
+        connection_rate_limit.forget(self.consumer.channel_name)
 
     async def dispatch_receive_event(self, event):
-        """Derive method name and dispatch event to it"""
-        if 'type' not in event:
+        """Dispatch event to handler of its type"""
+        if not isinstance(event, dict) or \
+                not isinstance(event.get('type'), str):
             err_msg = f'Expected `type` field in event. Got: {event}'
             raise MessageSchemaError(err_msg)
 
-        handler_name = event['type'].lower().replace('.', '_')
-        handler = getattr(self, handler_name)
-        await handler(event)
+        handler = self.handlers.get(event['type'])
+        if handler is None:
+            raise UnknownEventError(f'Unknown event type: {event["type"]}')
+        with event_handler_seconds.time(event=handler.__name__):
+            await handler(self, event)
+
+    async def rate_limit(self):
+        """Take a token of connection and user, both must be available"""
+        channel_name = self.consumer.channel_name
+        if not connection_rate_limit.allow_local(channel_name):
+            raise RateLimitError('Too many events, slow down')
+        if not await user_rate_limit.allow(
+                self.consumer.scope['user'].username,
+                self.consumer.channel_layer):
+            # throttled user does not drain bucket of the connection
+            connection_rate_limit.refund(channel_name)
+            raise RateLimitError('Too many events, slow down')
 
     async def on_receive(self, text_data=None, bytes_data=None):
-        event = json.loads(text_data)
-        await self.dispatch_receive_event(event)
+        size = len(text_data if text_data is not None else bytes_data or b'')
+        if size > FRAME_SIZE_MAX:
+            rejected_events.inc(reason='too_large')
+            await self.consumer.close(code=CLOSE_MESSAGE_TOO_BIG)
+            return
+
+        try:
+            await self.rate_limit()
+            try:
+                event = decode(text_data, bytes_data)
+            except (ValueError, TypeError, RecursionError) as e:
+                # small frame may still be nested too deep to decode
+                raise MessageSchemaError(f'Malformed frame: {e}') from e
+            await self.dispatch_receive_event(event)
+        except ManagerError as e:
+            rejected_events.inc(reason=e.reason)
+            await self.consumer.send_frame({'type': 'error',
+                                            'reason': e.reason,
+                                            'detail': str(e)})
 
     # dispatchable handlers
 
-    async def user_mention(self, event):
-        """Identify user channel by user name, send toast"""
-        event['by'] = self.consumer.scope['user'].username
-        target_username = event['name']
+    async def history_fetch(self, event):
+        """Send page of history older than given cursor to requester"""
+        if 'cursor' not in event:
+            err_msg = f'Expected `cursor` field in event. Got: {event}'
+            raise MessageSchemaError(err_msg)
 
-        await self.consumer.channel_layer.group_send(target_username, event)
+        try:
+            before = history_cursor_decode(event['cursor'])
+        except ValueError as e:
+            raise MessageSchemaError(str(e)) from e
 
-    async def chat_servicemessage(self, event):
-        """Handle chat service messages (joined channel, left channel)"""
-        await self.consumer.channel_layer.group_send(CHAT_ROOM_NAME, event)
+        data, cursor = await history_page(self.consumer.room, before)
+        event_data = {
+            'type': 'history.page',
+            'data': data,
+            'cursor': cursor
+        }
+        await self.consumer.send_frame(event_data)
+
+    async def search_query(self, event):
+        """Send page of room messages, matching query, to requester"""
+        query = event.get('query')
+        page = event.get('page', 0)
+        days = event.get('days', SEARCH_DAYS)
+        if not isinstance(query, str) or not query.strip() or \
+                len(query) > SEARCH_QUERY_LENGTH_MAX:
+            err_msg = f'Expected `query` of 1..{SEARCH_QUERY_LENGTH_MAX} ' \
+                      f'characters in event. Got: {event}'
+            raise MessageSchemaError(err_msg)
+        if not isinstance(page, int) or not 0 <= page < SEARCH_PAGES_MAX:
+            err_msg = f'Expected `page` in 0..{SEARCH_PAGES_MAX - 1}. ' \
+                      f'Got: {event}'
+            raise MessageSchemaError(err_msg)
+        if not isinstance(days, int) or not 0 < days <= SEARCH_DAYS_MAX:
+            err_msg = f'Expected `days` in 1..{SEARCH_DAYS_MAX}. ' \
+                      f'Got: {event}'
+            raise MessageSchemaError(err_msg)
+
+        entries, has_more = await db(message_search)(
+            room=self.consumer.room, query=query, limit=SEARCH_PAGE_SIZE,
+            offset=page * SEARCH_PAGE_SIZE,
+            since=timezone.now() - datetime.timedelta(days=days)
+        )
+        event_data = {
+            'type': 'search.results',
+            'query': query,
+            'page': page,
+            'data': [{**message, 'cursor': history_cursor_encode(*cursor)}
+                     for cursor, message in entries],
+            'has_more': has_more
+        }
+        await self.consumer.send_frame(event_data)
 
     async def chat_message(self, event):
         """Handle chat message"""
         user = self.consumer.scope['user']
-        message = event['message']
-        msg = await db(chat_message_create)(text=message, author=user)
-
-        to_send = {'type': 'chat.message',
-                   'message': message,
-                   'author': user.username,
-                   'sent': datetime_to_dict(msg.sent)}
-
-        await self.consumer.channel_layer.group_send(CHAT_ROOM_NAME, to_send)
+        message = event.get('message')
+        if not isinstance(message, str):
+            err_msg = f'Expected `message` string in event. Got: {event}'
+            raise MessageSchemaError(err_msg)
+        if len(message) > MESSAGE_LENGTH_MAX:
+            raise MessageSchemaError(f'Message is longer than '
+                                     f'{MESSAGE_LENGTH_MAX} characters')
+        room = self.consumer.room
+        msg = await chat_message_persist(text=message, author=user, room=room)
+        entry = history_cache.write_through(room.name, msg)
+
+        to_send = encoded_event({'type': 'chat.message',
+                                 'message': message,
+                                 'author': user.username,
+                                 'sent': datetime_to_epoch_ms(msg.sent),
+                                 'cursor': entry['cursor']},
+                                history=entry)
+
+        await group_send(self.consumer.channel_layer, self.consumer.room_group,
+                         to_send)
+        await self.notify_mentioned(message)
+
+    async def notify_mentioned(self, message: str):
+        """Send toast to every existing user, mentioned in message"""
+        author = self.consumer.scope['user'].username
+        mentioned = [name for name in mentions_extract(message)
+                     if name != author]
+        if mentioned:
+            mentioned = await known_usernames.filter(mentioned)
+        if not mentioned:
+            return
+
+        event = encoded_event({'type': 'user.mention',
+                               'by': author,
+                               'message': message})
+        await group_send_many(self.consumer.channel_layer,
+                              [user_group_name(name) for name in mentioned],
+                              event)
+
+    # received event types, clients may send
+    handlers = {
+        'chat.message': chat_message,
+        'history.fetch': history_fetch,
+        'search.query': search_query,
+    }
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Mentions of users in chat messages
+#
+# `@name` mentions are extracted from message text on the server and
+# checked against usernames known to exist, so notifications go only to
+# real users. Existing usernames are cached by each worker for a while, so
+# deleted users stop matching, unknown ones are looked up in a single query
+# per message.
+
+import re
+import time
+import typing as tp
+
+from chat.const import MENTIONS_PER_MESSAGE_MAX, KNOWN_USERNAMES_MAX, \
+    KNOWN_USERNAMES_TTL
+from chat.db_executor import db
+from chat.db_selectors import user_usernames_existing
+from chat.metrics import registry
+
+
+# name ends with a word character, so trailing punctuation is not captured
+MENTION_PATTERN = re.compile(r'(?:^|\s)@([\w.\-]*\w)')
+
+
+def mentions_extract(text: str) -> tp.List[str]:
+    """Mentioned usernames in order of appearance, without duplicates"""
+    names = dict.fromkeys(MENTION_PATTERN.findall(text))
+    return list(names)[:MENTIONS_PER_MESSAGE_MAX]
+
+
+class KnownUsernames:
+    """
+    Usernames, known to exist.
+
+    At most `maxlen` ones are kept, oldest are dropped first, each one is
+    trusted for `ttl` seconds since it was looked up.
+    """
+
+    def __init__(self, maxlen: int, ttl: float):
+        self.maxlen = maxlen
+        self.ttl = ttl
+        # username -> time it is known until, oldest first
+        self._known: tp.Dict[str, float] = {}
+        self.hits = 0
+        self.misses = 0
+
+    def _is_known(self, name: str, now: float) -> bool:
+        until = self._known.get(name)
+        if until is None:
+            return False
+        if until <= now:
+            del self._known[name]
+            return False
+        return True
+
+    async def filter(self, usernames: tp.List[str]) -> tp.List[str]:
+        """Existing ones of given usernames, order is kept"""
+        now = time.monotonic()
+        known = {name for name in usernames if self._is_known(name, now)}
+        unknown = [name for name in usernames if name not in known]
+        self.hits += len(usernames) - len(unknown)
+        self.misses += len(unknown)
+        if unknown:
+            existing = await db(user_usernames_existing)(usernames=unknown)
+            known.update(existing)
+            until = time.monotonic() + self.ttl
+            for name in existing:
+                self._known.pop(name, None)
+                self._known[name] = until
+            while len(self._known) > self.maxlen:
+                del self._known[next(iter(self._known))]
+        return [name for name in usernames if name in known]
+
+    def stats(self) -> dict:
+        return {'hits': self.hits,
+                'misses': self.misses,
+                'size': len(self._known)}
+
+
+known_usernames = KnownUsernames(KNOWN_USERNAMES_MAX, KNOWN_USERNAMES_TTL)
+registry.register_stats('chat_known_usernames', known_usernames.stats)
@@ -0,0 +1,239 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Persistence of chat messages
+#
+# By default each message is saved before it is broadcast. With
+# `CHAT_WRITE_BEHIND` setting enabled, message gets id and timestamp from
+# the worker, is broadcast immediately and saved later by `bulk_create`
+# batches, flushed by size or time. Messages, not flushed yet, are lost if
+# worker is killed, so strict durability deployments keep it disabled.
+#
+# Failed batch is retried on the next flushes, `CHAT_WRITE_BEHIND_RETRIES`
+# times, then its messages are saved one by one, and ones, which still
+# fail, are logged in full to `chat.message_writer.dead_letter` logger.
+# Once `CHAT_WRITE_BEHIND_QUEUE_MAX` messages are queued, new ones are
+# saved right away, so a stalled database slows senders down instead of
+# growing the queue.
+
+import asyncio
+import atexit
+import collections
+import json
+import logging
+import time
+import typing as tp
+
+from django.conf import settings
+from django.contrib.auth.models import User
+from django.db import connections
+from django.utils import timezone
+
+from chat.db_services import chat_message_create, chat_message_bulk_create, \
+    chat_message_reserve_ids
+from chat.db_executor import db, db_executor
+from chat.history_cache import history_cache
+from chat.metrics import registry
+from chat.models import ChatMessage, Room
+
+
+log = logging.getLogger(__name__)
+dead_letter_log = logging.getLogger(f'{__name__}.dead_letter')
+
+
+class MessageWriter:
+    """Write-behind queue of chat messages"""
+
+    def __init__(self, batch_size: int, flush_interval: float,
+                 retries: int = 3, queue_max: int = 10000):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.retries = retries
+        self.queue_max = queue_max
+        self._queue: tp.List[ChatMessage] = []
+        self._ids: tp.Deque[int] = collections.deque()
+        self._task = None
+        self._flushing = None
+        # batches being saved, and failed attempts of the head of queue
+        self._inflight: tp.List[tp.List[ChatMessage]] = []
+        self._attempts = 0
+
+        # metrics
+        self.flushes = 0
+        self.flushed = 0
+        self.flush_errors = 0
+        self.dead_letters = 0
+        self.last_flush_latency = 0.0
+        self.max_flush_latency = 0.0
+
+    @property
+    def queue_depth(self) -> int:
+        return len(self._queue)
+
+    @property
+    def max_delay(self) -> float:
+        """Longest time queued message may stay unsaved"""
+        return (self.flush_interval + db_executor.timeout) * \
+            (self.retries + 1)
+
+    def ensure_running(self):
+        """Start periodic flushes in current event loop, if not started yet"""
+        if self._task is None or self._task.done():
+            self._task = asyncio.ensure_future(self.run())
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            await self.flush()
+
+    async def reserve_id(self) -> int:
+        if not self._ids:
+            self._ids.extend(await db(chat_message_reserve_ids)(
+                count=self.batch_size
+            ))
+        return self._ids.popleft()
+
+    async def create(self, *, text: str, author: tp.Optional[User],
+                     room: Room, service_msg: bool = False) -> ChatMessage:
+        """Build message with id and timestamp, queue it for saving"""
+        self.ensure_running()
+        msg = ChatMessage(id=await self.reserve_id(), sent=timezone.now(),
+                          text=text, author=author, room=room,
+                          service_msg=service_msg)
+        if len(self._queue) >= self.queue_max:
+            # database does not keep up, sender waits for its message
+            await db(chat_message_bulk_create)(messages=[msg])
+            return msg
+        self._queue.append(msg)
+
+        if len(self._queue) >= self.batch_size and self._flushing is None:
+            self._flushing = asyncio.ensure_future(self.flush())
+        return msg
+
+    async def flush(self):
+        """Save queued messages in a single batch"""
+        batch, self._queue = self._queue, []
+        self._inflight.append(batch)
+        try:
+            if batch:
+                await self._save(batch)
+        finally:
+            # periodic flush or drain must not drop handle of size-triggered
+            if self._flushing is asyncio.current_task():
+                self._flushing = None
+        # batch of cancelled flush is left for `flush_sync`
+        self._inflight.remove(batch)
+
+    async def _save(self, batch: tp.List[ChatMessage]):
+        start = time.perf_counter()
+        try:
+            # failed attempt may have timed out after it was committed
+            await db(chat_message_bulk_create)(
+                messages=batch, ignore_conflicts=self._attempts > 0
+            )
+        except Exception:
+            self.flush_errors += 1
+            self._attempts += 1
+            if self._attempts <= self.retries:
+                log.exception(f'Failed to save {len(batch)} messages, '
+                              f'will retry on next flush')
+                self._queue[:0] = batch
+                return
+            log.exception(f'Failed to save {len(batch)} messages '
+                          f'{self._attempts} times, saving one by one')
+            self._attempts = 0
+            await self._save_each(batch)
+            return
+
+        self._attempts = 0
+        latency = time.perf_counter() - start
+        self.flushes += 1
+        self.flushed += len(batch)
+        self.last_flush_latency = latency
+        self.max_flush_latency = max(self.max_flush_latency, latency)
+
+    async def _save_each(self, batch: tp.List[ChatMessage]):
+        """Save messages separately, so one bad row does not block others"""
+        for msg in batch:
+            try:
+                await db(chat_message_bulk_create)(messages=[msg],
+                                                   ignore_conflicts=True)
+                self.flushed += 1
+            except Exception as e:
+                self.dead_letters += 1
+                dead_letter_log.error(json.dumps({
+                    'id': msg.id,
+                    'room': msg.room.name,
+                    'author': msg.author and msg.author.username,
+                    'text': msg.text,
+                    'sent': msg.sent.isoformat(),
+                    'service_msg': msg.service_msg,
+                    'error': repr(e)
+                }, ensure_ascii=False))
+
+    async def drain(self):
+        """Save queued messages and wait for batches being saved"""
+        # failed batches are queued again, until retries are exhausted
+        while self._queue or self._inflight:
+            if self._queue:
+                await self.flush()
+            else:
+                await asyncio.sleep(.05)
+
+    def flush_sync(self):
+        """
+        Save whatever is queued or was being saved, when event loop is
+        already stopped. Messages of interrupted batch may be saved already.
+        """
+        batch = [msg for inflight in self._inflight for msg in inflight]
+        batch += self._queue
+        self._inflight, self._queue = [], []
+        if batch:
+            chat_message_bulk_create(messages=batch, ignore_conflicts=True)
+            log.info(f'Saved {len(batch)} queued messages on shutdown')
+
+    def stats(self) -> dict:
+        return {'queue_depth': self.queue_depth,
+                'flushes': self.flushes,
+                'flushed': self.flushed,
+                'flush_errors': self.flush_errors,
+                'dead_letters': self.dead_letters,
+                'last_flush_latency': self.last_flush_latency,
+                'max_flush_latency': self.max_flush_latency}
+
+
+def _enabled() -> bool:
+    if not getattr(settings, 'CHAT_WRITE_BEHIND', False):
+        return False
+    if connections['default'].vendor != 'postgresql':
+        # ids of queued messages are reserved from PostgreSQL sequence
+        log.warning('Write-behind persistence requires PostgreSQL, '
+                    'falling back to saving each message')
+        return False
+    return True
+
+
+message_writer = None
+if _enabled():
+    message_writer = MessageWriter(
+        batch_size=getattr(settings, 'CHAT_WRITE_BEHIND_BATCH_SIZE', 100),
+        flush_interval=getattr(settings, 'CHAT_WRITE_BEHIND_INTERVAL', 0.5),
+        retries=getattr(settings, 'CHAT_WRITE_BEHIND_RETRIES', 3),
+        queue_max=getattr(settings, 'CHAT_WRITE_BEHIND_QUEUE_MAX', 10000)
+    )
+    atexit.register(message_writer.flush_sync)
+    # room snapshots, loaded from database, may miss messages for that long
+    history_cache.settle = message_writer.max_delay
+    registry.register_stats('chat_message_writer', message_writer.stats)
+
+
+async def chat_message_persist(*, text: str, author: tp.Optional[User],
+                               room: Room,
+                               service_msg: bool = False) -> ChatMessage:
+    """Save message now, or queue it in write-behind mode"""
+    attrs = {'text': text, 'author': author, 'room': room,
+             'service_msg': service_msg}
+    if message_writer is not None:
+        return await message_writer.create(**attrs)
+    return await db(chat_message_create)(**attrs)
@@ -0,0 +1,297 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Runtime metrics
+#
+# Minimal counters, gauges and histograms, rendered in Prometheus text
+# format by `metrics` view. Values are kept per worker process. With
+# `CHAT_METRICS` setting disabled all updates return immediately.
+#
+# Workers of `runchat` export their metrics to files of a shared directory,
+# the worker, serving `metrics` view, renders all of them, labelled by
+# `worker` index and `pid`, as each worker would be scraped alone.
+#
+# Values are updated on the event loop, while sync `metrics` view renders
+# them in a worker thread, so updates hold metric lock and rendering works
+# on copies.
+
+import asyncio
+import bisect
+import contextlib
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import typing as tp
+
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+enabled = getattr(settings, 'CHAT_METRICS', True)
+
+DEFAULT_BUCKETS = (.0005, .001, .0025, .005, .01, .025, .05, .1, .25, .5,
+                   1, 2.5, 5)
+
+LabelValues = tp.Tuple[str, ...]
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', r'\\').replace('"', r'\"') \
+                     .replace('\n', r'\n')
+
+
+def _labels_text(pairs: tp.Sequence[tp.Tuple[str, tp.Any]]) -> str:
+    if not pairs:
+        return ''
+    return '{' + ','.join(f'{name}="{_escape(value)}"'
+                          for name, value in pairs) + '}'
+
+
+def export_path(directory: str, pid: int) -> str:
+    """File of worker metrics in shared directory"""
+    return os.path.join(directory, f'{pid}.json')
+
+
+class Metric:
+    type_name = ''
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tp.Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: tp.Dict[LabelValues, tp.Any] = {}
+        self._lock = threading.Lock()
+        registry.register(self)
+
+    def _key(self, labels: dict) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def _labels_text(self, key: LabelValues, **extra) -> str:
+        return _labels_text([*zip(self.labelnames, key), *extra.items()])
+
+    def _items(self) -> tp.List[tp.Tuple[LabelValues, tp.Any]]:
+        with self._lock:
+            return sorted(self._values.items())
+
+    def samples(self, **extra) -> tp.Iterator[str]:
+        for key, value in self._items():
+            yield f'{self.name}{self._labels_text(key, **extra)} {value}'
+
+
+class Counter(Metric):
+    type_name = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Counter):
+    type_name = 'gauge'
+
+    def dec(self, amount: float = 1, **labels):
+        self.inc(-amount, **labels)
+
+    def set(self, value: float, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    type_name = 'histogram'
+
+    def __init__(self, name: str, documentation: str,
+                 labelnames: tp.Sequence[str] = (),
+                 buckets: tp.Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value: float, **labels):
+        if not enabled:
+            return
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # per-bucket counts, sum, count
+                state = self._values[key] = [[0] * len(self.buckets), 0.0, 0]
+            if index < len(self.buckets):
+                state[0][index] += 1
+            state[1] += value
+            state[2] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """Observe duration of the block, may contain awaits"""
+        if not enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _items(self) -> tp.List[tp.Tuple[LabelValues, tp.Any]]:
+        with self._lock:
+            return sorted((key, (list(counts), total, count))
+                          for key, (counts, total, count)
+                          in self._values.items())
+
+    def samples(self, **extra) -> tp.Iterator[str]:
+        for key, (counts, total, count) in self._items():
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets, counts):
+                cumulative += bucket_count
+                labels = self._labels_text(key, **extra, le=bound)
+                yield f'{self.name}_bucket{labels} {cumulative}'
+            labels = self._labels_text(key, **extra, le='+Inf')
+            yield f'{self.name}_bucket{labels} {count}'
+            labels = self._labels_text(key, **extra)
+            yield f'{self.name}_sum{labels} {total}'
+            yield f'{self.name}_count{labels} {count}'
+
+
+# metric families: name -> [type, documentation, samples]
+Families = tp.Dict[str, list]
+
+
+class Registry:
+    """Metrics of the process and callbacks of components with own stats"""
+
+    def __init__(self):
+        self._metrics: tp.List[Metric] = []
+        self._stats: tp.Dict[str, tp.Callable[[], dict]] = {}
+        # shared directory and labels of the worker, see `export_to`
+        self.directory: tp.Optional[str] = None
+        self.labels: tp.Dict[str, str] = {}
+
+    def register(self, metric: Metric):
+        self._metrics.append(metric)
+
+    def register_stats(self, prefix: str, stats: tp.Callable[[], dict]):
+        """Expose numeric values of `stats()` as `<prefix>_<key>` gauges"""
+        self._stats[prefix] = stats
+
+    def families(self) -> Families:
+        """Samples of the process, labelled by worker labels"""
+        families = {}
+        for metric in self._metrics:
+            families[metric.name] = [metric.type_name, metric.documentation,
+                                     list(metric.samples(**self.labels))]
+        for prefix, stats in sorted(list(self._stats.items())):
+            for key, value in sorted(stats().items()):
+                name = f'{prefix}_{key}'
+                labels = _labels_text(list(self.labels.items()))
+                families[name] = ['gauge', None, [f'{name}{labels} {value}']]
+        return families
+
+    def export_to(self, directory: str, **labels):
+        """Share metrics of the worker through files of `directory`"""
+        self.directory = directory
+        self.labels = {name: str(value) for name, value in labels.items()}
+
+    def export(self):
+        """Write metrics of the worker to its file of shared directory"""
+        if self.directory is None:
+            return
+        path = export_path(self.directory, os.getpid())
+        with open(f'{path}.tmp', 'w') as f:
+            json.dump(self.families(), f)
+        # readers never see a partial file
+        os.replace(f'{path}.tmp', path)
+
+    def collect(self) -> Families:
+        """Current metrics of the process, exported ones of other workers"""
+        families = self.families()
+        if self.directory is None:
+            return families
+        own = export_path(self.directory, os.getpid())
+        for path in sorted(glob.glob(os.path.join(self.directory, '*.json'))):
+            if path == own:
+                continue
+            try:
+                with open(path) as f:
+                    exported = json.load(f)
+            except (OSError, ValueError):
+                # worker exited meanwhile
+                continue
+            for name, (type_name, documentation, samples) in exported.items():
+                family = families.setdefault(name,
+                                             [type_name, documentation, []])
+                family[2].extend(samples)
+        return families
+
+    def render(self) -> str:
+        lines = []
+        for name, (type_name, documentation, samples) in \
+                self.collect().items():
+            if documentation is not None:
+                lines.append(f'# HELP {name} {documentation}')
+            lines.append(f'# TYPE {name} {type_name}')
+            lines.extend(samples)
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
+
+active_sockets = Gauge('chat_active_sockets', 'Open WebSocket connections')
+frames = Counter('chat_frames_total', 'WebSocket frames',
+                 ['direction'])
+frame_bytes = Counter('chat_frame_bytes_total',
+                      'Payload of WebSocket frames, characters of text '
+                      'frames and bytes of binary ones', ['direction'])
+manager_hook_seconds = Histogram('chat_manager_hook_seconds',
+                                 'Duration of manager hooks',
+                                 ['manager', 'hook'])
+event_handler_seconds = Histogram('chat_event_handler_seconds',
+                                  'Duration of received event handlers',
+                                  ['event'])
+rejected_events = Counter('chat_rejected_events_total',
+                          'Received events, not handled', ['reason'])
+db_seconds = Histogram('chat_db_seconds',
+                       'Duration of database calls, including thread hop',
+                       ['call'])
+group_send_seconds = Histogram('chat_group_send_seconds',
+                               'Duration of channel layer group sends',
+                               ['event'])
+
+
+async def group_send(channel_layer, group: str, event: dict):
+    """Channel layer `group_send`, timed by event type"""
+    with group_send_seconds.time(event=event['type']):
+        await channel_layer.group_send(group, event)
+
+
+async def group_send_many(channel_layer, groups: tp.Iterable[str],
+                          event: dict):
+    """
+    Send the same event to several groups concurrently, timed as one send.
+
+    Channel layers have no multi-group send, so each group still costs its
+    own layer round trip, only they overlap. Failed sends are logged per
+    group and do not stop the others.
+    """
+    groups = list(groups)
+    with group_send_seconds.time(event=event['type']):
+        results = await asyncio.gather(
+            *[channel_layer.group_send(group, event) for group in groups],
+            return_exceptions=True
+        )
+    for group, result in zip(groups, results):
+        if isinstance(result, Exception):
+            log.error(f'Failed to send {event["type"]} to group {group}: '
+                      f'{result!r}')
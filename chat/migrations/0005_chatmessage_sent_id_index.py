@@ -0,0 +1,17 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:31
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0004_auto_20200709_1002'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['sent', 'id'], name='chat_msg_sent_id_idx'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:42
+
+from django.db import migrations, models
+import django.utils.timezone
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_connectionlease'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='sent',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+    ]
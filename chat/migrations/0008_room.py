@@ -0,0 +1,46 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+DEFAULT_ROOM_NAME = 'chat'
+
+
+def move_to_default_room(apps, schema_editor):
+    Room = apps.get_model('chat', 'Room')
+    ChatMessage = apps.get_model('chat', 'ChatMessage')
+    ConnectionLease = apps.get_model('chat', 'ConnectionLease')
+
+    room, _ = Room.objects.get_or_create(name=DEFAULT_ROOM_NAME)
+    ChatMessage.objects.update(room=room)
+    # leases are renewed every few seconds, connections will reacquire them
+    ConnectionLease.objects.all().delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0007_chatmessage_sent_default'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Room',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.SlugField(max_length=64, unique=True)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='chatmessage',
+            name='room',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='chat.Room'),
+        ),
+        migrations.AddField(
+            model_name='connectionlease',
+            name='room',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.CASCADE, to='chat.Room'),
+        ),
+        migrations.RunPython(move_to_default_room, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,32 @@
+# Generated by Django 3.0.8 on 2026-10-18 18:52
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0008_room'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.Room'),
+        ),
+        migrations.AlterField(
+            model_name='connectionlease',
+            name='room',
+            field=models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='chat.Room'),
+        ),
+        migrations.RemoveIndex(
+            model_name='chatmessage',
+            name='chat_msg_sent_id_idx',
+        ),
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(fields=['room', 'sent', 'id'], name='chat_msg_room_sent_id_idx'),
+        ),
+    ]
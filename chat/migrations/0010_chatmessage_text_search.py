@@ -0,0 +1,39 @@
+# Generated by Django 3.0.8 on 2026-10-18 19:40
+
+from django.db import migrations
+
+
+# expression must match `SearchVector('text', config='simple')` SQL,
+# otherwise planner does not use the index
+INDEX_NAME = 'chat_msg_text_search_idx'
+CREATE_INDEX = (
+    f'CREATE INDEX CONCURRENTLY IF NOT EXISTS {INDEX_NAME} '
+    f'ON chat_chatmessage USING gin '
+    f"(to_tsvector('simple'::regconfig, COALESCE(text, '')))"
+)
+DROP_INDEX = f'DROP INDEX CONCURRENTLY IF EXISTS {INDEX_NAME}'
+
+
+def create_index(apps, schema_editor):
+    # other databases are searched by in-memory index, see `chat.search`
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(CREATE_INDEX)
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        schema_editor.execute(DROP_INDEX)
+
+
+class Migration(migrations.Migration):
+
+    # index is built without locking writes to messages
+    atomic = False
+
+    dependencies = [
+        ('chat', '0009_room_required'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,191 @@
+# Generated by Django 3.0.8 on 2026-10-18 21:05
+
+import datetime
+import re
+import typing as tp
+
+from django.db import migrations, transaction
+
+
+# Messages table is rebuilt as partitioned by month of `sent`, see
+# `chat.partitions`. Other databases keep a single table.
+#
+# Rebuild is staged, so writes to messages are blocked only for a short
+# swap at the end:
+#  1. new table is created with partitions, indexes and foreign keys, while
+#     it is empty and unused, so indexes, e.g. text search one of 0010, are
+#     built without locking the live table;
+#  2. rows are copied in batches of COPY_BATCH, each batch committed on its
+#     own, messages are sent and read meanwhile;
+#  3. live table is locked against writes, rows saved during the copy are
+#     copied, tables are swapped and old one dropped, in one transaction.
+# Messages must not be archived or deleted, e.g. by `chatpartitions
+# archive`, while migration runs, rows, already copied, are not removed
+# from the new table.
+TABLE = 'chat_chatmessage'
+NEW_TABLE = f'{TABLE}_new'
+# partitions up to so many months after the current one are created
+MONTHS_AHEAD = 2
+COPY_BATCH = 10000
+# rows saved during the copy may carry `sent` up to so much older than the
+# copy start, e.g. queued by write-behind persistence with reserved ids
+LATE_WRITES = datetime.timedelta(hours=1)
+
+INDEX_NAME = re.compile(r'^(CREATE (?:UNIQUE )?INDEX )(\S+)')
+INDEX_TABLE = re.compile(r' ON (?:ONLY )?\S+ USING ')
+
+
+def _month_add(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def _month_start(value: datetime.datetime) -> datetime.datetime:
+    return value.astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def _staged_name(name: str) -> str:
+    """Name of index of new table, until it takes the name of the table"""
+    # identifiers are limited to 63 characters
+    return f'{name[:59]}_new'
+
+
+def _create(cursor, partitioned: bool) -> tp.List[str]:
+    """
+    Create empty new table, partitioned or not, with indexes and foreign
+    keys of the live one. Returns names of indexes to rename after swap.
+    """
+    if partitioned:
+        cursor.execute(f'CREATE TABLE {NEW_TABLE} '
+                       f'(LIKE {TABLE} INCLUDING DEFAULTS) '
+                       f'PARTITION BY RANGE (sent)')
+        # unique constraints of partitioned table include partition key
+        cursor.execute(f'ALTER TABLE {NEW_TABLE} ADD PRIMARY KEY (id, sent)')
+
+        cursor.execute(f'SELECT min(sent) FROM {TABLE}')
+        oldest, = cursor.fetchone()
+        now = _month_start(datetime.datetime.now(datetime.timezone.utc))
+        month = _month_start(oldest) if oldest is not None else now
+        while month <= _month_add(now, MONTHS_AHEAD):
+            cursor.execute(
+                f'CREATE TABLE {TABLE}_y{month.year}m{month.month:02d} '
+                f'PARTITION OF {NEW_TABLE} FOR VALUES FROM (%s) TO (%s)',
+                [month, _month_add(month, 1)]
+            )
+            month = _month_add(month, 1)
+        cursor.execute(f'CREATE TABLE {TABLE}_default '
+                       f'PARTITION OF {NEW_TABLE} DEFAULT')
+    else:
+        cursor.execute(f'CREATE TABLE {NEW_TABLE} '
+                       f'(LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(f'ALTER TABLE {NEW_TABLE} ADD PRIMARY KEY (id)')
+
+    cursor.execute("SELECT indexname, indexdef FROM pg_indexes "
+                   "WHERE tablename = %s AND indexname <> %s",
+                   [TABLE, f'{TABLE}_pkey'])
+    indexes = cursor.fetchall()
+    for name, definition in indexes:
+        definition = INDEX_NAME.sub(
+            lambda match: match.group(1) + _staged_name(name), definition
+        )
+        definition = INDEX_TABLE.sub(f' ON {NEW_TABLE} USING ', definition,
+                                     count=1)
+        cursor.execute(definition)
+
+    # checked row by row while copying, instead of validating the whole
+    # table at once
+    cursor.execute("SELECT conname, pg_get_constraintdef(oid) "
+                   "FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'",
+                   [TABLE])
+    for name, definition in cursor.fetchall():
+        cursor.execute(f'ALTER TABLE {NEW_TABLE} ADD CONSTRAINT '
+                       f'{_staged_name(name)} {definition}')
+    return [name for name, _ in indexes]
+
+
+def _copy(cursor) -> tp.Optional[int]:
+    """Copy rows in batches of ascending id, returns the last copied id"""
+    last = None
+    while True:
+        cursor.execute(f'SELECT max(id) FROM '
+                       f'(SELECT id FROM {TABLE} WHERE id > %s '
+                       f'ORDER BY id LIMIT %s) batch',
+                       [-1 if last is None else last, COPY_BATCH])
+        upto, = cursor.fetchone()
+        if upto is None:
+            return last
+        cursor.execute(f'INSERT INTO {NEW_TABLE} SELECT * FROM {TABLE} '
+                       f'WHERE id > %s AND id <= %s',
+                       [-1 if last is None else last, upto])
+        last = upto
+
+
+def _swap(cursor, indexes: tp.List[str], last: tp.Optional[int],
+          started: datetime.datetime):
+    """Copy rows, saved meanwhile, replace live table with the new one"""
+    # reads go on, writes wait until the end of transaction
+    cursor.execute(f'LOCK TABLE {TABLE} IN EXCLUSIVE MODE')
+    cursor.execute(
+        f'INSERT INTO {NEW_TABLE} SELECT * FROM {TABLE} t '
+        f'WHERE (t.id > %s OR t.sent >= %s) AND NOT EXISTS '
+        f'(SELECT 1 FROM {NEW_TABLE} n WHERE n.id = t.id)',
+        [-1 if last is None else last, started - LATE_WRITES]
+    )
+
+    cursor.execute("SELECT conname FROM pg_constraint "
+                   "WHERE conrelid = %s::regclass AND contype = 'f'",
+                   [TABLE])
+    foreign_keys = [row[0] for row in cursor.fetchall()]
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [TABLE])
+    sequence, = cursor.fetchone()
+    # otherwise the sequence is dropped with the old table
+    cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY NONE')
+
+    cursor.execute(f'DROP TABLE {TABLE}')
+    cursor.execute(f'ALTER TABLE {NEW_TABLE} RENAME TO {TABLE}')
+    cursor.execute(f'ALTER TABLE {TABLE} '
+                   f'RENAME CONSTRAINT {NEW_TABLE}_pkey TO {TABLE}_pkey')
+    cursor.execute(f'ALTER SEQUENCE {sequence} OWNED BY {TABLE}.id')
+    for name in indexes:
+        cursor.execute(f'ALTER INDEX {_staged_name(name)} RENAME TO {name}')
+    for name in foreign_keys:
+        cursor.execute(f'ALTER TABLE {TABLE} RENAME CONSTRAINT '
+                       f'{_staged_name(name)} TO {name}')
+
+
+def _rebuild(connection, partitioned: bool):
+    """Replace table with a new one, partitioned or not, see above"""
+    started = datetime.datetime.now(datetime.timezone.utc)
+    with connection.cursor() as cursor:
+        with transaction.atomic(using=connection.alias):
+            indexes = _create(cursor, partitioned)
+        last = _copy(cursor)
+        with transaction.atomic(using=connection.alias):
+            _swap(cursor, indexes, last, started)
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _rebuild(schema_editor.connection, partitioned=True)
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor == 'postgresql':
+        _rebuild(schema_editor.connection, partitioned=False)
+
+
+class Migration(migrations.Migration):
+
+    # rows are copied in batches, each committed on its own
+    atomic = False
+
+    dependencies = [
+        ('chat', '0010_chatmessage_text_search'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
@@ -1,15 +1,37 @@
 from django.db import models
+from django.utils import timezone
 from django.contrib.auth.models import User
 
-from chat.utils import datetime_to_dict
+from chat.utils import datetime_to_epoch_ms
+
+
+class Room(models.Model):
+
+    name = models.SlugField(max_length=64, unique=True)
+
+    def __str__(self):
+        return f"Room({self.name})"
+
+    def __repr__(self):
+        return str(self)
 
 
 class ChatMessage(models.Model):
 
     text = models.CharField(max_length=8192)
-    sent = models.DateTimeField(auto_now=True)
+    sent = models.DateTimeField(default=timezone.now)
     author = models.ForeignKey(User, on_delete=models.CASCADE, null=True)
     service_msg = models.BooleanField(default=False)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+
+    # fields required by `values_as_dict`, to be used in `.values()`
+    DICT_FIELDS = ('id', 'text', 'sent', 'author__username', 'service_msg')
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['room', 'sent', 'id'],
+                         name='chat_msg_room_sent_id_idx')
+        ]
 
     def as_dict(self):
         author = self.author
@@ -18,12 +40,20 @@ class ChatMessage(models.Model):
         else:
             user_name = self.author.username
 
-        dict_date = datetime_to_dict(self.sent)
+        sent = datetime_to_epoch_ms(self.sent)
         return {'message':     self.text,
-                'sent':        dict_date,
+                'sent':        sent,
                 'author':      user_name,
                 'service_msg': self.service_msg}
 
+    @staticmethod
+    def values_as_dict(values):
+        """Same as `as_dict`, but built from `.values(*DICT_FIELDS)` row"""
+        return {'message':     values['text'],
+                'sent':        datetime_to_epoch_ms(values['sent']),
+                'author':      values['author__username'],
+                'service_msg': values['service_msg']}
+
     def __str__(self):
         if len(self.text) > 16:
             text = self.text[:16] + '...'
@@ -37,11 +67,21 @@ class ChatMessage(models.Model):
         return str(self)
 
 
-class ActiveUser(models.Model):
+class ConnectionLease(models.Model):
+    """
+    Presence of a single websocket connection.
+
+    Connection keeps lease alive by heartbeats, user is online in a room as
+    long as at least one of their leases in it is not expired.
+    """
 
     user = models.ForeignKey(User, on_delete=models.CASCADE)
-    active_connections = models.IntegerField(default=0)
+    room = models.ForeignKey(Room, on_delete=models.CASCADE)
+    channel_name = models.CharField(max_length=256, unique=True)
+    expires = models.DateTimeField(db_index=True)
 
-    def as_dict(self):
-        username = self.user.username
-        return {'user': username, 'connections': self.active_connections}
+    def __str__(self):
+        return f"ConnectionLease({self.user.username}, {self.expires})"
+
+    def __repr__(self):
+        return str(self)
@@ -0,0 +1,125 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Outbound frames of a connection
+#
+# Consumer handlers queue frames instead of awaiting transport send, frames
+# are written by a task of the connection. Queue is bounded, when a slow
+# client lets it fill up, `CHAT_OUTBOUND_POLICY` decides what is sacrificed:
+# oldest frames, superseded presence frames first, or the connection itself.
+
+import asyncio
+import collections
+import itertools
+import typing as tp
+
+from django.conf import settings
+
+from chat.metrics import Counter, Gauge, Histogram
+
+
+POLICY_DROP_OLDEST = 'drop_oldest'
+POLICY_COALESCE_PRESENCE = 'coalesce_presence'
+POLICY_DISCONNECT = 'disconnect'
+POLICIES = (POLICY_DROP_OLDEST, POLICY_COALESCE_PRESENCE, POLICY_DISCONNECT)
+
+QUEUE_SIZE = getattr(settings, 'CHAT_OUTBOUND_QUEUE_SIZE', 1000)
+POLICY = getattr(settings, 'CHAT_OUTBOUND_POLICY', POLICY_COALESCE_PRESENCE)
+
+queued_frames = Gauge('chat_outbound_queued_frames',
+                      'Frames queued for sending, over all connections')
+dropped_frames = Counter('chat_outbound_dropped_frames_total',
+                         'Queued frames discarded before sending',
+                         ['reason'])
+queue_depth = Histogram('chat_outbound_queue_depth',
+                        'Deepest outbound queue of a connection, observed '
+                        'when it is closed',
+                        buckets=(1, 2, 5, 10, 25, 50, 100, 250, 500, 1000))
+evictions = Counter('chat_outbound_evictions_total',
+                    'Connections closed for not keeping up with sends')
+
+# text_data, bytes_data
+Frame = tp.Tuple[tp.Optional[str], tp.Optional[bytes]]
+
+
+class OutboundOverflow(Exception): pass
+
+
+class OutboundQueue:
+    """Bounded queue of frames of a single connection"""
+
+    def __init__(self, send: tp.Callable[..., tp.Awaitable],
+                 maxsize: tp.Optional[int] = None,
+                 policy: tp.Optional[str] = None):
+        """`send(text_data, bytes_data)` writes frame to transport"""
+        self._send = send
+        self.maxsize = maxsize or QUEUE_SIZE
+        self.policy = policy or POLICY
+        if self.policy not in POLICIES:
+            raise ValueError(f'Unknown outbound policy {self.policy!r}')
+        # frames in sending order, keyed by coalesce key or sequence number
+        self._frames: tp.Dict[tp.Hashable, Frame] = collections.OrderedDict()
+        self._seq = itertools.count()
+        self._ready = asyncio.Event()
+        self._task = None
+        self.stopped = False
+        self.max_depth = 0
+
+    def __len__(self):
+        return len(self._frames)
+
+    def start(self):
+        self._task = asyncio.ensure_future(self.run())
+
+    def stop(self):
+        """Stop writing, discard frames not sent yet and further ones"""
+        if not self.stopped:
+            queue_depth.observe(self.max_depth)
+        self.stopped = True
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        queued_frames.dec(len(self._frames))
+        self._frames.clear()
+
+    def put(self, text_data: tp.Optional[str] = None,
+            bytes_data: tp.Optional[bytes] = None,
+            coalesce_key: tp.Optional[str] = None):
+        """
+        Queue frame for sending.
+
+        Queued frame with the same `coalesce_key` is superseded, if policy
+        coalesces them. Raises `OutboundOverflow` under disconnect policy,
+        when queue is full.
+        """
+        if self.stopped:
+            return
+        key = coalesce_key
+        if key is not None and self.policy == POLICY_COALESCE_PRESENCE:
+            if self._frames.pop(key, None) is not None:
+                queued_frames.dec()
+                dropped_frames.inc(reason='coalesced')
+        else:
+            key = next(self._seq)
+
+        if len(self._frames) >= self.maxsize:
+            if self.policy == POLICY_DISCONNECT:
+                raise OutboundOverflow(f'{len(self._frames)} frames queued')
+            self._frames.popitem(last=False)
+            queued_frames.dec()
+            dropped_frames.inc(reason='overflow')
+
+        self._frames[key] = (text_data, bytes_data)
+        queued_frames.inc()
+        self.max_depth = max(self.max_depth, len(self._frames))
+        self._ready.set()
+
+    async def run(self):
+        while True:
+            await self._ready.wait()
+            while self._frames:
+                _, (text_data, bytes_data) = self._frames.popitem(last=False)
+                queued_frames.dec()
+                await self._send(text_data, bytes_data)
+            self._ready.clear()
@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Time partitions of chat messages
+#
+# On PostgreSQL messages table is partitioned by month of `sent` (see
+# migration 0011): `<table>_y2026m10` holds October 2026, rows of months
+# without partition land in `<table>_default`. `chatpartitions ensure`
+# creates partitions of the coming months, run it at least monthly.
+# Queries, bounded by `sent`, are served by matching partitions only.
+#
+# Retention: months older than CHAT_RETENTION_MONTHS are archived to
+# gzipped JSONL files, one per month, then their partitions are dropped.
+# On other databases months are archived the same way, rows are deleted.
+
+import datetime
+import gzip
+import json
+import os
+import re
+import typing as tp
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models import Min
+
+from chat.models import ChatMessage
+
+
+TABLE = ChatMessage._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+PARTITION_PATTERN = re.compile(rf'^{TABLE}_y(\d{{4}})m(\d{{2}})$')
+
+PARTITIONS_AHEAD = getattr(settings, 'CHAT_PARTITIONS_AHEAD', 2)
+RETENTION_MONTHS = getattr(settings, 'CHAT_RETENTION_MONTHS', None)
+ARCHIVE_DIR = getattr(settings, 'CHAT_ARCHIVE_DIR',
+                      os.path.join(settings.BASE_DIR, 'archive'))
+
+# fields of archived messages, in order
+ARCHIVE_FIELDS = ('id', 'room__name', 'author__username', 'text', 'sent',
+                  'service_msg')
+
+
+def month_start(value: datetime.datetime) -> datetime.datetime:
+    """First moment of the month of value, UTC"""
+    return value.astimezone(datetime.timezone.utc).replace(
+        day=1, hour=0, minute=0, second=0, microsecond=0
+    )
+
+
+def month_add(month: datetime.datetime, months: int) -> datetime.datetime:
+    index = month.year * 12 + month.month - 1 + months
+    return month.replace(year=index // 12, month=index % 12 + 1)
+
+
+def partition_name(month: datetime.datetime) -> str:
+    return f'{TABLE}_y{month.year}m{month.month:02d}'
+
+
+def is_partitioned() -> bool:
+    if connection.vendor != 'postgresql':
+        return False
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT 1 FROM pg_partitioned_table "
+                       "WHERE partrelid = %s::regclass", [TABLE])
+        return cursor.fetchone() is not None
+
+
+def partition_months() -> tp.List[datetime.datetime]:
+    """Months with partitions, oldest first"""
+    if not is_partitioned():
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT inhrelid::regclass::text FROM pg_inherits "
+                       "WHERE inhparent = %s::regclass", [TABLE])
+        names = [row[0] for row in cursor.fetchall()]
+
+    months = []
+    for name in names:
+        match = PARTITION_PATTERN.match(name)
+        if match is not None:
+            year, month = map(int, match.groups())
+            months.append(datetime.datetime(year, month, 1,
+                                            tzinfo=datetime.timezone.utc))
+    return sorted(months)
+
+
+def partition_rows() -> tp.Dict[str, int]:
+    """Estimated rows of each partition, by name"""
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT c.relname, greatest(c.reltuples, 0)::bigint "
+                       "FROM pg_inherits i "
+                       "JOIN pg_class c ON c.oid = i.inhrelid "
+                       "WHERE i.inhparent = %s::regclass", [TABLE])
+        return dict(cursor.fetchall())
+
+
+def partition_create(month: datetime.datetime):
+    """
+    Create partition of the month, moving its rows out of default one.
+
+    Default partition is locked, until rows of the month are moved.
+    """
+    name = partition_name(month)
+    bounds = [month, month_add(month, 1)]
+    with transaction.atomic(), connection.cursor() as cursor:
+        # attaching locks it anyway, rows of the month may not slip in before
+        cursor.execute(f'LOCK TABLE {DEFAULT_PARTITION} '
+                       f'IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(f'CREATE TABLE {name} '
+                       f'(LIKE {TABLE} INCLUDING DEFAULTS)')
+        cursor.execute(f'WITH moved AS ('
+                       f'  DELETE FROM {DEFAULT_PARTITION} '
+                       f'  WHERE sent >= %s AND sent < %s RETURNING *'
+                       f') INSERT INTO {name} SELECT * FROM moved', bounds)
+        cursor.execute(f'ALTER TABLE {TABLE} ATTACH PARTITION {name} '
+                       f'FOR VALUES FROM (%s) TO (%s)', bounds)
+
+
+def partition_drop(month: datetime.datetime):
+    name = partition_name(month)
+    with transaction.atomic(), connection.cursor() as cursor:
+        cursor.execute(f'ALTER TABLE {TABLE} DETACH PARTITION {name}')
+        cursor.execute(f'DROP TABLE {name}')
+
+
+def partitions_ensure(*, ahead: tp.Optional[int] = None,
+                      now: tp.Optional[datetime.datetime] = None
+                      ) -> tp.List[datetime.datetime]:
+    """Create missing partitions up to `ahead` months after current one"""
+    if not is_partitioned():
+        return []
+    ahead = PARTITIONS_AHEAD if ahead is None else ahead
+    current = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    existing = set(partition_months())
+
+    created = []
+    for month in (month_add(current, i) for i in range(ahead + 1)):
+        if month not in existing:
+            partition_create(month)
+            created.append(month)
+    return created
+
+
+def _month_messages(month: datetime.datetime):
+    return ChatMessage.objects.filter(sent__gte=month,
+                                      sent__lt=month_add(month, 1))
+
+
+def archive_path(directory: str, month: datetime.datetime) -> str:
+    return os.path.join(directory, f'{TABLE}_{month:%Y-%m}.jsonl.gz')
+
+
+def month_archive(month: datetime.datetime, directory: str) -> int:
+    """
+    Write messages of the month to gzipped JSONL file in directory.
+
+    File appears complete or not at all, existing one is overwritten.
+    Returns number of messages written.
+    """
+    os.makedirs(directory, exist_ok=True)
+    path = archive_path(directory, month)
+    rows = _month_messages(month).order_by('sent', 'id') \
+        .values_list(*ARCHIVE_FIELDS).iterator(chunk_size=2000)
+
+    count = 0
+    with open(f'{path}.tmp', 'wb') as raw:
+        with gzip.open(raw, 'wt', encoding='utf-8') as f:
+            for row in rows:
+                message = dict(zip(ARCHIVE_FIELDS, row))
+                message['sent'] = message['sent'].isoformat()
+                f.write(json.dumps(message, ensure_ascii=False) + '\n')
+                count += 1
+        raw.flush()
+        os.fsync(raw.fileno())
+    os.replace(f'{path}.tmp', path)
+    return count
+
+
+def month_remove(month: datetime.datetime, partitioned: bool):
+    """Drop partition of the month, or delete its rows, if there is none"""
+    if partitioned and month in partition_months():
+        partition_drop(month)
+    else:
+        _month_messages(month).delete()
+
+
+def messages_archive(*, older_than: int, directory: str,
+                     dry_run: bool = False,
+                     now: tp.Optional[datetime.datetime] = None
+                     ) -> tp.List[tp.Tuple[datetime.datetime, int]]:
+    """
+    Archive and remove months before the last `older_than` ones, preceding
+    the current month. Returns archived months with number of messages.
+    """
+    current = month_start(now or datetime.datetime.now(datetime.timezone.utc))
+    cutoff = month_add(current, -older_than)
+    partitioned = is_partitioned()
+
+    months = set(m for m in partition_months() if m < cutoff)
+    # months with messages, found one by one, as they may be years apart
+    after = None
+    while True:
+        qs = ChatMessage.objects.filter(sent__lt=cutoff)
+        if after is not None:
+            qs = qs.filter(sent__gte=after)
+        oldest = qs.aggregate(oldest=Min('sent'))['oldest']
+        if oldest is None:
+            break
+        months.add(month_start(oldest))
+        after = month_add(month_start(oldest), 1)
+
+    archived = []
+    for month in sorted(months):
+        if dry_run:
+            archived.append((month, _month_messages(month).count()))
+            continue
+        count = month_archive(month, directory)
+        if not count:
+            os.remove(archive_path(directory, month))
+        month_remove(month, partitioned)
+        archived.append((month, count))
+    return archived
@@ -0,0 +1,253 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Online presence
+#
+# Each connection holds a lease, renewed by heartbeats. Leases of connections,
+# whose worker died without running `disconnect`, stop being renewed and are
+# expired by sweeper, which announces leave of users left without leases.
+# Joins and leaves are collected by worker and broadcast every
+# `CHAT_PRESENCE_DELTA_INTERVAL` as a single `online.delta` event per room,
+# leave and join of the same user in between, e.g. reconnect, cancel out.
+# User may leave on one worker and join on another one, which flushes first,
+# so changes are checked against leases on flush and only ones, agreeing with
+# current presence, are broadcast.
+
+import asyncio
+import datetime
+import logging
+import typing as tp
+
+from django.conf import settings
+from django.utils import timezone
+
+from chat.codec import encoded_event
+from chat.const import PRESENCE_LEASE_TTL, PRESENCE_SWEEP_INTERVAL
+from chat.db_selectors import connection_lease_online_usernames
+from chat.db_services import connection_lease_expire
+from chat.history_cache import history_cache
+from chat.message_writer import chat_message_persist
+from chat.db_executor import db
+from chat.metrics import group_send, registry
+from chat.models import Room
+from chat.utils import room_group_name
+
+
+log = logging.getLogger(__name__)
+
+# source of current time, replaced by tests
+clock = timezone.now
+
+# seconds, zero broadcasts `online.connect` and `online.disconnect` event per
+# change immediately, as clients before `online.delta` expect
+DELTA_INTERVAL = getattr(settings, 'CHAT_PRESENCE_DELTA_INTERVAL', 1)
+
+SERVICE_MESSAGES_STORED = 'stored'
+SERVICE_MESSAGES_TRANSIENT = 'transient'
+SERVICE_MESSAGES_NONE = 'none'
+SERVICE_MESSAGES = getattr(settings, 'CHAT_PRESENCE_SERVICE_MESSAGES',
+                           SERVICE_MESSAGES_TRANSIENT)
+
+# users named in transient service message, the rest is counted
+SERVICE_MESSAGE_NAMES_MAX = 5
+
+
+def lease_expiry() -> datetime.datetime:
+    return clock() + datetime.timedelta(seconds=PRESENCE_LEASE_TTL)
+
+
+def _users_text(usernames: tp.List[str]) -> str:
+    if len(usernames) == 1:
+        return f'User {usernames[0]}'
+    names = ', '.join(usernames[:SERVICE_MESSAGE_NAMES_MAX])
+    more = len(usernames) - SERVICE_MESSAGE_NAMES_MAX
+    if more > 0:
+        return f'Users {names} and {more} more'
+    return f'Users {names}'
+
+
+def presence_events(joined: tp.List[str], left: tp.List[str]
+                    ) -> tp.List[dict]:
+    """Presence events about given joins and leaves"""
+    if DELTA_INTERVAL:
+        return [encoded_event({'type': 'online.delta',
+                               'joined': joined, 'left': left})]
+    # only the latest presence of user matters to a client
+    return [encoded_event({'type': event_type, 'user': username},
+                          coalesce_key=f'online.{username}')
+            for event_type, usernames in (('online.connect', joined),
+                                          ('online.disconnect', left))
+            for username in usernames]
+
+
+async def _service_events(room: Room, joined: tp.List[str],
+                          left: tp.List[str]) -> tp.List[dict]:
+    if SERVICE_MESSAGES == SERVICE_MESSAGES_TRANSIENT:
+        return [encoded_event({'type': 'chat.servicemessage',
+                               'message': f'{_users_text(usernames)} {verb}'})
+                for verb, usernames in (('joined', joined), ('left', left))
+                if usernames]
+
+    if SERVICE_MESSAGES != SERVICE_MESSAGES_STORED:
+        return []
+
+    events = []
+    messages = [f'User {username} joined' for username in joined] + \
+               [f'User {username} left' for username in left]
+    for message in messages:
+        msg = await chat_message_persist(text=message, author=None,
+                                         room=room, service_msg=True)
+        entry = history_cache.write_through(room.name, msg)
+        events.append(encoded_event({'type': 'chat.servicemessage',
+                                     'message': message,
+                                     'cursor': entry['cursor']},
+                                    history=entry))
+    return events
+
+
+async def presence_broadcast(channel_layer, room: Room,
+                             joined: tp.List[str], left: tp.List[str]):
+    """Notify room about joins and leaves, with service messages"""
+    group = room_group_name(room.name)
+    for event in presence_events(joined, left):
+        await group_send(channel_layer, group, event)
+    for event in await _service_events(room, joined, left):
+        await group_send(channel_layer, group, event)
+
+
+class PresenceBatcher:
+    """Collects joins and leaves of rooms, broadcasts them periodically"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+        # room name -> room, username -> whether joined
+        self._rooms: tp.Dict[str, Room] = {}
+        self._changes: tp.Dict[str, tp.Dict[str, bool]] = {}
+
+        # metrics
+        self.flushes = 0
+        self.cancelled = 0
+        # changes, overtaken by other workers before flush
+        self.stale = 0
+
+    def ensure_running(self, channel_layer):
+        """Start flushes in current event loop, if not started yet"""
+        if self._task is None or self._task.done() or \
+                self._task.get_loop() is not asyncio.get_event_loop():
+            self._task = asyncio.ensure_future(self.run(channel_layer))
+
+    def add(self, room: Room, username: str, joined: bool):
+        self._rooms[room.name] = room
+        changes = self._changes.setdefault(room.name, {})
+        if changes.get(username) is (not joined):
+            # opposite change is not broadcast yet, nothing changed for room
+            del changes[username]
+            self.cancelled += 1
+        else:
+            changes[username] = joined
+
+    async def run(self, channel_layer):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.flush(channel_layer)
+            except Exception:
+                log.exception('Presence flush failed')
+
+    async def current(self, room: Room, room_changes: tp.Dict[str, bool]
+                      ) -> tp.Dict[str, bool]:
+        """Changes, which agree with leases of users"""
+        try:
+            online = await db(connection_lease_online_usernames)(
+                room=room, usernames=list(room_changes), now=clock()
+            )
+        except Exception as e:
+            log.warning(f'Presence of {room.name} not checked, '
+                        f'broadcast as is: {e}')
+            return room_changes
+        current = {username: joined
+                   for username, joined in room_changes.items()
+                   if joined is (username in online)}
+        self.stale += len(room_changes) - len(current)
+        return current
+
+    async def flush(self, channel_layer):
+        """Broadcast collected changes, one delta per room"""
+        rooms, self._rooms = self._rooms, {}
+        changes, self._changes = self._changes, {}
+        for name, room_changes in changes.items():
+            if not room_changes:
+                continue
+            room_changes = await self.current(rooms[name], room_changes)
+            if not room_changes:
+                continue
+            joined = sorted(u for u, j in room_changes.items() if j)
+            left = sorted(u for u, j in room_changes.items() if not j)
+            try:
+                await presence_broadcast(channel_layer, rooms[name], joined,
+                                         left)
+            except Exception:
+                # changes of the other rooms are swapped out already
+                log.exception(f'Presence of {name} not broadcast')
+                continue
+            self.flushes += 1
+
+    def stats(self) -> dict:
+        # called by metrics view from another thread, iterate a snapshot
+        return {'pending': sum(map(len, list(self._changes.values()))),
+                'flushes': self.flushes,
+                'cancelled': self.cancelled,
+                'stale': self.stale}
+
+
+presence_batcher = None
+if DELTA_INTERVAL:
+    presence_batcher = PresenceBatcher(DELTA_INTERVAL)
+    registry.register_stats('chat_presence', presence_batcher.stats)
+
+
+async def presence_announce(channel_layer, room: Room, username: str,
+                            joined: bool):
+    """Notify room about user join or leave, in next delta if batched"""
+    if presence_batcher is None:
+        await presence_broadcast(channel_layer, room,
+                                 [username] if joined else [],
+                                 [] if joined else [username])
+        return
+    presence_batcher.ensure_running(channel_layer)
+    presence_batcher.add(room, username, joined)
+
+
+class PresenceSweeper:
+    """Periodically expires stale leases of all users in a single query"""
+
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task = None
+
+    def ensure_running(self, channel_layer):
+        """Start sweeping in current event loop, if not started yet"""
+        if self._task is None or self._task.done() or \
+                self._task.get_loop() is not asyncio.get_event_loop():
+            self._task = asyncio.ensure_future(self.run(channel_layer))
+
+    async def run(self, channel_layer):
+        while True:
+            await asyncio.sleep(self.interval)
+            try:
+                await self.sweep(channel_layer)
+            except Exception:
+                log.exception('Presence sweep failed')
+
+    async def sweep(self, channel_layer):
+        """Expire stale leases, announce leave of users gone offline"""
+        gone = await db(connection_lease_expire)(now=clock())
+        for room, username in gone:
+            await presence_announce(channel_layer, room, username,
+                                    joined=False)
+        return gone
+
+
+presence_sweeper = PresenceSweeper(PRESENCE_SWEEP_INTERVAL)
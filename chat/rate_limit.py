@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Rate limits of received events
+#
+# Token buckets: each event takes a token, tokens are refilled at `rate` per
+# second up to `burst`. Buckets of a connection live in its worker. Buckets
+# of a user are shared by all workers through Redis of the channel layer,
+# or kept by each worker, if layer is not Redis or Redis fails.
+
+import logging
+import time
+import typing as tp
+
+from django.conf import settings
+
+
+log = logging.getLogger(__name__)
+
+# KEYS[1] bucket; ARGV rate, burst, now. Returns 1 if token was taken
+TOKEN_BUCKET_LUA = """
+local rate = tonumber(ARGV[1])
+local burst = tonumber(ARGV[2])
+local now = tonumber(ARGV[3])
+local bucket = redis.call('HMGET', KEYS[1], 'tokens', 'updated')
+local tokens = tonumber(bucket[1]) or burst
+local updated = tonumber(bucket[2]) or now
+tokens = math.min(burst, tokens + math.max(0, now - updated) * rate)
+local allowed = 0
+if tokens >= 1 then
+    tokens = tokens - 1
+    allowed = 1
+end
+redis.call('HMSET', KEYS[1], 'tokens', tostring(tokens), 'updated', ARGV[3])
+redis.call('EXPIRE', KEYS[1], math.ceil(burst / rate) + 1)
+return allowed
+"""
+
+
+class RateLimiter:
+    """Token buckets with the same rate and burst, zero rate disables them"""
+
+    # local buckets are pruned of full ones, when there are more of them
+    LOCAL_BUCKETS_MAX = 10000
+
+    def __init__(self, name: str, rate: float, burst: int):
+        self.name = name
+        self.rate = rate
+        self.burst = burst
+        # key -> tokens, updated
+        self._buckets: tp.Dict[str, tp.Tuple[float, float]] = {}
+
+    def _refilled(self, key: str, now: float) -> float:
+        tokens, updated = self._buckets.get(key, (self.burst, now))
+        return min(self.burst, tokens + max(0., now - updated) * self.rate)
+
+    def allow_local(self, key: str) -> bool:
+        """Take a token from bucket of this worker"""
+        if not self.rate:
+            return True
+        now = time.monotonic()
+        if len(self._buckets) > self.LOCAL_BUCKETS_MAX:
+            self._prune(now)
+        tokens = self._refilled(key, now)
+        allowed = tokens >= 1
+        if allowed:
+            tokens -= 1
+        self._buckets[key] = (tokens, now)
+        return allowed
+
+    def refund(self, key: str):
+        """Give back a token, taken from bucket of this worker"""
+        bucket = self._buckets.get(key)
+        if bucket is not None:
+            tokens, updated = bucket
+            self._buckets[key] = (min(self.burst, tokens + 1), updated)
+
+    def _prune(self, now: float):
+        self._buckets = {key: bucket for key, bucket in self._buckets.items()
+                         if self._refilled(key, now) < self.burst}
+
+    def forget(self, key: str):
+        self._buckets.pop(key, None)
+
+    async def allow(self, key: str, channel_layer=None) -> bool:
+        """
+        Take a token from bucket, shared through Redis of `channel_layer`,
+        if it is Redis layer, or from bucket of this worker.
+        """
+        if not self.rate or not hasattr(channel_layer, 'consistent_hash'):
+            return self.allow_local(key)
+
+        redis_key = f'{channel_layer.prefix}:ratelimit:{self.name}:{key}'
+        index = channel_layer.consistent_hash(redis_key)
+        try:
+            async with channel_layer.connection(index) as connection:
+                allowed = await connection.eval(
+                    TOKEN_BUCKET_LUA, keys=[redis_key],
+                    args=[self.rate, self.burst, time.time()]
+                )
+        except Exception as e:
+            log.warning(f'Shared rate limit failed, using local one: {e!r}')
+            return self.allow_local(key)
+        return bool(allowed)
+
+
+connection_rate_limit = RateLimiter(
+    'connection',
+    rate=getattr(settings, 'CHAT_RATE_LIMIT_CONNECTION_RATE', 5),
+    burst=getattr(settings, 'CHAT_RATE_LIMIT_CONNECTION_BURST', 20)
+)
+user_rate_limit = RateLimiter(
+    'user',
+    rate=getattr(settings, 'CHAT_RATE_LIMIT_USER_RATE', 10),
+    burst=getattr(settings, 'CHAT_RATE_LIMIT_USER_BURST', 40)
+)
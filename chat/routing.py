@@ -2,11 +2,13 @@
 # -*-encoding: utf-8-*-
 # Author: Danil Kovalenko
 
-from django.urls import path
+from django.urls import path, re_path
 
+from chat.const import ROOM_NAME_PATTERN
 from chat.consumers import ChatConsumer
 
 
 websocket_urlpatterns = [
-    path('ws/chat', ChatConsumer)
+    path('ws/chat', ChatConsumer),
+    re_path(rf'^ws/chat/(?P<room>{ROOM_NAME_PATTERN})$', ChatConsumer),
 ]
\ No newline at end of file
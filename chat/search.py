@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Full text search of chat messages
+#
+# PostgreSQL is searched by `chat_message_search` selector, backed by GIN
+# index. Other databases, e.g. SQLite of test runs, are searched by
+# in-memory inverted index of each worker, which loads messages, created
+# since the previous search of the room, before searching. Index keeps
+# SEARCH_MEMORY_MAX newest messages of a room and drops ones, older than the
+# oldest message in database, e.g. archived by `chatpartitions archive`.
+
+import collections
+import datetime
+import heapq
+import re
+import threading
+import time
+import typing as tp
+
+from django.db import connections
+
+from chat.const import SEARCH_RANKED_MAX, SEARCH_MEMORY_MAX
+from chat.db_selectors import chat_message_search, \
+    chat_message_since_entries, chat_message_page_entries, \
+    chat_message_oldest_cursor, HistoryCursor, HistoryEntry
+from chat.models import Room
+
+
+TOKEN_PATTERN = re.compile(r'\w+')
+
+
+def tokenize(text: str) -> tp.List[str]:
+    return TOKEN_PATTERN.findall(text.lower())
+
+
+class InvertedIndex:
+    """Words of messages of a single room"""
+
+    def __init__(self):
+        # word -> cursor of message -> occurrences of the word in it
+        self.postings: tp.Dict[str, tp.Dict[HistoryCursor, int]] = \
+            collections.defaultdict(dict)
+        self.messages: tp.Dict[HistoryCursor, dict] = {}
+        # cursor of the newest indexed message
+        self.last: tp.Optional[HistoryCursor] = None
+        # monotonic time of the last check for removed old messages
+        self.checked = 0.0
+
+    def add(self, cursor: HistoryCursor, message: dict):
+        self.last = cursor
+        if message['service_msg']:
+            return
+        self.messages[cursor] = message
+        for word, count in collections.Counter(
+                tokenize(message['message'])).items():
+            self.postings[word][cursor] = count
+
+    def remove_oldest(self, *, keep: int,
+                      before: tp.Optional[HistoryCursor] = None):
+        """
+        Remove oldest messages, until at most `keep` are left, and ones
+        before `before` cursor
+        """
+        while self.messages:
+            # messages are added oldest first
+            cursor = next(iter(self.messages))
+            if len(self.messages) <= keep and \
+                    (before is None or cursor >= before):
+                break
+            message = self.messages.pop(cursor)
+            for word in set(tokenize(message['message'])):
+                postings = self.postings[word]
+                del postings[cursor]
+                if not postings:
+                    del self.postings[word]
+
+    def search(self, query: str, limit: int, offset: int = 0,
+               since: tp.Optional[datetime.datetime] = None
+               ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+        """Same results as `chat_message_search`, ranked by occurrences"""
+        words = set(tokenize(query))
+        if not words:
+            return [], False
+        postings = sorted((self.postings.get(word, {}) for word in words),
+                          key=len)
+        matches = set(postings[0]).intersection(*postings[1:])
+        if since is not None:
+            matches = [cursor for cursor in matches if cursor[0] >= since]
+        matches = heapq.nlargest(SEARCH_RANKED_MAX, matches)
+
+        ranked = heapq.nlargest(offset + limit + 1, matches,
+                                key=lambda c: (sum(p[c] for p in postings), c))
+        page = ranked[offset:]
+        return [(c, self.messages[c]) for c in page[:limit]], \
+            len(page) > limit
+
+
+class MemorySearch:
+    """Inverted indexes of rooms, synced with database on search"""
+
+    # messages loaded per query, when index is synced
+    SYNC_BATCH = 1000
+    # seconds between checks for archived messages of a room, archival runs
+    # seldom, e.g. monthly
+    ARCHIVE_CHECK_INTERVAL = 60
+
+    def __init__(self, max_messages: int):
+        self.max_messages = max_messages
+        self._rooms: tp.Dict[int, InvertedIndex] = {}
+        # searches are run by database executor threads
+        self._lock = threading.Lock()
+
+    def _sync(self, room: Room, index: InvertedIndex):
+        if index.last is None:
+            # older messages would be dropped right away
+            entries, _ = chat_message_page_entries(room=room,
+                                                   limit=self.max_messages)
+            for cursor, message in entries:
+                index.add(cursor, message)
+            index.checked = time.monotonic()
+
+        has_more = True
+        while has_more:
+            entries, has_more = chat_message_since_entries(
+                room=room, after=index.last, limit=self.SYNC_BATCH
+            )
+            for cursor, message in entries:
+                index.add(cursor, message)
+
+        keep, before = self.max_messages, None
+        now = time.monotonic()
+        if now - index.checked >= self.ARCHIVE_CHECK_INTERVAL:
+            index.checked = now
+            before = chat_message_oldest_cursor(room=room)
+            if before is None:
+                # all messages of room are removed
+                keep = 0
+        index.remove_oldest(keep=keep, before=before)
+
+    def search(self, *, room: Room, query: str, limit: int, offset: int = 0,
+               since: tp.Optional[datetime.datetime] = None
+               ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+        with self._lock:
+            index = self._rooms.setdefault(room.pk, InvertedIndex())
+            self._sync(room, index)
+            return index.search(query, limit, offset, since)
+
+    def clear(self):
+        with self._lock:
+            self._rooms.clear()
+
+
+memory_search = MemorySearch(SEARCH_MEMORY_MAX)
+
+
+def message_search(*, room: Room, query: str, limit: int, offset: int = 0,
+                   since: tp.Optional[datetime.datetime] = None
+                   ) -> tp.Tuple[tp.List[HistoryEntry], bool]:
+    """
+    Ranked page of room messages, sent since `since`, matching query, by
+    database backend
+    """
+    if connections['default'].vendor == 'postgresql':
+        return chat_message_search(room=room, query=query, limit=limit,
+                                   offset=offset, since=since)
+    return memory_search.search(room=room, query=query, limit=limit,
+                                offset=offset, since=since)
@@ -1,70 +1,322 @@
-let onlineUsers = new Map()
-const chatSocket = new WebSocket('ws://' + window.location.host + '/ws/chat')
-let curUser = null
+// protocol 2: timestamps are sent as epoch milliseconds
+const PROTOCOL_VERSION = 2
+// binary frames, used if server accepts this subprotocol, JSON otherwise
+const MSGPACK_SUBPROTOCOL = 'chat.msgpack'
+const ROOM_NAME = JSON.parse(document.getElementById('room-name').textContent)
+// reconnect delay, seconds: doubled on each failed attempt up to the max,
+// randomized so clients, dropped together, do not reconnect together
+const RECONNECT_DELAY_MIN = 0.5
+const RECONNECT_DELAY_MAX = 30
+let reconnectAttempt = 0
+// close code of a draining server
+const SERVICE_RESTART = 4012
+// close codes, after which reconnect fails the same way
+const CLOSE_FINAL = {
+    4003: 'You are logged out, log in again to chat',
+    4004: 'No such room',
+    4009: 'Message is too long, reload the page to reconnect',
+}
+// cursor of the last message seen, server sends only newer ones on resume
+let lastSeen = null
+let chatSocket = null
+
+function socketUrl() {
+    let url = 'ws://' + window.location.host + '/ws/chat/' + ROOM_NAME +
+        '?v=' + PROTOCOL_VERSION
+    if (lastSeen !== null)
+        url += '&resume=' + encodeURIComponent(JSON.stringify(lastSeen))
+    return url
+}
 
-function showOnlineUsers() {
-    getOnlineDiv().innerHTML = ''
-    for (const [user, html] of onlineUsers.entries()) {
-        getOnlineDiv().innerHTML += html;
-    }
+function connect() {
+    chatSocket = new WebSocket(socketUrl(), [MSGPACK_SUBPROTOCOL])
+    chatSocket.binaryType = 'arraybuffer'
+    chatSocket.onopen = onSocketOpen
+    chatSocket.onmessage = onSocketMessage
+    chatSocket.onclose = onSocketClose
 }
 
-function getChatDiv() {
-    return document.getElementsByClassName('chat-log')[0]
+function reconnectDelay() {
+    let delay = Math.min(RECONNECT_DELAY_MAX,
+                         RECONNECT_DELAY_MIN * 2 ** reconnectAttempt)
+    // full jitter over the upper half of the delay
+    return delay * (0.5 + Math.random() / 2)
+}
+
+function isBinary() {
+    return chatSocket.protocol === MSGPACK_SUBPROTOCOL
 }
 
-function addMessage(data) {
-    getChatDiv().innerHTML += wrapMessage(data)
+function sendEvent(event) {
+    if (isBinary()) chatSocket.send(msgpack.encode(event))
+    else chatSocket.send(JSON.stringify(event))
 }
 
-function addServiceMessage(data) {
-    getChatDiv().innerHTML += wrapServiceMessage(data)
+function decodeEvent(data) {
+    if (data instanceof ArrayBuffer) return msgpack.decode(data)
+    return JSON.parse(data)
+}
+
+let curUser = null
+let historyCursor = null
+let historyLoading = false
+
+/* chat log, virtualized: all messages are kept, only a window of them
+   is rendered and the window moves by chunks, when log is scrolled */
+
+// messages of the log, oldest first
+let messages = []
+// rendered window of messages is [renderStart, renderEnd)
+let renderStart = 0
+let renderEnd = 0
+const RENDER_MAX = 150
+const RENDER_CHUNK = 50
+// distance to log edge in pixels, where next chunk is rendered or fetched
+const SCROLL_MARGIN = 200
+
+// online user -> its element of online list
+let onlineUsers = new Map()
+
+function getChatDiv() {
+    return document.getElementsByClassName('chat-log')[0]
 }
 
 function getOnlineDiv() {
     return document.getElementsByClassName('chat-online')[0]
 }
 
+function isScrolledDown() {
+    let dst = getChatDiv()
+    return dst.scrollHeight - dst.scrollTop - dst.clientHeight < SCROLL_MARGIN
+}
 
 function scrollDown() {
     let dst = getChatDiv()
     dst.scrollTop = dst.scrollHeight
 }
 
+// text, safe to put into html: messages and usernames are user input
+function escapeHtml(text) {
+    return String(text).replace(/[&<>"']/g, c => ({
+        '&': '&amp;', '<': '&lt;', '>': '&gt;', '"': '&quot;', "'": '&#39;'
+    })[c])
+}
+
+// elements of given html, parsed at once
+function htmlFragment(html) {
+    let template = document.createElement('template')
+    template.innerHTML = html
+    return template.content
+}
+
+function wrapHistory(data) {
+    let html = ''
+    for (let i = 0; i < data.length; i++) {
+        let msg = data[i]
+
+        if (msg.service_msg) html += wrapServiceMessage(msg)
+        else html += wrapMessage(msg)
+    }
+    return html
+}
+
+function renderMessages(start, end) {
+    return htmlFragment(wrapHistory(messages.slice(start, end)))
+}
+
+// drop rendered messages over RENDER_MAX from the top, keeping viewport
+function trimTop() {
+    let dst = getChatDiv()
+    let oldHeight = dst.scrollHeight
+    while (renderEnd - renderStart > RENDER_MAX) {
+        dst.firstElementChild.remove()
+        renderStart++
+    }
+    dst.scrollTop -= oldHeight - dst.scrollHeight
+}
+
+function trimBottom() {
+    let dst = getChatDiv()
+    while (renderEnd - renderStart > RENDER_MAX) {
+        dst.lastElementChild.remove()
+        renderEnd--
+    }
+}
+
+function renderOlder() {
+    if (renderStart === 0) {
+        fetchOlderHistory()
+        return
+    }
+    let dst = getChatDiv()
+    let start = Math.max(0, renderStart - RENDER_CHUNK)
+    let oldHeight = dst.scrollHeight
+    dst.prepend(renderMessages(start, renderStart))
+    // keep viewport on the message user was looking at
+    dst.scrollTop += dst.scrollHeight - oldHeight
+    renderStart = start
+    trimBottom()
+}
+
+function renderNewer() {
+    if (renderEnd === messages.length) return
+    let end = Math.min(messages.length, renderEnd + RENDER_CHUNK)
+    getChatDiv().append(renderMessages(renderEnd, end))
+    renderEnd = end
+    trimTop()
+}
+
+// new messages go to the end, rendered if user is at the end of log
+function appendMessages(data) {
+    let follow = renderEnd === messages.length && isScrolledDown()
+    messages.push(...data)
+    if (!follow) return
+    getChatDiv().append(renderMessages(renderEnd, messages.length))
+    renderEnd = messages.length
+    scrollDown()
+    trimTop()
+}
+
+// older page goes before the rest, rendered at once
+function prependMessages(data) {
+    messages.unshift(...data)
+    renderStart += data.length
+    renderEnd += data.length
+    renderOlder()
+}
+
 function initChatHistory(event) {
-    for (let i = 0; i < event.data.length; i++) {
-        let isService = event.data[i].service_msg
-        let msg = event.data[i]
+    // history of a new session replaces whatever was shown before
+    messages = []
+    renderStart = renderEnd = 0
+    getChatDiv().replaceChildren()
+    historyCursor = event.cursor
+    historyLoading = false
+    lastSeen = event.last
+    appendMessages(event.data)
+    scrollDown()
+}
 
-        if (isService) addServiceMessage(msg)
-        else addMessage(msg)
+// messages, missed while reconnecting
+function resumeChatHistory(event) {
+    lastSeen = event.last
+    appendMessages(event.data)
+}
+
+function receiveMessage(data) {
+    if (data.cursor) lastSeen = data.cursor
+    appendMessages([data])
+}
+
+function historyPage(event) {
+    historyCursor = event.cursor
+    historyLoading = false
+    if (event.data.length) prependMessages(event.data)
+}
+
+function fetchOlderHistory() {
+    if (historyCursor === null || historyLoading) return
+    historyLoading = true
+    sendEvent({
+        "type": "history.fetch",
+        "cursor": historyCursor
+    })
+}
+
+/* search, results are paged by server */
+
+let searchQuery = ''
+let searchPage = 0
+
+function getSearchDiv() {
+    return document.querySelector('.chat-search-results')
+}
+
+function searchMessages(query, page) {
+    searchQuery = query
+    searchPage = page
+    sendEvent({
+        "type": "search.query",
+        "query": query,
+        "page": page
+    })
+}
+
+function searchResults(event) {
+    if (event.query !== searchQuery || event.page !== searchPage) return
+    let div = getSearchDiv()
+    if (event.page === 0) div.replaceChildren()
+    else div.querySelector('.chat-search-more')?.remove()
+    if (!event.data.length && event.page === 0)
+        div.append(htmlFragment('<p class="text-secondary">Nothing found</p>'))
+    div.append(htmlFragment(event.data.map(wrapMessage).join('')))
+    if (event.has_more) {
+        div.append(htmlFragment(`<input class="btn btn-link chat-search-more"
+                                        type="button" value="More">`))
+        div.querySelector('.chat-search-more').onclick = function (e) {
+            searchMessages(searchQuery, searchPage + 1)
+        }
     }
-    dst = getChatDiv()
-    dst.scrollTop = dst.scrollHeight
+}
+
+/* online list, updated by user */
+
+function setOnline(user) {
+    if (onlineUsers.has(user)) return
+    let element = htmlFragment(wrapOnlineUser({user})).firstElementChild
+    onlineUsers.set(user, element)
+    getOnlineDiv().append(element)
+}
+
+function setOffline(user) {
+    let element = onlineUsers.get(user)
+    if (element === undefined) return
+    element.remove()
+    onlineUsers.delete(user)
 }
 
 /* incoming event handlers */
 
 function initOnlineUsers(event) {
-    event.data.forEach(user => onlineUsers.set(user.user, wrapOnlineUser(user)))
-    showOnlineUsers()
+    onlineUsers.forEach(element => element.remove())
+    onlineUsers.clear()
+    event.data.forEach(user => setOnline(user.user))
 }
 
 
 function onlineConnect(event) {
-    onlineUsers.set(event.user, wrapOnlineUser(event))
-    showOnlineUsers()
+    setOnline(event.user)
 }
 
 function onlineDisconnect(event) {
-    onlineUsers.delete(event.user)
-    showOnlineUsers()
+    setOffline(event.user)
+}
+
+// joins and leaves, collected by server since previous delta
+function onlineDelta(event) {
+    event.left.forEach(setOffline)
+    event.joined.forEach(setOnline)
+}
+
+let noticeTimer = null
+
+// text in snackbar, hidden after a while unless permanent
+function showNotice(text, permanent = false) {
+    let x = document.getElementById("snackbar")
+    clearTimeout(noticeTimer)
+    x.className = permanent ? "show permanent" : "show"
+    x.textContent = text
+    if (permanent) return
+    noticeTimer = setTimeout(function () {
+        x.className = x.className.replace("show", "")
+        x.textContent = ''
+    }, 3000);
 }
 
 function userMention(event) {
     let x = document.getElementById("snackbar")
     x.className = "show"
-    x.innerHTML = `<b>${event.by}</b>: ${event.message}`
+    x.innerHTML = `<b>${escapeHtml(event.by)}</b>: ${escapeHtml(event.message)}`
     setTimeout(function () {
         x.className = x.className.replace("show", "")
         x.innerHTML = ''
@@ -80,7 +332,7 @@ function userWhoami(event) {
 
 function wrapOnlineUser(data) {
     return `<div class="user-online">
-                ${data.user}
+                ${escapeHtml(data.user)}
                 <hr style="margin: 0">
             </div>`
 }
@@ -88,11 +340,18 @@ function wrapOnlineUser(data) {
 
 function wrapServiceMessage(data) {
     return `<div class="chat-service-message"> 
-                <p>${data.message}</p>
+                <p>${escapeHtml(data.message)}</p>
             </div>`
 }
 
 
+function formatTime(sent) {
+    let date = new Date(sent)
+    let pad = val => String(val).padStart(2, '0')
+    return `${pad(date.getHours())}:${pad(date.getMinutes())}`
+}
+
+
 function wrapMessage(data) {
     let outerCls = ''
     if (data.author === curUser)
@@ -102,68 +361,81 @@ function wrapMessage(data) {
 
     return `<div class="${outerCls} w-75">
                 <div class="chat-message">
-                    ${data.message}
+                    ${escapeHtml(data.message)}
                 </div>
                 
                 <div class="d-flex mt-2 pb5-0">
-                    <span class="text-secondary">${data.author}</span>
+                    <span class="text-secondary">${escapeHtml(data.author)}</span>
                     <span class="ml-auto text-secondary">
-                        ${data.sent.hour.padStart(2, '0')}:${data.sent.minute.padStart(2, '0')}
+                        ${formatTime(data.sent)}
                     </span>
                 </div>
             </div>`
 }
 
 
-chatSocket.onmessage = function (e) {
-    const data = JSON.parse(e.data)
-    console.log(e.data)
+function onSocketOpen(e) {
+    reconnectAttempt = 0
+}
+
+function onSocketMessage(e) {
+    const data = decodeEvent(e.data)
 
     let msg_type = data.type.split('.')
 
-    if (msg_type[0] === 'user') {
+    if (msg_type[0] === 'error') {
+        // event sent by this client was rejected
+        showNotice(data.detail)
+    } else if (msg_type[0] === 'user') {
         if (msg_type[1] === 'mention') userMention(data)
     } else if (msg_type[0] === 'chat') {
-        if (msg_type[1] === 'message') {
-            addMessage(data)
-            scrollDown()
-        } else if (msg_type[1] === 'servicemessage') {
-            addServiceMessage(data)
-            scrollDown()
-        }
+        if (msg_type[1] === 'message') receiveMessage(data)
+        else if (msg_type[1] === 'servicemessage')
+            receiveMessage({...data, service_msg: true})
     } else if (msg_type[0] === 'init') {
         if (msg_type[1] === 'whoami') userWhoami(data)
         else if (msg_type[1] === 'chat_history') initChatHistory(data)
+        else if (msg_type[1] === 'resume') resumeChatHistory(data)
         else if (msg_type[1] === 'online_users') initOnlineUsers(data)
+    } else if (msg_type[0] === 'history') {
+        if (msg_type[1] === 'page') historyPage(data)
+    } else if (msg_type[0] === 'search') {
+        if (msg_type[1] === 'results') searchResults(data)
     } else if (msg_type[0] === 'online') {
         if (msg_type[1] === 'connect') onlineConnect(data)
         else if (msg_type[1] === 'disconnect') onlineDisconnect(data)
+        else if (msg_type[1] === 'delta') onlineDelta(data)
     }
 }
 
+// mentions are resolved and notified by server
 function processMessage(data) {
-    let prepare = obj => JSON.stringify(obj)
-
     message = data.message.slice(0, -1)
-    let mentioned = message.matchAll(/(^|\s)@([\w.\-]+)/gm)
-
-    for (let match of mentioned) {
-        chatSocket.send(prepare({
-            "type": "user.mention",
-            "name": match[2],
-            "message": message
-        }))
-    }
-
-    chatSocket.send(prepare({
+    sendEvent({
         "type": "chat.message",
         "message": message
-    }))
+    })
 }
 
-chatSocket.onclose = function (e) {
-    console.error('Chat socket closed unexpectedly')
-};
+function onSocketClose(e) {
+    if (e.code in CLOSE_FINAL) {
+        showNotice(CLOSE_FINAL[e.code], true)
+        return
+    }
+    let delay = reconnectDelay()
+    reconnectAttempt++
+    // server worker restarts, another one serves the reconnect
+    let log = e.code === SERVICE_RESTART ? console.info : console.error
+    log(`Chat socket closed, reconnecting in ${delay.toFixed(1)}s`)
+    setTimeout(connect, delay * 1000)
+}
+
+getChatDiv().onscroll = function (e) {
+    if (getChatDiv().scrollTop < SCROLL_MARGIN) renderOlder()
+    else if (isScrolledDown()) renderNewer()
+}
+
+connect()
 
 document.querySelector('#chat-message-input').focus()
 document.querySelector('#chat-message-input').onkeyup = function (e) {
@@ -178,3 +450,8 @@ document.querySelector('#chat-message-submit').onclick = function (e) {
     processMessage({"type": "chat.message", "message": message})
     messageInputDom.value = ''
 };
+
+document.querySelector('#chat-search-input').onkeyup = function (e) {
+    const query = e.target.value.trim()
+    if (e.keyCode === 13 && query) searchMessages(query, 0)
+}
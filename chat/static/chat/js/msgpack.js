@@ -0,0 +1,142 @@
+/* Minimal MessagePack codec, covers types used by chat protocol:
+   nil, booleans, integers, floats, strings, arrays and maps */
+
+const msgpack = (function () {
+    const textEncoder = new TextEncoder()
+    const textDecoder = new TextDecoder()
+
+    function encode(value) {
+        let bytes = []
+        encodeValue(value, bytes)
+        return new Uint8Array(bytes)
+    }
+
+    function pushUint(bytes, value, size) {
+        for (let i = size - 1; i >= 0; i--) {
+            bytes.push(Math.floor(value / Math.pow(2, 8 * i)) & 0xff)
+        }
+    }
+
+    function encodeHeader(bytes, length, fix, fixMax, codes) {
+        if (fix !== null && length <= fixMax) bytes.push(fix | length)
+        else if (codes[0] !== null && length < 0x100) bytes.push(codes[0], length)
+        else if (length < 0x10000) { bytes.push(codes[1]); pushUint(bytes, length, 2) }
+        else { bytes.push(codes[2]); pushUint(bytes, length, 4) }
+    }
+
+    function encodeValue(value, bytes) {
+        if (value === null || value === undefined) bytes.push(0xc0)
+        else if (value === false) bytes.push(0xc2)
+        else if (value === true) bytes.push(0xc3)
+        else if (typeof value === 'number') encodeNumber(value, bytes)
+        else if (typeof value === 'string') {
+            let utf8 = textEncoder.encode(value)
+            encodeHeader(bytes, utf8.length, 0xa0, 31, [0xd9, 0xda, 0xdb])
+            for (let i = 0; i < utf8.length; i++) bytes.push(utf8[i])
+        } else if (Array.isArray(value)) {
+            encodeHeader(bytes, value.length, 0x90, 15, [null, 0xdc, 0xdd])
+            value.forEach(item => encodeValue(item, bytes))
+        } else {
+            let keys = Object.keys(value)
+            encodeHeader(bytes, keys.length, 0x80, 15, [null, 0xde, 0xdf])
+            keys.forEach(key => {
+                encodeValue(key, bytes)
+                encodeValue(value[key], bytes)
+            })
+        }
+    }
+
+    function encodeNumber(value, bytes) {
+        if (Number.isInteger(value) && value >= 0 && value < 0x80) {
+            bytes.push(value)
+        } else if (Number.isInteger(value) && value < 0 && value >= -32) {
+            bytes.push(value & 0xff)
+        } else if (Number.isSafeInteger(value) && value >= 0) {
+            bytes.push(0xcf)
+            pushUint(bytes, value, 8)
+        } else {
+            // negative integers beyond fixint are not used by protocol,
+            // encode them as float64 along with fractions
+            let view = new DataView(new ArrayBuffer(8))
+            view.setFloat64(0, value)
+            bytes.push(0xcb)
+            for (let i = 0; i < 8; i++) bytes.push(view.getUint8(i))
+        }
+    }
+
+    function decode(buffer) {
+        let view = new DataView(buffer)
+        let offset = 0
+
+        function uint(size) {
+            let value = 0
+            for (let i = 0; i < size; i++) value = value * 256 + view.getUint8(offset + i)
+            offset += size
+            return value
+        }
+
+        function int(size) {
+            let value = uint(size)
+            let max = Math.pow(2, 8 * size)
+            return value >= max / 2 ? value - max : value
+        }
+
+        function str(length) {
+            let value = textDecoder.decode(new Uint8Array(buffer, offset, length))
+            offset += length
+            return value
+        }
+
+        function array(length) {
+            let value = []
+            for (let i = 0; i < length; i++) value.push(next())
+            return value
+        }
+
+        function map(length) {
+            let value = {}
+            for (let i = 0; i < length; i++) {
+                let key = next()
+                value[key] = next()
+            }
+            return value
+        }
+
+        function next() {
+            let code = uint(1)
+            if (code < 0x80) return code
+            if (code < 0x90) return map(code & 0x0f)
+            if (code < 0xa0) return array(code & 0x0f)
+            if (code < 0xc0) return str(code & 0x1f)
+            if (code >= 0xe0) return code - 0x100
+
+            switch (code) {
+                case 0xc0: return null
+                case 0xc2: return false
+                case 0xc3: return true
+                case 0xca: offset += 4; return view.getFloat32(offset - 4)
+                case 0xcb: offset += 8; return view.getFloat64(offset - 8)
+                case 0xcc: return uint(1)
+                case 0xcd: return uint(2)
+                case 0xce: return uint(4)
+                case 0xcf: return uint(8)
+                case 0xd0: return int(1)
+                case 0xd1: return int(2)
+                case 0xd2: return int(4)
+                case 0xd3: return int(8)
+                case 0xd9: return str(uint(1))
+                case 0xda: return str(uint(2))
+                case 0xdb: return str(uint(4))
+                case 0xdc: return array(uint(2))
+                case 0xdd: return array(uint(4))
+                case 0xde: return map(uint(2))
+                case 0xdf: return map(uint(4))
+            }
+            throw new Error('Unsupported MessagePack type: 0x' + code.toString(16))
+        }
+
+        return next()
+    }
+
+    return {encode: encode, decode: decode}
+})()
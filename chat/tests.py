@@ -1,3 +1,1909 @@
-from django.test import TestCase
+import asyncio
+import datetime
+import functools
+import gzip
+import json
+import os
+import signal
+import sys
+import tempfile
+import threading
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from channels.routing import URLRouter
+from channels.testing import WebsocketCommunicator
+from django.contrib.auth.models import AnonymousUser
+from django.core.management import call_command, CommandError
+from django.db import connection, connections
+from django.test import TestCase, SimpleTestCase, TransactionTestCase, \
+    skipUnlessDBFeature, override_settings
+from django.utils import timezone
+
+from chat.benchmarks import BENCH_LAYERS, bench_fanout, _percentiles
+from chat import metrics
+from chat.codec import protocol_negotiate, encoded_event, event_text, pack, \
+    unpack, MSGPACK_SUBPROTOCOL, binary_transport
+from chat.consumers import ChatConsumer, ChatConsumerBase, live_consumers
+from chat.const import DEFAULT_ROOM_NAME, PROTOCOL_LEGACY, PROTOCOL_COMPACT, \
+    CLOSE_SERVICE_RESTART, CLOSE_ROOM_NOT_FOUND, CLOSE_TRY_AGAIN_LATER, \
+    CLOSE_MESSAGE_TOO_BIG, CLOSE_UNAUTHORIZED
+from chat import db_async
+from chat.db_executor import DBExecutor, DatabaseBusy, db_executor
+from chat.db_selectors import chat_message_page_as_dicts, \
+    chat_message_page_entries, connection_lease_online_users_as_dicts, \
+    chat_message_since_entries
+from chat.db_services import user_create, room_get_or_create, \
+    chat_message_create, connection_lease_acquire, connection_lease_release, \
+    connection_lease_renew, connection_lease_expire
+from chat.history_cache import HistoryCache, history_cache, \
+    history_event_entry
+from chat.layers import HashRing, LocalChannelLayer, ShardedRedisChannelLayer
+from chat.managers import AbstractManager, FRAME_SIZE_MAX, \
+    MESSAGE_LENGTH_MAX
+from chat import managers
+from chat.mentions import KnownUsernames, mentions_extract
+from chat.message_writer import MessageWriter
+from chat import message_writer
+from chat.models import ConnectionLease, ChatMessage, Room
+from chat.routing import websocket_urlpatterns
+from chat import outbound
+from chat.outbound import OutboundQueue, OutboundOverflow
+from chat import partitions
+from chat.rate_limit import RateLimiter, connection_rate_limit, \
+    user_rate_limit
+from chat.search import memory_search, message_search
+from chat import presence
+from chat.presence import PresenceSweeper
+from chat.utils import datetime_to_epoch_ms, room_group_name, \
+    history_cursor_encode, history_cursor_decode
+from chat.workers import Supervisor
+
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    'default': {'BACKEND': 'channels.layers.InMemoryChannelLayer'}
+}
+
+
+class ChatTransactionTestCase(TransactionTestCase):
+    """Releases persistent connections, opened outside of test thread"""
+
+    def tearDown(self):
+        db_executor.close_connections()
+        db_async.pool.terminate()
+        super().tearDown()
+
+
+class HistorySerializationTestCase(TestCase):
+
+    def setUp(self):
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.other_room = room_get_or_create(name='other')
+        self.users = [user_create(username=f'user{i}', password='password')
+                      for i in range(5)]
+        for i in range(30):
+            chat_message_create(text=f'message {i}', room=self.room,
+                                author=self.users[i % len(self.users)])
+        chat_message_create(text='service', author=None, room=self.room,
+                            service_msg=True)
+        chat_message_create(text='elsewhere', author=self.users[0],
+                            room=self.other_room)
+
+    def test_history_page_query_count(self):
+        with self.assertNumQueries(1):
+            data, cursor = chat_message_page_as_dicts(room=self.room, limit=10)
+
+        self.assertEqual(len(data), 10)
+        self.assertIsNotNone(cursor)
+        self.assertEqual(data[-1], {'message': 'service',
+                                    'sent': data[-1]['sent'],
+                                    'author': None,
+                                    'service_msg': True})
+
+        with self.assertNumQueries(1):
+            older, _ = chat_message_page_as_dicts(room=self.room, limit=10,
+                                                  before=cursor)
+        self.assertEqual(older[-1]['message'], 'message 20')
+
+    def test_since_query(self):
+        msg = ChatMessage.objects.get(text='message 28')
+        after = (msg.sent, msg.id)
+        with self.assertNumQueries(1):
+            entries, has_more = chat_message_since_entries(
+                room=self.room, after=after, limit=1
+            )
+        self.assertEqual([m['message'] for _, m in entries], ['message 29'])
+        self.assertTrue(has_more)
+
+    def test_history_is_per_room(self):
+        data, cursor = chat_message_page_as_dicts(room=self.other_room,
+                                                  limit=10)
+        self.assertEqual([d['message'] for d in data], ['elsewhere'])
+        self.assertIsNone(cursor)
+
+    def test_online_users_query_count(self):
+        now = timezone.now()
+        expires = now + datetime.timedelta(seconds=30)
+        for i, user in enumerate(self.users):
+            connection_lease_acquire(user=user, room=self.room,
+                                     channel_name=f'channel{i}',
+                                     expires=expires, now=now)
+
+        with self.assertNumQueries(1):
+            data = connection_lease_online_users_as_dicts(room=self.room,
+                                                          now=now)
+        self.assertEqual(
+            connection_lease_online_users_as_dicts(room=self.other_room,
+                                                   now=now),
+            []
+        )
+
+        self.assertEqual(len(data), len(self.users))
+        self.assertIn({'user': 'user0', 'connections': 1}, data)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class HistoryFetchTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        # messages are created below, bypassing cache of this worker
+        history_cache.invalidate(self.room.name)
+        for i in range(5):
+            chat_message_create(text=f'message {i}', author=self.user,
+                                room=self.room)
+
+    def fetch(self, cursors):
+        """
+        Connect, send `history.fetch` for each cursor, None meaning cursor of
+        initial history, return initial history and frames received in
+        response.
+        """
+        async def receive_all(communicator):
+            frames = []
+            while not await communicator.receive_nothing(timeout=.2):
+                event = json.loads(await communicator.receive_from())
+                # presence updates may arrive at any time
+                if event['type'] in ('init.chat_history', 'history.page',
+                                     'error'):
+                    frames.append(event)
+            return frames
+
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            init, = await receive_all(communicator)
+
+            received = []
+            for cursor in cursors:
+                if cursor is None:
+                    cursor = init['cursor']
+                await communicator.send_to(text_data=json.dumps(
+                    {'type': 'history.fetch', 'cursor': cursor}
+                ))
+                received.extend(await receive_all(communicator))
+            await communicator.disconnect()
+            return init, received
+
+        with mock.patch.object(managers, 'HISTORY_PAGE_SIZE', 3):
+            return async_to_sync(run)()
+
+    def test_fetch_older_page(self):
+        init, received = self.fetch([None])
+        self.assertEqual([m['message'] for m in init['data']],
+                         ['message 2', 'message 3', 'message 4'])
+
+        page, = received
+        self.assertEqual(page['type'], 'history.page')
+        self.assertEqual([m['message'] for m in page['data']],
+                         ['message 0', 'message 1'])
+        self.assertIsNone(page['cursor'])
+
+    def test_malformed_cursor_reported(self):
+        _, received = self.fetch([
+            'yesterday',
+            {'sent': 'yesterday', 'id': 1},
+            {'sent': timezone.now().isoformat(), 'id': 'x'},
+            {'id': 1},
+            # naive timestamp can not be compared with cached cursors
+            {'sent': '2020-01-01T00:00:00', 'id': 1},
+        ])
+        self.assertEqual([(event['type'], event['reason'])
+                          for event in received],
+                         [('error', 'invalid')] * 5)
+
+
+class HistoryCacheTestCase(SimpleTestCase):
+
+    room = 'chat'
+
+    def entry(self, pk):
+        sent = datetime.datetime(2020, 7, 9, tzinfo=datetime.timezone.utc) \
+            + datetime.timedelta(seconds=pk)
+        return (sent, pk), {'message': str(pk)}
+
+    def setUp(self):
+        self.cache = HistoryCache(maxlen=5)
+        self.cache.subscribe(self.room)
+        self.cache.fill(self.room, [self.entry(i) for i in range(3)],
+                        has_more=False, started=self.cache.load_start())
+
+    def test_page_hit_and_miss(self):
+        data, cursor = self.cache.page(self.room, limit=2)
+        self.assertEqual([m['message'] for m in data], ['1', '2'])
+        self.assertEqual(cursor, self.entry(1)[0])
+
+        data, cursor = self.cache.page(self.room, limit=2, before=cursor)
+        self.assertEqual([m['message'] for m in data], ['0'])
+        self.assertIsNone(cursor)
+
+        self.assertIsNone(self.cache.page('other', limit=2))
+        self.assertEqual((self.cache.hits, self.cache.misses), (2, 1))
+
+    def test_append_evicts_oldest(self):
+        for i in range(3, 7):
+            self.cache.append(self.room, *self.entry(i))
+        # duplicate delivery of broadcast is ignored
+        self.cache.append(self.room, *self.entry(6))
+
+        data, cursor = self.cache.page(self.room, limit=10)
+        self.assertEqual([m['message'] for m in data],
+                         ['2', '3', '4', '5', '6'])
+        self.assertEqual(cursor, self.entry(2)[0])
+
+    def test_broadcast_applied_once_per_worker(self):
+        cache = HistoryCache(maxlen=5)
+        for _ in range(3):
+            cache.subscribe(self.room)
+        started = cache.load_start()
+        events = [{'history': history_event_entry(*self.entry(i))}
+                  for i in range(3)]
+
+        with mock.patch('chat.history_cache.history_cursor_decode',
+                        wraps=history_cursor_decode) as decode:
+            # every local consumer receives its own copy of each broadcast
+            for event in events:
+                for _ in range(3):
+                    cache.append_from_event(self.room, dict(event))
+        self.assertEqual(decode.call_count, len(events))
+
+        cache.fill(self.room, [], has_more=False, started=started)
+        data, _ = cache.page(self.room, limit=10)
+        self.assertEqual([m['message'] for m in data], ['0', '1', '2'])
+
+    def test_unsubscribe_drops_buffer(self):
+        self.cache.unsubscribe(self.room)
+        self.assertIsNone(self.cache.page(self.room, limit=2))
+
+    def test_broadcast_during_load_merged(self):
+        cache = HistoryCache(maxlen=5)
+        cache.subscribe(self.room)
+        started = cache.load_start()
+        # broadcast between database snapshot and fill, message 3 was
+        # committed after snapshot, message 2 is not saved yet
+        cache.append(self.room, *self.entry(2))
+        cache.append(self.room, *self.entry(3))
+        cache.fill(self.room, [self.entry(0), self.entry(1)],
+                   has_more=False, started=started)
+        cache.append(self.room, *self.entry(4))
+
+        data, cursor = cache.page(self.room, limit=10)
+        self.assertEqual([m['message'] for m in data],
+                         ['0', '1', '2', '3', '4'])
+        self.assertIsNone(cursor)
+
+    def test_history_page_keeps_broadcast_during_load(self):
+        room = Room(name='race')
+        history_cache.subscribe(room.name)
+        self.addCleanup(history_cache.unsubscribe, room.name)
+
+        def db(func):
+            async def load(**kwargs):
+                # broadcast arrives, while snapshot query is awaited
+                history_cache.append(room.name, *self.entry(1))
+                return [self.entry(0)], False
+            return load
+
+        with mock.patch.object(managers, 'db', db):
+            async_to_sync(managers.history_page)(room)
+        data, _ = history_cache.page(room.name, limit=10)
+        self.assertEqual([m['message'] for m in data], ['0', '1'])
+
+    def test_fill_waits_until_writes_settle(self):
+        cache = HistoryCache(maxlen=5, settle=60)
+        cache.subscribe(self.room)
+        cache.fill(self.room, [self.entry(0)], has_more=False,
+                   started=cache.load_start())
+        self.assertIsNone(cache.page(self.room, limit=2))
+
+    def test_since(self):
+        since = self.cache.since(self.room, self.entry(0)[0])
+        self.assertEqual([m['message'] for _, m in since], ['1', '2'])
+        self.assertEqual(self.cache.latest(self.room), self.entry(2)[0])
+
+        for i in range(3, 7):
+            self.cache.append(self.room, *self.entry(i))
+        # message 1 is evicted, there may be more missed ones
+        self.assertIsNone(self.cache.since(self.room, self.entry(0)[0]))
+        self.assertEqual(self.cache.since(self.room, self.entry(6)[0]), [])
+
+
+class ProtocolTestCase(SimpleTestCase):
+
+    def test_negotiate(self):
+        self.assertEqual(protocol_negotiate({'query_string': b'v=2'}),
+                         PROTOCOL_COMPACT)
+        for query in (b'', b'v=100', b'v=x'):
+            self.assertEqual(protocol_negotiate({'query_string': query}),
+                             PROTOCOL_LEGACY)
+
+    def test_encoded_event_timestamps(self):
+        sent = datetime.datetime(2020, 7, 9, 10, 2, 3, 4000,
+                                 tzinfo=datetime.timezone.utc)
+        event = encoded_event({'type': 'chat.message',
+                               'message': 'hello',
+                               'sent': datetime_to_epoch_ms(sent)})
+
+        compact = json.loads(event_text(event, PROTOCOL_COMPACT))
+        self.assertEqual(compact['sent'], 1594288923004)
+
+        legacy = json.loads(event_text(event, PROTOCOL_LEGACY))
+        self.assertEqual(legacy['sent'], {'year': '2020', 'month': '7',
+                                          'day': '9', 'hour': '10',
+                                          'minute': '2', 'second': '3',
+                                          'microsecond': '4000',
+                                          'tzinfo': 'UTC'})
+
+        # frames without timestamps are encoded once
+        event = encoded_event({'type': 'online.connect', 'user': 'user'})
+        self.assertNotIn('legacy_text', event)
+
+
+class SendEncodedTestCase(SimpleTestCase):
+    """Pre-encoded frame variant matches protocol of the connection"""
+
+    def setUp(self):
+        sent = datetime.datetime(2020, 7, 9, tzinfo=datetime.timezone.utc)
+        self.event = encoded_event({'type': 'chat.message',
+                                    'message': 'hello',
+                                    'sent': datetime_to_epoch_ms(sent)})
+
+    def forward(self, protocol=PROTOCOL_COMPACT, binary=False):
+        consumer = ChatConsumerBase({'type': 'websocket'})
+        consumer.protocol = protocol
+        consumer.binary = binary
+        frames = []
+
+        async def send_now(text_data=None, bytes_data=None, close=False):
+            frames.append((text_data, bytes_data))
+
+        consumer.send_now = send_now
+        async_to_sync(consumer.send_encoded)(self.event)
+        return frames
+
+    def test_compact_text(self):
+        self.assertEqual(self.forward(), [(self.event['text'], None)])
+
+    def test_legacy_text(self):
+        self.assertNotEqual(self.event['legacy_text'], self.event['text'])
+        self.assertEqual(self.forward(protocol=PROTOCOL_LEGACY),
+                         [(self.event['legacy_text'], None)])
+
+    @skipUnless(binary_transport, 'binary transport is disabled')
+    def test_bytes(self):
+        self.assertEqual(self.forward(binary=True),
+                         [(None, self.event['bytes'])])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BinaryTransportTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+
+    async def receive_until(self, communicator, event_type):
+        while True:
+            event = unpack(await communicator.receive_from())
+            if event['type'] == event_type:
+                return event
+
+    def test_msgpack_roundtrip(self):
+        async def chat():
+            communicator = WebsocketCommunicator(
+                ChatConsumer, '/ws/chat', subprotocols=[MSGPACK_SUBPROTOCOL]
+            )
+            communicator.scope['user'] = self.user
+            connected, subprotocol = await communicator.connect()
+            self.assertTrue(connected)
+            self.assertEqual(subprotocol, MSGPACK_SUBPROTOCOL)
+
+            whoami = await self.receive_until(communicator, 'init.whoami')
+            self.assertEqual(whoami['protocol'], PROTOCOL_COMPACT)
+
+            await communicator.send_to(bytes_data=pack(
+                {'type': 'chat.message', 'message': 'hello'}
+            ))
+            event = await self.receive_until(communicator, 'chat.message')
+            await communicator.disconnect()
+            return event
+
+        event = async_to_sync(chat)()
+        self.assertEqual(event['message'], 'hello')
+        self.assertIsInstance(event['sent'], int)
+
+
+class ConnectionLeaseTestCase(TestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.other_room = room_get_or_create(name='other')
+        self.user = user_create(username='user', password='password')
+        self.other = user_create(username='other', password='password')
+
+    def acquire(self, user, channel_name, ttl, room=None):
+        expires = self.now + datetime.timedelta(seconds=ttl)
+        return connection_lease_acquire(user=user, room=room or self.room,
+                                        channel_name=channel_name,
+                                        expires=expires, now=self.now)
+
+    def test_acquire_release(self):
+        self.assertEqual(self.acquire(self.user, 'a', ttl=30), 1)
+        self.assertEqual(self.acquire(self.user, 'b', ttl=30), 2)
+        # presence is counted per room
+        self.assertEqual(self.acquire(self.user, 'c', ttl=30,
+                                      room=self.other_room), 1)
+
+        release = functools.partial(connection_lease_release, user=self.user,
+                                    room=self.room, now=self.now)
+        self.assertEqual(release(channel_name='a'), 1)
+        self.assertEqual(release(channel_name='b'), 0)
+        # already released, e.g. by sweeper
+        self.assertIsNone(release(channel_name='b'))
+
+    def test_expire_in_bulk(self):
+        self.acquire(self.user, 'a', ttl=10)
+        self.acquire(self.user, 'b', ttl=60)
+        self.acquire(self.other, 'c', ttl=10)
+        self.acquire(self.other, 'd', ttl=10, room=self.other_room)
+
+        later = self.now + datetime.timedelta(seconds=30)
+        # savepoint, select, delete, still online, users, rooms, release:
+        # no per-user or per-room queries
+        with self.assertNumQueries(7):
+            gone = connection_lease_expire(now=later)
+
+        self.assertEqual(gone, [(self.room, 'other'),
+                                (self.other_room, 'other')])
+        self.assertEqual(
+            list(ConnectionLease.objects.values_list('channel_name',
+                                                     flat=True)),
+            ['b']
+        )
+        self.assertFalse(connection_lease_renew(channel_name='a',
+                                                expires=later))
+        self.assertTrue(connection_lease_renew(channel_name='b',
+                                               expires=later))
+
+
+def presence_patchers(**attributes):
+    """Patchers of presence module for batched, transient presence"""
+    attributes = {'DELTA_INTERVAL': 1,
+                  'SERVICE_MESSAGES': presence.SERVICE_MESSAGES_TRANSIENT,
+                  **attributes}
+    return [mock.patch.object(presence, name, value)
+            for name, value in attributes.items()]
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceSweeperTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.user = user_create(username='user', password='password')
+        expires = self.now + datetime.timedelta(seconds=30)
+        connection_lease_acquire(user=self.user, room=self.room,
+                                 channel_name='crashed',
+                                 expires=expires, now=self.now)
+
+        self.layer = get_channel_layer()
+        self.channel = async_to_sync(self.layer.new_channel)()
+        async_to_sync(self.layer.group_add)(room_group_name(self.room.name),
+                                            self.channel)
+
+        self.batcher = presence.PresenceBatcher(interval=60)
+        for patcher in presence_patchers(presence_batcher=self.batcher):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+
+    def sweep(self, seconds_later):
+        fake_now = self.now + datetime.timedelta(seconds=seconds_later)
+        with mock.patch('chat.presence.clock', return_value=fake_now):
+            return async_to_sync(PresenceSweeper(interval=0).sweep)(self.layer)
+
+    def test_sweep_expires_stale_lease(self):
+        self.assertEqual(self.sweep(seconds_later=10), [])
+        self.assertEqual(self.sweep(seconds_later=60), [(self.room, 'user')])
+        async_to_sync(self.batcher.flush)(self.layer)
+
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual(json.loads(event['text']),
+                         {'type': 'online.delta', 'joined': [],
+                          'left': ['user']})
+        event = async_to_sync(self.layer.receive)(self.channel)
+        self.assertEqual(json.loads(event['text']),
+                         {'type': 'chat.servicemessage',
+                          'message': 'User user left'})
+        self.assertFalse(ConnectionLease.objects.exists())
+
+    def test_restarted_in_new_loop(self):
+        sweeper = PresenceSweeper(interval=3600)
+
+        async def start():
+            sweeper.ensure_running(self.layer)
+            return sweeper._task
+
+        tasks = []
+        for _ in range(2):
+            loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(loop)
+            tasks.append(loop.run_until_complete(start()))
+            # task of closed loop stays pending forever
+            loop.close()
+        asyncio.set_event_loop(None)
+
+        self.assertIsNot(tasks[0], tasks[1])
+        self.assertFalse(tasks[0].done())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class PresenceBatcherTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        for patcher in presence_patchers():
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.now = timezone.now()
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+
+    def online(self, *usernames):
+        for username in usernames:
+            user = user_create(username=username, password='password')
+            connection_lease_acquire(
+                user=user, room=self.room, channel_name=username,
+                expires=self.now + datetime.timedelta(seconds=30),
+                now=self.now
+            )
+
+    def broadcast(self, *workers):
+        """
+        Add changes of each worker to its batcher, flush batchers in order,
+        return events room received
+        """
+        async def run():
+            layer = get_channel_layer()
+            channel = await layer.new_channel()
+            await layer.group_add(room_group_name(self.room.name), channel)
+
+            for changes in workers:
+                batcher = presence.PresenceBatcher(interval=60)
+                for username, joined in changes:
+                    batcher.add(self.room, username, joined)
+                await batcher.flush(layer)
+
+            events = []
+            while True:
+                try:
+                    event = await asyncio.wait_for(layer.receive(channel),
+                                                   timeout=.05)
+                except asyncio.TimeoutError:
+                    return events
+                events.append(json.loads(event['text']))
+
+        return async_to_sync(run)()
+
+    def test_changes_batched_into_delta(self):
+        self.online(*[f'user{i}' for i in range(1, 7)])
+        changes = [(f'user{i}', True) for i in range(7)] + \
+                  [('old', False), ('user0', False), ('back', False),
+                   ('back', True)]
+        self.assertEqual(self.broadcast(changes), [
+            {'type': 'online.delta',
+             'joined': [f'user{i}' for i in range(1, 7)], 'left': ['old']},
+            {'type': 'chat.servicemessage',
+             'message': 'Users user1, user2, user3, user4, user5 and 1 more '
+                        'joined'},
+            {'type': 'chat.servicemessage', 'message': 'User old left'},
+        ])
+
+    def test_reconnect_broadcasts_nothing(self):
+        self.assertEqual(self.broadcast([('user', False), ('user', True)]),
+                         [])
+
+    def test_rejoin_on_worker_flushed_first(self):
+        # left on one worker, joined on another one, which flushes first
+        self.online('user')
+        self.assertEqual(self.broadcast([('user', True)], [('user', False)]), [
+            {'type': 'online.delta', 'joined': ['user'], 'left': []},
+            {'type': 'chat.servicemessage', 'message': 'User user joined'},
+        ])
+
+    def test_leave_on_worker_flushed_first(self):
+        # joined on one worker, left on another one, which flushes first
+        self.assertEqual(self.broadcast([('user', False)], [('user', True)]), [
+            {'type': 'online.delta', 'joined': [], 'left': ['user']},
+            {'type': 'chat.servicemessage', 'message': 'User user left'},
+        ])
+
+    def test_failed_room_does_not_drop_others(self):
+        broken = room_get_or_create(name='broken')
+        broadcast = []
+
+        async def presence_broadcast(channel_layer, room, joined, left):
+            if room == broken:
+                raise ConnectionError('layer is down')
+            broadcast.append((room.name, joined, left))
+
+        batcher = presence.PresenceBatcher(interval=60)
+        batcher.add(broken, 'user', False)
+        batcher.add(self.room, 'user', False)
+        with mock.patch.object(presence, 'presence_broadcast',
+                               presence_broadcast), \
+                self.assertLogs('chat.presence', 'ERROR'):
+            async_to_sync(batcher.flush)(get_channel_layer())
+        self.assertEqual(broadcast, [(self.room.name, [], ['user'])])
+        self.assertEqual(batcher.flushes, 1)
+
+
+class HeartbeatTestCase(SimpleTestCase):
+
+    def test_survives_errors_and_reacquires_lease(self):
+        manager = managers.UserTrackManager.__new__(managers.UserTrackManager)
+        manager.channel_name = 'channel'
+        results = [DatabaseBusy('busy'), False]
+        acquired = None
+
+        def db(func):
+            async def call(**kwargs):
+                result = results.pop(0) if results else True
+                if isinstance(result, Exception):
+                    raise result
+                return result
+            return call
+
+        async def acquire_lease():
+            acquired.set()
+
+        async def run():
+            nonlocal acquired
+            acquired = asyncio.Event()
+            manager.acquire_lease = acquire_lease
+            task = asyncio.ensure_future(manager.heartbeat_loop())
+            await asyncio.wait_for(acquired.wait(), timeout=1)
+            task.cancel()
+
+        with mock.patch.object(managers, 'db', db), \
+                mock.patch.object(managers, 'PRESENCE_HEARTBEAT_INTERVAL', 0):
+            async_to_sync(run)()
+        self.assertEqual(results, [])
+
+
+# concurrent writers need row-level locking, e.g. PostgreSQL
+@skipUnlessDBFeature('has_select_for_update')
+class ConnectionLeaseConcurrencyTestCase(ChatTransactionTestCase):
+
+    workers = 8
+    connections_per_worker = 25
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.expires = self.now + datetime.timedelta(seconds=30)
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.user = user_create(username='user', password='password')
+
+    def call_concurrently(self, func, **kwargs):
+        def run(worker):
+            try:
+                return [func(user=self.user, room=self.room, now=self.now,
+                             channel_name=f'channel{worker}.{i}', **kwargs)
+                        for i in range(self.connections_per_worker)]
+            finally:
+                connection.close()
+
+        with ThreadPoolExecutor(self.workers) as pool:
+            results = pool.map(run, range(self.workers))
+        return sorted(count for result in results for count in result)
+
+    def test_concurrent_connects_and_disconnects(self):
+        total = self.workers * self.connections_per_worker
+
+        # each connection observes its own, unique count
+        counts = self.call_concurrently(connection_lease_acquire,
+                                        expires=self.expires)
+        self.assertEqual(counts, list(range(1, total + 1)))
+
+        counts = self.call_concurrently(connection_lease_release)
+        self.assertEqual(counts, list(range(total)))
+        self.assertFalse(ConnectionLease.objects.exists())
+
+
+@skipUnless(connection.vendor == 'postgresql', 'ids come from sequence')
+class MessageWriterTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.user = user_create(username='user', password='password')
+
+    def test_flush_by_size_and_on_shutdown(self):
+        writer = MessageWriter(batch_size=3, flush_interval=3600)
+
+        async def write(count):
+            msgs = [await writer.create(text=f'message {i}', author=self.user,
+                                        room=self.room)
+                    for i in range(count)]
+            if writer._flushing is not None:
+                await writer._flushing
+            return msgs
+
+        msgs = async_to_sync(write)(2)
+        self.assertEqual(writer.queue_depth, 2)
+        self.assertFalse(ChatMessage.objects.exists())
+
+        msgs += async_to_sync(write)(2)
+        self.assertEqual(writer.stats()['flushed'], 3)
+        self.assertEqual(writer.queue_depth, 1)
+
+        writer.flush_sync()
+        self.assertEqual(
+            list(ChatMessage.objects.order_by('id').values_list('id', 'sent')),
+            [(msg.id, msg.sent) for msg in msgs]
+        )
+
+
+class MessageWriterFailuresTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.saved = []
+        self.conflicts_ignored = []
+        self.blocked = None
+        self.room = Room(name='room')
+
+        def db(func):
+            async def call(**kwargs):
+                if func.__name__ == 'chat_message_reserve_ids':
+                    return list(range(len(self.saved) * 100,
+                                      len(self.saved) * 100 + 100))
+                if self.blocked is not None:
+                    await self.blocked.wait()
+                messages = kwargs['messages']
+                self.conflicts_ignored.append(
+                    kwargs.get('ignore_conflicts', False)
+                )
+                if any(msg.text == 'poison' for msg in messages):
+                    raise ValueError('bad row')
+                self.saved.extend(msg.text for msg in messages)
+            return call
+
+        patcher = mock.patch.object(message_writer, 'db', db)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def create(self, writer, texts):
+        async def run():
+            for text in texts:
+                await writer.create(text=text, author=None, room=self.room)
+        async_to_sync(run)()
+
+    def test_poison_message_dead_lettered(self):
+        writer = MessageWriter(batch_size=100, flush_interval=3600,
+                               retries=1)
+        self.create(writer, ['a', 'poison', 'b'])
+        async_to_sync(writer.flush)()
+        self.assertEqual(writer.queue_depth, 3)
+
+        with self.assertLogs('chat.message_writer.dead_letter') as logs:
+            async_to_sync(writer.flush)()
+        self.assertEqual(self.saved, ['a', 'b'])
+        self.assertEqual(writer.queue_depth, 0)
+        self.assertEqual(writer.dead_letters, 1)
+        self.assertIn('"text": "poison"', logs.output[0])
+        # batch and rows of retries may be committed by timed out attempt
+        self.assertEqual(self.conflicts_ignored,
+                         [False, True, True, True, True])
+
+    def test_periodic_flush_keeps_size_triggered_handle(self):
+        writer = MessageWriter(batch_size=2, flush_interval=3600)
+
+        async def run():
+            self.blocked = asyncio.Event()
+            for text in ['a', 'b']:
+                await writer.create(text=text, author=None, room=self.room)
+            flushing = writer._flushing
+            await asyncio.sleep(0)
+            self.blocked.set()
+            await writer.flush()
+            self.assertIs(writer._flushing, flushing)
+            await flushing
+            self.assertIsNone(writer._flushing)
+
+        async_to_sync(run)()
+        self.assertEqual(self.saved, ['a', 'b'])
+
+    def test_queue_cap(self):
+        writer = MessageWriter(batch_size=100, flush_interval=3600,
+                               queue_max=2)
+        self.create(writer, ['a', 'b', 'c'])
+        self.assertEqual(writer.queue_depth, 2)
+        self.assertEqual(self.saved, ['c'])
+
+    def test_shutdown_saves_batch_in_flight(self):
+        writer = MessageWriter(batch_size=2, flush_interval=3600)
+
+        async def run():
+            self.blocked = asyncio.Event()
+            for text in ['a', 'b', 'c']:
+                await writer.create(text=text, author=None, room=self.room)
+            # let size-triggered flush take its batch
+            await asyncio.sleep(0)
+
+        async_to_sync(run)()
+        with mock.patch.object(message_writer, 'chat_message_bulk_create') \
+                as bulk_create:
+            writer.flush_sync()
+        self.assertEqual([msg.text for msg in
+                          bulk_create.call_args[1]['messages']],
+                         ['a', 'b', 'c'])
+
+    def test_drain_waits_for_batch_in_flight(self):
+        writer = MessageWriter(batch_size=2, flush_interval=3600)
+
+        async def run():
+            self.blocked = asyncio.Event()
+            for text in ['a', 'b', 'c']:
+                await writer.create(text=text, author=None, room=self.room)
+            await asyncio.sleep(0)
+            draining = asyncio.ensure_future(writer.drain())
+            await asyncio.sleep(.1)
+            self.assertFalse(draining.done())
+            self.blocked.set()
+            await asyncio.wait_for(draining, timeout=1)
+
+        async_to_sync(run)()
+        self.assertEqual(sorted(self.saved), ['a', 'b', 'c'])
+        self.assertEqual(writer.queue_depth, 0)
+
+
+class WriteBehindSettingTestCase(SimpleTestCase):
+
+    @override_settings(CHAT_WRITE_BEHIND=True)
+    def test_requires_postgresql(self):
+        with mock.patch.object(connections['default'], 'vendor', 'sqlite'), \
+                self.assertLogs('chat.message_writer', 'WARNING'):
+            self.assertFalse(message_writer._enabled())
+        with mock.patch.object(connections['default'], 'vendor',
+                               'postgresql'):
+            self.assertTrue(message_writer._enabled())
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class BenchmarkTestCase(ChatTransactionTestCase):
+
+    def test_percentiles(self):
+        summary = _percentiles([i / 1000 for i in range(1, 101)])
+        self.assertAlmostEqual(summary['p50_ms'], 50)
+        self.assertAlmostEqual(summary['p99_ms'], 99)
+        self.assertEqual(_percentiles([]), {'count': 0})
+
+    def test_unavailable_layer_reported(self):
+        def connect(options):
+            raise OSError('Name or service not known')
+
+        with mock.patch.dict('chat.benchmarks.SCENARIOS',
+                             {'connect': connect}), \
+                self.assertRaisesMessage(CommandError, 'is unavailable'):
+            call_command('chatbench', 'connect')
+
+    # clients write concurrently from database executor threads
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_fanout_delivers_to_every_client(self):
+        results = bench_fanout({'room': 'bench', 'messages': 5, 'clients': 3,
+                                'rounds': 2, 'timeout': 5})
+        self.assertEqual(results['messages_sent'], 6)
+        self.assertEqual(results['deliveries'], 18)
+        self.assertEqual(results['fanout']['count'], 18)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_fanout_local_layer(self):
+        with override_settings(CHANNEL_LAYERS={'default':
+                                               BENCH_LAYERS['local']}):
+            results = bench_fanout({'room': 'bench', 'messages': 5,
+                                    'clients': 3, 'rounds': 2, 'timeout': 5})
+        self.assertEqual(results['deliveries'], 18)
+
+
+class MetricsTestCase(SimpleTestCase):
+
+    def test_render(self):
+        registry = metrics.Registry()
+        with mock.patch('chat.metrics.registry', registry):
+            frames = metrics.Counter('frames_total', 'Frames', ['direction'])
+            latency = metrics.Histogram('latency_seconds', 'Latency',
+                                        buckets=(.1, 1))
+        frames.inc(direction='in')
+        frames.inc(2, direction='in')
+        latency.observe(.05)
+        latency.observe(.5)
+        latency.observe(5)
+        registry.register_stats('cache', lambda: {'hits': 3})
+
+        self.assertEqual(registry.render().splitlines(), [
+            '# HELP frames_total Frames',
+            '# TYPE frames_total counter',
+            'frames_total{direction="in"} 3',
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="0.1"} 1',
+            'latency_seconds_bucket{le="1"} 2',
+            'latency_seconds_bucket{le="+Inf"} 3',
+            'latency_seconds_sum 5.55',
+            'latency_seconds_count 3',
+            '# TYPE cache_hits gauge',
+            'cache_hits 3',
+        ])
+
+    def test_render_during_updates(self):
+        registry = metrics.Registry()
+        with mock.patch('chat.metrics.registry', registry):
+            frames = metrics.Counter('frames_total', 'Frames', ['direction'])
+            latency = metrics.Histogram('latency_seconds', 'Latency',
+                                        ['event'])
+        stop = threading.Event()
+
+        def update():
+            i = 0
+            while not stop.is_set():
+                # few series, so rendering keeps up with updates
+                frames.inc(direction=i % 8)
+                latency.observe(.01, event=i % 8)
+                i += 1
+
+        updater = threading.Thread(target=update)
+        updater.start()
+        try:
+            for _ in range(50):
+                registry.render()
+        finally:
+            stop.set()
+            updater.join()
+
+    def test_group_send_many_logs_failed_groups(self):
+        sent = []
+
+        class Layer:
+            async def group_send(self, group, event):
+                if group == 'broken':
+                    raise ConnectionError('layer is down')
+                sent.append(group)
+
+        with self.assertLogs('chat.metrics', 'ERROR') as logs:
+            async_to_sync(metrics.group_send_many)(
+                Layer(), ['a', 'broken', 'b'], {'type': 'user.mention'}
+            )
+        self.assertEqual(sent, ['a', 'b'])
+        self.assertEqual(len(logs.output), 1)
+        self.assertIn('group broken', logs.output[0])
+
+    def test_render_workers(self):
+        registries = []
+        with tempfile.TemporaryDirectory() as directory:
+            for worker in range(2):
+                registry = metrics.Registry()
+                with mock.patch('chat.metrics.registry', registry):
+                    frames = metrics.Counter('frames_total', 'Frames')
+                frames.inc(worker + 1)
+                registry.export_to(directory, worker=worker, pid=100 + worker)
+                with mock.patch('os.getpid', return_value=100 + worker):
+                    registry.export()
+                registries.append(registry)
+
+            with mock.patch('os.getpid', return_value=100):
+                lines = registries[0].render().splitlines()
+
+        self.assertEqual(lines, [
+            '# HELP frames_total Frames',
+            '# TYPE frames_total counter',
+            'frames_total{worker="0",pid="100"} 1',
+            'frames_total{worker="1",pid="101"} 2',
+        ])
+
+    def test_metrics_view(self):
+        response = self.client.get('/metrics')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'# TYPE chat_active_sockets gauge', response.content)
+
+    def test_metrics_view_internal(self):
+        response = self.client.get('/metrics', REMOTE_ADDR='203.0.113.1')
+        self.assertEqual(response.status_code, 403)
+
+
+class ManagersNotifyTestCase(SimpleTestCase):
+
+    def make_consumer(self, calls):
+        started = asyncio.Event()
+
+        class Manager(AbstractManager):
+            def __init__(self, consumer): pass
+            async def on_disconnect(self): pass
+            async def on_receive(self, text_data=None, bytes_data=None): pass
+
+        class Waiting(Manager):
+            independent = True
+
+            async def on_connect(self):
+                # deadlocks unless run concurrently with `Signalling`
+                await asyncio.wait_for(started.wait(), timeout=1)
+                calls.append('waiting')
+
+        class Signalling(Manager):
+            independent = True
+
+            async def on_connect(self):
+                started.set()
+                calls.append('signalling')
+
+        class Dependent(Manager):
+            async def on_connect(self):
+                calls.append('dependent')
+
+        consumer = ChatConsumerBase({'type': 'websocket'})
+        consumer._managers = [Waiting(consumer), Signalling(consumer),
+                              Dependent(consumer)]
+        return consumer
+
+    def notify_connect(self, calls, concurrent=True):
+        async def notify():
+            consumer = self.make_consumer(calls)
+            consumer.concurrent_managers = concurrent
+            await consumer.managers_notify_connect()
+        async_to_sync(notify)()
+
+    def test_independent_managers_run_concurrently(self):
+        calls = []
+        self.notify_connect(calls)
+        self.assertEqual(calls, ['signalling', 'waiting', 'dependent'])
+
+    def test_sequential_when_disabled(self):
+        with self.assertRaises(asyncio.TimeoutError):
+            self.notify_connect([], concurrent=False)
+
+
+class DBExecutorTestCase(SimpleTestCase):
+
+    def test_rejects_over_capacity_and_times_out(self):
+        executor = DBExecutor(max_workers=1, max_queue=0, timeout=.05)
+        release = threading.Event()
+
+        async def run():
+            blocked = asyncio.ensure_future(executor.run(release.wait, 5))
+            await asyncio.sleep(.01)
+            with self.assertRaises(DatabaseBusy):
+                await executor.run(lambda: None)
+            with self.assertRaises(DatabaseBusy):
+                await blocked
+
+        try:
+            async_to_sync(run)()
+        finally:
+            release.set()
+        executor._pool.shutdown()
+
+        self.assertEqual(executor.stats(), {'pending': 0, 'queue_depth': 0,
+                                            'rejected': 1, 'timeouts': 1})
+
+
+@skipUnless(connection.vendor == 'postgresql' and db_async.asyncpg,
+            'requires PostgreSQL and asyncpg')
+class AsyncDataAccessParityTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.now = timezone.now()
+        self.expires = self.now + datetime.timedelta(seconds=30)
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.user = user_create(username='user', password='password')
+        self.other = user_create(username='other', password='password')
+
+    def run_async(self, func, **kwargs):
+        async def run():
+            try:
+                return await func(**kwargs)
+            finally:
+                await db_async.pool.close()
+        return async_to_sync(run)()
+
+    def test_acquire_timeout(self):
+        pool = db_async.ConnectionPool(min_size=1, max_size=1, timeout=.1)
+
+        async def run():
+            try:
+                async with pool.acquire():
+                    with self.assertRaises(DatabaseBusy):
+                        async with pool.acquire():
+                            pass
+            finally:
+                await pool.close()
+
+        async_to_sync(run)()
+
+    def test_terminated_before_loop_closes(self):
+        pool = db_async.ConnectionPool(min_size=1, max_size=1, timeout=1)
+
+        async def run():
+            async with pool.acquire() as conn:
+                await conn.fetchval('SELECT 1')
+            return pool._pool
+
+        asyncpg_pool = async_to_sync(run)()
+        self.assertIsNone(pool._pool)
+        self.assertTrue(asyncpg_pool._closed)
+
+    def test_history_parity(self):
+        for i in range(7):
+            self.run_async(db_async.chat_message_create, text=f'message {i}',
+                           author=self.user, room=self.room)
+        chat_message_create(text='service', author=None, room=self.room,
+                            service_msg=True)
+
+        sync_page = chat_message_page_entries(room=self.room, limit=3)
+        async_page = self.run_async(db_async.chat_message_page_entries,
+                                    room=self.room, limit=3)
+        self.assertEqual(async_page, sync_page)
+
+        before = sync_page[0][0][0]
+        self.assertEqual(
+            self.run_async(db_async.chat_message_page_as_dicts,
+                           room=self.room, limit=3, before=before),
+            chat_message_page_as_dicts(room=self.room, limit=3, before=before)
+        )
+
+    def test_message_create_parity(self):
+        msg = self.run_async(db_async.chat_message_create, text='hello',
+                             author=self.user, room=self.room)
+        saved = ChatMessage.objects.get(pk=msg.pk)
+        self.assertEqual(saved.as_dict(), msg.as_dict())
+        self.assertFalse(msg._state.adding)
+
+    def test_connection_lease_parity(self):
+        def acquire(impl, user, channel_name):
+            return impl(user=user, room=self.room, channel_name=channel_name,
+                        expires=self.expires, now=self.now)
+
+        async_acquire = functools.partial(
+            self.run_async, acquire, impl=db_async.connection_lease_acquire
+        )
+        self.assertEqual(acquire(connection_lease_acquire, self.user, 'a'), 1)
+        self.assertEqual(async_acquire(user=self.user, channel_name='b'), 2)
+        async_acquire(user=self.other, channel_name='c')
+
+        self.assertCountEqual(
+            self.run_async(db_async.connection_lease_online_users_as_dicts,
+                           room=self.room, now=self.now),
+            connection_lease_online_users_as_dicts(room=self.room,
+                                                   now=self.now)
+        )
+        self.assertTrue(self.run_async(db_async.connection_lease_renew,
+                                       channel_name='a', expires=self.expires))
+        self.assertFalse(self.run_async(db_async.connection_lease_renew,
+                                        channel_name='x', expires=self.expires))
+
+        release = functools.partial(self.run_async,
+                                    db_async.connection_lease_release,
+                                    user=self.user, room=self.room,
+                                    now=self.now)
+        self.assertEqual(release(channel_name='a'), 1)
+        self.assertEqual(release(channel_name='b'), 0)
+        self.assertIsNone(release(channel_name='b'))
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class MentionsTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.alice = user_create(username='alice', password='password')
+        self.bob = user_create(username='bob', password='password')
+
+    def test_extract(self):
+        self.assertEqual(
+            mentions_extract('@bob hi, @carol.x and @bob\n@dave-1 a@b'),
+            ['bob', 'carol.x', 'dave-1']
+        )
+        self.assertEqual(mentions_extract('thanks @bob. and @eve-, @-'),
+                         ['bob', 'eve'])
+
+    def test_known_usernames_cached(self):
+        known = KnownUsernames(maxlen=10, ttl=60)
+        names = async_to_sync(known.filter)(['bob', 'nobody', 'alice'])
+        self.assertEqual(names, ['bob', 'alice'])
+        with self.assertNumQueries(0):
+            async_to_sync(known.filter)(['alice', 'bob'])
+        self.assertEqual(known.stats(), {'hits': 2, 'misses': 3, 'size': 2})
+
+    def test_known_usernames_expire(self):
+        bounded = KnownUsernames(maxlen=1, ttl=60)
+        async_to_sync(bounded.filter)(['bob', 'alice'])
+        self.assertEqual(bounded.stats()['size'], 1)
+
+        known = KnownUsernames(maxlen=10, ttl=0)
+        async_to_sync(known.filter)(['bob', 'alice'])
+        self.bob.delete()
+        names = async_to_sync(known.filter)(['bob', 'alice'])
+        self.assertEqual(names, ['alice'])
+        self.assertEqual(known.stats()['misses'], 4)
+
+    # connections write leases concurrently from database executor threads
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_mentioned_user_notified_once(self):
+        async def chat():
+            communicators = []
+            for user in (self.alice, self.bob):
+                communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+                communicator.scope['user'] = user
+                await communicator.connect()
+                communicators.append(communicator)
+            alice, bob = communicators
+
+            await alice.send_to(text_data=json.dumps({
+                'type': 'chat.message',
+                'message': 'hi @bob, @nobody, @alice and @bob again'
+            }))
+            events = []
+            while not await bob.receive_nothing(timeout=.5):
+                events.append(json.loads(await bob.receive_from()))
+            for communicator in communicators:
+                await communicator.disconnect()
+            return events
+
+        mentions = [event for event in async_to_sync(chat)()
+                    if event['type'] == 'user.mention']
+        self.assertEqual(mentions, [{
+            'type': 'user.mention', 'by': 'alice',
+            'message': 'hi @bob, @nobody, @alice and @bob again'
+        }])
+
+
+class OutboundQueueTestCase(SimpleTestCase):
+
+    def sent_by_slow_client(self, policy, frames):
+        """
+        Queue frames while client does not receive, then let it catch up.
+        Returns sent frames and whether queue overflowed.
+        """
+        async def run():
+            receiving = asyncio.Event()
+            sent = []
+
+            async def send(text_data, bytes_data):
+                await receiving.wait()
+                sent.append(text_data)
+
+            queue = OutboundQueue(send, maxsize=3, policy=policy)
+            queue.start()
+            overflow = False
+            try:
+                for text, key in frames:
+                    queue.put(text, coalesce_key=key)
+                    # writer takes the first frame and blocks on it
+                    await asyncio.sleep(0)
+            except OutboundOverflow:
+                overflow = True
+                queue.stop()
+            self.assertLessEqual(len(queue), 3)
+            receiving.set()
+            await asyncio.sleep(.01)
+            queue.stop()
+            return sent, overflow
+
+        return async_to_sync(run)()
+
+    def test_drop_oldest(self):
+        sent, overflow = self.sent_by_slow_client(
+            outbound.POLICY_DROP_OLDEST, [(text, None) for text in 'abcde']
+        )
+        self.assertFalse(overflow)
+        self.assertEqual(sent, ['a', 'c', 'd', 'e'])
+
+    def test_coalesce_presence(self):
+        frames = [('a', None), ('join x', 'online.x'),
+                  ('leave x', 'online.x'), ('b', None)]
+        sent, overflow = self.sent_by_slow_client(
+            outbound.POLICY_COALESCE_PRESENCE, frames
+        )
+        self.assertFalse(overflow)
+        self.assertEqual(sent, ['a', 'leave x', 'b'])
+
+        sent, _ = self.sent_by_slow_client(outbound.POLICY_DROP_OLDEST,
+                                           frames)
+        self.assertEqual(sent, ['a', 'join x', 'leave x', 'b'])
+
+    def test_disconnect(self):
+        sent, overflow = self.sent_by_slow_client(
+            outbound.POLICY_DISCONNECT, [(text, None) for text in 'abcde']
+        )
+        self.assertTrue(overflow)
+        self.assertEqual(sent, [])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SlowConsumerTestCase(ChatTransactionTestCase):
+
+    def test_slow_consumer_evicted(self):
+        user = user_create(username='user', password='password')
+        send_now = ChatConsumerBase.send_now
+
+        async def slow_send_now(consumer, *args, **kwargs):
+            await asyncio.sleep(.2)
+            await send_now(consumer, *args, **kwargs)
+
+        async def chat():
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            # connection init alone sends more frames than queue holds
+            output = await communicator.receive_output(timeout=1)
+            await communicator.disconnect()
+            return output
+
+        evictions = outbound.evictions._values.get((), 0)
+        with mock.patch.object(ChatConsumerBase, 'send_now', slow_send_now), \
+                mock.patch.object(outbound, 'QUEUE_SIZE', 2), \
+                mock.patch.object(outbound, 'POLICY',
+                                  outbound.POLICY_DISCONNECT):
+            output = async_to_sync(chat)()
+
+        self.assertEqual(output, {'type': 'websocket.close',
+                                  'code': CLOSE_TRY_AGAIN_LATER})
+        self.assertEqual(outbound.evictions._values.get((), 0), evictions + 1)
+
+
+class RateLimiterTestCase(SimpleTestCase):
+
+    def test_token_bucket(self):
+        limiter = RateLimiter('test', rate=.001, burst=2)
+        self.assertEqual([limiter.allow_local('a') for _ in range(3)],
+                         [True, True, False])
+        self.assertTrue(limiter.allow_local('b'))
+
+        limiter.refund('a')
+        self.assertTrue(limiter.allow_local('a'))
+        self.assertFalse(limiter.allow_local('a'))
+
+        limiter.rate = 0
+        self.assertTrue(limiter.allow_local('a'))
+
+    def test_shared_falls_back_to_local(self):
+        class BrokenRedisLayer:
+            prefix = 'asgi'
+
+            def consistent_hash(self, value):
+                return 0
+
+            def connection(self, index):
+                raise ConnectionError('redis is down')
+
+        limiter = RateLimiter('test', rate=.001, burst=1)
+        allow = async_to_sync(limiter.allow)
+        with self.assertLogs('chat.rate_limit', 'WARNING'):
+            self.assertEqual([allow('a', BrokenRedisLayer())
+                              for _ in range(2)], [True, False])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ReceiveLimitsTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+
+    def chat(self, frames):
+        """Send frames, return frames received in response"""
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            while not await communicator.receive_nothing(timeout=.2):
+                await communicator.receive_from()
+
+            received = []
+            for frame in frames:
+                await communicator.send_to(text_data=frame)
+                while not await communicator.receive_nothing(timeout=.2):
+                    output = await communicator.receive_output()
+                    if output['type'] == 'websocket.close':
+                        received.append(output)
+                        await communicator.disconnect()
+                        return received
+                    event = json.loads(output['text'])
+                    # presence delta may arrive at any time
+                    if event['type'] in ('error', 'chat.message'):
+                        received.append(event)
+            await communicator.disconnect()
+            return received
+
+        return async_to_sync(run)()
+
+    def test_rejected_events_reported(self):
+        received = self.chat([
+            json.dumps({'type': 'user.mention', 'user': 'user'}),
+            json.dumps({'type': 'chat.message',
+                        'message': 'x' * (MESSAGE_LENGTH_MAX + 1)}),
+            '{"type": ',
+            '[' * 60000,
+            json.dumps({'type': 'chat.message', 'message': 'hi'}),
+        ])
+        self.assertEqual([(event['type'], event.get('reason'))
+                          for event in received],
+                         [('error', 'unknown_type'), ('error', 'invalid'),
+                          ('error', 'invalid'), ('error', 'invalid'),
+                          ('chat.message', None)])
+
+    def test_rate_limited(self):
+        message = json.dumps({'type': 'chat.message', 'message': 'hi'})
+        with mock.patch.object(connection_rate_limit, 'burst', 2), \
+                mock.patch.object(connection_rate_limit, 'rate', .001):
+            received = self.chat([message] * 3)
+        self.assertEqual([event.get('reason') for event in received],
+                         [None, None, 'rate_limited'])
+
+    def test_throttled_user_keeps_connection_tokens(self):
+        message = json.dumps({'type': 'chat.message', 'message': 'hi'})
+        with mock.patch.object(connection_rate_limit, 'burst', 2), \
+                mock.patch.object(connection_rate_limit, 'rate', .001), \
+                mock.patch.object(user_rate_limit, 'allow',
+                                  side_effect=[False, False, True, True]):
+            received = self.chat([message] * 4)
+        self.assertEqual([event.get('reason') for event in received],
+                         ['rate_limited', 'rate_limited', None, None])
+
+    def test_oversized_frame_closes_connection(self):
+        received = self.chat(['x' * (FRAME_SIZE_MAX + 1)])
+        self.assertEqual(received, [{'type': 'websocket.close',
+                                     'code': CLOSE_MESSAGE_TOO_BIG}])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RoomCreationTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+
+    def connect(self, path, user=None):
+        application = URLRouter(websocket_urlpatterns)
+
+        async def run():
+            communicator = WebsocketCommunicator(application, path)
+            communicator.scope['user'] = user or self.user
+            connected, _ = await communicator.connect()
+            output = await communicator.receive_output(timeout=1)
+            await communicator.disconnect()
+            return output
+
+        return async_to_sync(run)()
+
+    def test_unknown_room_not_created(self):
+        output = self.connect('/ws/chat/random-room')
+        self.assertEqual(output, {'type': 'websocket.close',
+                                  'code': CLOSE_ROOM_NOT_FOUND})
+        self.assertFalse(Room.objects.filter(name='random-room').exists())
+
+        self.client.force_login(self.user)
+        response = self.client.get('/room/random-room/')
+        self.assertEqual(response.status_code, 404)
+
+    def test_staff_creates_room(self):
+        self.user.is_staff = True
+        self.user.save()
+        self.client.force_login(self.user)
+        self.assertEqual(self.client.get('/room/new-room/').status_code, 200)
+        self.assertTrue(Room.objects.filter(name='new-room').exists())
+
+    def test_anonymous_closed_after_accept(self):
+        output = self.connect(f'/ws/chat/{DEFAULT_ROOM_NAME}',
+                              user=AnonymousUser())
+        self.assertEqual(output, {'type': 'websocket.close',
+                                  'code': CLOSE_UNAUTHORIZED})
+
+    def test_long_room_name_not_routed(self):
+        with self.assertRaises(ValueError):
+            self.connect('/ws/chat/' + 'a' * 65)
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class ResumeTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        # messages are created below, bypassing cache of this worker
+        history_cache.invalidate(self.room.name)
+
+    async def resume(self, resume):
+        """Connect with resume cursor, return init frames"""
+        path = '/ws/chat?v=2&resume=' + urllib.parse.quote(json.dumps(resume))
+        communicator = WebsocketCommunicator(ChatConsumer, path)
+        communicator.scope['user'] = self.user
+        await communicator.connect()
+        frames = {}
+        while not await communicator.receive_nothing(timeout=.2):
+            event = json.loads(await communicator.receive_from())
+            frames.setdefault(event['type'], event)
+        await communicator.disconnect()
+        return frames
+
+    def reconnect(self, resume):
+        return async_to_sync(self.resume)(resume)
+
+    def test_resume_sends_missed_messages_only(self):
+        messages = [chat_message_create(text=f'message {i}', author=self.user,
+                                        room=self.room) for i in range(5)]
+        seen = history_cursor_encode(messages[2].sent, messages[2].id)
+
+        frames = self.reconnect(seen)
+        self.assertNotIn('init.chat_history', frames)
+        resumed = frames['init.resume']
+        self.assertEqual([m['message'] for m in resumed['data']],
+                         ['message 3', 'message 4'])
+        self.assertEqual(resumed['last'],
+                         history_cursor_encode(messages[4].sent,
+                                               messages[4].id))
+        self.assertIn('init.online_users', frames)
+
+    def test_large_gap_gets_full_history(self):
+        messages = [chat_message_create(text=f'message {i}', author=self.user,
+                                        room=self.room) for i in range(5)]
+        seen = history_cursor_encode(messages[0].sent, messages[0].id)
+
+        with mock.patch.object(managers, 'RESUME_GAP_MAX', 3):
+            frames = self.reconnect(seen)
+        self.assertNotIn('init.resume', frames)
+        self.assertEqual(len(frames['init.chat_history']['data']), 5)
+
+        # malformed cursor starts session anew
+        frames = self.reconnect({'sent': 'yesterday'})
+        self.assertIn('init.chat_history', frames)
+
+    def test_naive_cursor_gets_full_history(self):
+        chat_message_create(text='message', author=self.user, room=self.room)
+
+        async def run():
+            # room stays cached while other session is open
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            while not await communicator.receive_nothing(timeout=.2):
+                await communicator.receive_from()
+            cached = history_cache.latest(self.room.name)
+            frames = await self.resume({'sent': '2020-01-01T00:00:00',
+                                        'id': 1})
+            await communicator.disconnect()
+            return cached, frames
+
+        cached, frames = async_to_sync(run)()
+        self.assertIsNotNone(cached)
+        self.assertNotIn('init.resume', frames)
+        self.assertEqual([m['message']
+                          for m in frames['init.chat_history']['data']],
+                         ['message'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class SearchTestCase(ChatTransactionTestCase):
+
+    def setUp(self):
+        memory_search.clear()
+        self.user = user_create(username='user', password='password')
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        for text in ('hello world', 'Hello, hello there', 'world peace'):
+            chat_message_create(text=text, author=self.user, room=self.room)
+        chat_message_create(text='User hello joined', author=None,
+                            room=self.room, service_msg=True)
+        chat_message_create(text='hello', author=self.user,
+                            room=room_get_or_create(name='other'))
+
+    def search(self, query, limit=10, offset=0, since=None):
+        entries, has_more = message_search(room=self.room, query=query,
+                                           limit=limit, offset=offset,
+                                           since=since)
+        return [message['message'] for _, message in entries], has_more
+
+    def test_ranked_and_paginated(self):
+        self.assertEqual(self.search('hello'),
+                         (['Hello, hello there', 'hello world'], False))
+        self.assertEqual(self.search('world hello'), (['hello world'], False))
+        self.assertEqual(self.search('hello', limit=1),
+                         (['Hello, hello there'], True))
+        self.assertEqual(self.search('hello', limit=1, offset=1),
+                         (['hello world'], False))
+        self.assertEqual(self.search('nothing'), ([], False))
+
+    def test_time_window(self):
+        old = chat_message_create(text='ancient peace', author=self.user,
+                                  room=self.room)
+        ChatMessage.objects.filter(id=old.id).update(
+            sent=timezone.now() - datetime.timedelta(days=400)
+        )
+        since = timezone.now() - datetime.timedelta(days=365)
+        self.assertEqual(self.search('peace', since=since),
+                         (['world peace'], False))
+        self.assertEqual(sorted(self.search('peace')[0]),
+                         ['ancient peace', 'world peace'])
+
+    def test_new_messages_found(self):
+        self.assertEqual(self.search('peace'), (['world peace'], False))
+        chat_message_create(text='peace talks', author=self.user,
+                            room=self.room)
+        with self.assertNumQueries(1):
+            found, _ = self.search('peace')
+        self.assertEqual(sorted(found), ['peace talks', 'world peace'])
+
+    def memory_search(self, query):
+        entries, _ = memory_search.search(room=self.room, query=query,
+                                          limit=10)
+        return [message['message'] for _, message in entries]
+
+    def test_memory_index_capped(self):
+        self.memory_search('hello')
+        chat_message_create(text='hello again', author=self.user,
+                            room=self.room)
+        with mock.patch.object(memory_search, 'max_messages', 2):
+            self.assertEqual(self.memory_search('hello'), ['hello again'])
+            self.assertEqual(self.memory_search('world'), ['world peace'])
+
+    def test_memory_index_drops_archived(self):
+        self.memory_search('hello')
+        ChatMessage.objects.filter(text='hello world').delete()
+        with mock.patch.object(memory_search, 'ARCHIVE_CHECK_INTERVAL', 0):
+            self.assertEqual(self.memory_search('hello'),
+                             ['Hello, hello there'])
+            ChatMessage.objects.filter(room=self.room).delete()
+            self.assertEqual(self.memory_search('peace'), [])
+
+    def test_search_event(self):
+        async def run():
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat?v=2')
+            communicator.scope['user'] = self.user
+            await communicator.connect()
+            await communicator.send_to(text_data=json.dumps(
+                {'type': 'search.query', 'query': 'peace'}
+            ))
+            while True:
+                event = json.loads(await communicator.receive_from())
+                if event['type'] == 'search.results':
+                    break
+            await communicator.disconnect()
+            return event
+
+        event = async_to_sync(run)()
+        self.assertEqual([m['message'] for m in event['data']],
+                         ['world peace'])
+        self.assertEqual((event['page'], event['has_more']), (0, False))
+        self.assertIn('cursor', event['data'][0])
+
+
+class PartitionsTestCase(TestCase):
+
+    def setUp(self):
+        self.user = user_create(username='user', password='password')
+        self.room = room_get_or_create(name=DEFAULT_ROOM_NAME)
+        self.directory = tempfile.mkdtemp()
+
+    def message(self, text, sent):
+        msg = chat_message_create(text=text, author=self.user, room=self.room)
+        ChatMessage.objects.filter(pk=msg.pk).update(sent=sent)
+
+    def month(self, year, month):
+        return datetime.datetime(year, month, 1, tzinfo=datetime.timezone.utc)
+
+    def test_archive(self):
+        self.message('july', self.month(2020, 7) + datetime.timedelta(days=3))
+        self.message('july end', self.month(2020, 8) -
+                     datetime.timedelta(microseconds=1))
+        self.message('march', self.month(2021, 3))
+        self.message('april', self.month(2021, 4))
+        now = self.month(2021, 5) + datetime.timedelta(days=10)
+
+        def archive(dry_run):
+            return partitions.messages_archive(
+                older_than=1, directory=self.directory, dry_run=dry_run,
+                now=now
+            )
+
+        archived = [(self.month(2020, 7), 2), (self.month(2021, 3), 1)]
+        self.assertEqual([a for a in archive(True) if a[1]], archived)
+        self.assertEqual(ChatMessage.objects.count(), 4)
+
+        self.assertEqual([a for a in archive(False) if a[1]], archived)
+        self.assertEqual(list(ChatMessage.objects.values_list('text')),
+                         [('april',)])
+        path = partitions.archive_path(self.directory, self.month(2020, 7))
+        with gzip.open(path, 'rt') as f:
+            rows = [json.loads(line) for line in f]
+        self.assertEqual([(r['text'], r['author__username'], r['room__name'])
+                          for r in rows],
+                         [('july', 'user', DEFAULT_ROOM_NAME),
+                          ('july end', 'user', DEFAULT_ROOM_NAME)])
+        self.assertEqual(archive(False), [])
+
+    @skipUnless(connection.vendor == 'postgresql', 'partitioned table')
+    def test_partition_create(self):
+        month = self.month(2040, 1)
+        self.message('future', month)
+        # deferred checks of test transaction would prevent dropping tables
+        with connection.cursor() as cursor:
+            cursor.execute('SET CONSTRAINTS ALL IMMEDIATE')
+        self.assertNotIn(month, partitions.partition_months())
+
+        created = partitions.partitions_ensure(ahead=1, now=month)
+        self.assertEqual(created, [month, self.month(2040, 2)])
+        self.assertEqual(partitions.partitions_ensure(ahead=1, now=month), [])
+        with connection.cursor() as cursor:
+            cursor.execute(f'SELECT tableoid::regclass::text '
+                           f'FROM {partitions.TABLE}')
+            self.assertEqual(cursor.fetchall(),
+                             [(partitions.partition_name(month),)])
+
+        archived = partitions.messages_archive(
+            older_than=0, directory=self.directory, now=self.month(2040, 2)
+        )
+        self.assertIn((month, 1), archived)
+        self.assertNotIn(month, partitions.partition_months())
+        self.assertIn(self.month(2040, 2), partitions.partition_months())
+
+
+class ChannelLayersTestCase(SimpleTestCase):
+
+    KEYS = [f'chat.room-{i}'.encode() for i in range(5000)]
+
+    def test_hash_ring_moves_keys_to_new_node_only(self):
+        before = HashRing(['a', 'b', 'c'])
+        after = HashRing(['a', 'b', 'c', 'd'])
+        moved = [key for key in self.KEYS
+                 if before.node(key) != after.node(key)]
+        self.assertTrue(all(after.node(key) == 3 for key in moved))
+        self.assertLess(len(moved) / len(self.KEYS), .35)
+
+        shares = [sum(before.node(key) == node for key in self.KEYS)
+                  for node in range(3)]
+        self.assertGreater(min(shares) / len(self.KEYS), .2)
+
+    def test_sharded_layer_places_by_host_address(self):
+        hosts = [('redis-a', 6379), ('redis-b', 6379), ('redis-c', 6379)]
+        layer = ShardedRedisChannelLayer(hosts=hosts)
+        reordered = ShardedRedisChannelLayer(hosts=hosts[::-1])
+        for group in ('chat', 'room-1', 'room-2', 'room-3'):
+            self.assertEqual(
+                layer.hosts[layer.consistent_hash(group)],
+                reordered.hosts[reordered.consistent_hash(group)]
+            )
+
+    def test_local_layer_group_send(self):
+        layer = LocalChannelLayer(capacity=2)
+
+        async def run():
+            await layer.group_add('room', 'a')
+            await layer.group_add('room', 'b')
+            for i in range(3):
+                await layer.group_send('room', {'type': 'event', 'i': i})
+            received = [await layer.receive('a'), await layer.receive('a')]
+            other = await layer.receive('b')
+            return received, other
+
+        received, other = async_to_sync(run)()
+        # full receiver misses events, as with other layers
+        self.assertEqual([event['i'] for event in received], [0, 1])
+        self.assertEqual(other, received[0])
+        self.assertIsNot(other, received[0])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class DrainTestCase(ChatTransactionTestCase):
+
+    def test_drained_connection_keeps_lease(self):
+        user = user_create(username='user', password='password')
+
+        async def chat():
+            communicator = WebsocketCommunicator(ChatConsumer, '/ws/chat')
+            communicator.scope['user'] = user
+            connected, _ = await communicator.connect()
+            self.assertTrue(connected)
+            consumer, = live_consumers
+            await consumer.drain()
+            while True:
+                output = await communicator.receive_output(timeout=1)
+                if output['type'] == 'websocket.close':
+                    break
+            await communicator.disconnect()
+            return output
+
+        self.assertEqual(async_to_sync(chat)(),
+                         {'type': 'websocket.close',
+                          'code': CLOSE_SERVICE_RESTART})
+        self.assertFalse(live_consumers)
+        # client, reconnecting to another worker, is still online
+        self.assertTrue(ConnectionLease.objects.filter(user=user).exists())
+
+
+# reports its status once, drains on SIGTERM
+FAKE_WORKER = """
+import json, os, signal, sys, time
+signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+index, fd = map(int, sys.argv[1:])
+os.write(fd, json.dumps({'worker': index, 'pid': os.getpid(),
+                         'connections': index, 'draining': False}).encode()
+         + b'\\n')
+while True:
+    time.sleep(.1)
+"""
+
+
+class SupervisorTestCase(SimpleTestCase):
+
+    def setUp(self):
+        self.output = []
+        self.supervisor = Supervisor(
+            workers=2, drain_timeout=2, report_interval=0,
+            command=lambda index, fd: [sys.executable, '-c', FAKE_WORKER,
+                                       str(index), str(fd)],
+            out=self.output.append
+        )
+        self.addCleanup(self.stop)
+
+    def stop(self):
+        self.supervisor.retire(list(self.supervisor.workers))
+
+    def reported(self):
+        return all(worker.status is not None
+                   for worker in self.supervisor.workers)
+
+    def test_replaces_exited_worker(self):
+        for index in range(2):
+            self.supervisor.spawn(index)
+        self.assertTrue(self.supervisor.wait(self.reported, 10))
+        self.supervisor.report()
+        self.assertEqual(self.output[0], '2 workers, 1 connections')
+
+        crashed = self.supervisor.workers[0]
+        os.kill(crashed.process.pid, signal.SIGKILL)
+        self.assertTrue(self.supervisor.wait(
+            lambda: crashed not in self.supervisor.workers and
+            len(self.supervisor.workers) == 2 and self.reported(), 10
+        ))
+        self.assertEqual(sorted(w.index for w in self.supervisor.workers),
+                         [0, 1])
+
+    def test_restart_replaces_every_worker(self):
+        for index in range(2):
+            self.supervisor.spawn(index)
+        old = [worker.process.pid for worker in self.supervisor.workers]
+        self.supervisor.restart()
+        self.assertEqual(len(self.supervisor.workers), 2)
+        self.assertFalse(set(old) & set(worker.process.pid
+                                        for worker in self.supervisor.workers))
+        self.assertEqual(self.output, ['Workers restarted'])
+
+
+@override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+class RunchatTestCase(SimpleTestCase):
+
+    def test_workers_limited_by_db_connections(self):
+        with mock.patch.dict(os.environ, {'ASGI_THREADS': '4'}), \
+                mock.patch.object(db_executor, 'max_workers', 10), \
+                mock.patch.object(db_async, 'ASYNC_IMPLEMENTATIONS', {}), \
+                override_settings(CHAT_DB_CONNECTIONS_MAX=40), \
+                self.assertRaisesMessage(CommandError,
+                                         'run at most 2 workers'):
+            call_command('runchat', workers=3)
@@ -3,12 +3,15 @@
 # Author: Danil Kovalenko
 
 from django.contrib import admin
-from django.urls import path
+from django.urls import path, re_path
 
 import chat.views
+from chat.const import ROOM_NAME_PATTERN
 
 app_name = 'chat'
 urlpatterns = [
     path('register/', chat.views.register, name='register'),
+    re_path(rf'^room/(?P<room>{ROOM_NAME_PATTERN})/$', chat.views.index,
+            name='room'),
     path('', chat.views.index, name='index')
 ]
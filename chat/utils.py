@@ -2,7 +2,12 @@
 # -*-encoding: utf-8-*-
 # Author: Danil Kovalenko
 
+import datetime
+import hashlib
 import json
+import re
+
+from django.utils.dateparse import parse_datetime
 
 
 def datetime_to_dict(d):
@@ -18,3 +23,56 @@ def datetime_to_dict(d):
 def datetime_to_json(d):
     val = datetime_to_dict(d)
     return json.dumps(val)
+
+
+def datetime_to_epoch_ms(d):
+    return int(d.timestamp() * 1000)
+
+
+def epoch_ms_to_datetime(ms):
+    return datetime.datetime.fromtimestamp(ms / 1000, tz=datetime.timezone.utc)
+
+
+def history_cursor_encode(sent, pk):
+    """Build wire representation of `(sent, id)` history cursor"""
+    return {'sent': sent.isoformat(), 'id': pk}
+
+
+def history_cursor_decode(cursor):
+    """
+    Parse cursor, received from client, into `(sent, id)` tuple.
+
+    Raises ValueError if cursor is malformed or its timestamp is naive,
+    stored ones are aware and can not be compared with it.
+    """
+    try:
+        sent = parse_datetime(cursor['sent'])
+        pk = int(cursor['id'])
+    except (KeyError, TypeError) as e:
+        raise ValueError(f'Malformed history cursor: {cursor}') from e
+
+    if sent is None or sent.tzinfo is None:
+        raise ValueError(f'Malformed history cursor: {cursor}')
+    return sent, pk
+
+
+# channel layers limit group names to 100 characters of this set
+GROUP_NAME_MAX_LENGTH = 100
+GROUP_NAME_CHARS = re.compile(r'^[a-zA-Z0-9_.-]+$')
+
+
+def _group_name(prefix, name):
+    group = f'{prefix}.{name}'
+    if len(group) < GROUP_NAME_MAX_LENGTH and GROUP_NAME_CHARS.match(name):
+        return group
+    return f'{prefix}.{hashlib.sha1(name.encode()).hexdigest()}'
+
+
+def room_group_name(room_name):
+    """Group of channels, connected to given room"""
+    return _group_name('room', room_name)
+
+
+def user_group_name(username):
+    """Group of channels of given user, in all rooms"""
+    return _group_name('user', username)
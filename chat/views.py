@@ -1,19 +1,27 @@
 import logging
 
+from django.conf import settings
+from django.core.exceptions import PermissionDenied
+from django.http import Http404, HttpResponse
 from django.shortcuts import render, redirect
 from django.contrib.auth import authenticate, login, logout
 from django.contrib.auth.models import AnonymousUser
 from django.contrib import messages
 
+from chat import metrics as chat_metrics
+from chat.const import DEFAULT_ROOM_NAME
 from chat.forms import LoginForm
 from chat.db_selectors import user_username_taken
-from chat.db_services import user_create
+from chat.db_services import user_create, room_get_or_create_permitted
 
 
 log = logging.getLogger(__name__)
 
+METRICS_ALLOWED_IPS = frozenset(getattr(settings, 'CHAT_METRICS_ALLOWED_IPS',
+                                        ('127.0.0.1', '::1')))
 
-def index(request):
+
+def index(request, room=DEFAULT_ROOM_NAME):
     if isinstance(request.user, AnonymousUser):
         return redirect('chat:register')
 
@@ -21,7 +29,9 @@ def index(request):
         logout(request)
         return redirect('chat:register')
 
-    return render(request, 'index.html')
+    if room_get_or_create_permitted(name=room, user=request.user) is None:
+        raise Http404('No such room')
+    return render(request, 'index.html', {'room_name': room})
 
 
 def register(request):
@@ -54,3 +64,13 @@ def register(request):
 
     context = {'form': LoginForm}
     return render(request, 'registration/login.html', context)
+
+
+def metrics(request):
+    if not chat_metrics.enabled:
+        raise Http404('Metrics are disabled')
+    if not request.user.is_staff and \
+            request.META.get('REMOTE_ADDR') not in METRICS_ALLOWED_IPS:
+        raise PermissionDenied('Metrics are internal')
+    return HttpResponse(chat_metrics.registry.render(),
+                        content_type='text/plain; version=0.0.4')
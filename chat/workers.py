@@ -0,0 +1,342 @@
+#!/usr/bin/env python3
+# -*-encoding: utf-8-*-
+# Author: Danil Kovalenko
+
+# Worker processes
+#
+# `runchat` command runs supervisor, which starts `workers` ASGI worker
+# processes, serving one port. Each worker listens on its own socket with
+# SO_REUSEPORT and kernel spreads connections over them. Where it is not
+# available, workers accept from one socket, inherited from supervisor.
+# Workers share presence and events through the channel layer and the
+# database, as separate hosts would.
+#
+# On SIGTERM worker drains: stops accepting, closes its websockets with
+# CLOSE_SERVICE_RESTART code, so that clients resume on other workers, saves
+# queued messages of write-behind mode and exits, once websockets are
+# closed. SIGHUP to supervisor replaces workers one by
+# one, SIGTERM or SIGINT drains all of them and exits. Workers report
+# connection counts to supervisor through a pipe, supervisor prints them
+# periodically. Workers export their metrics to a shared directory as often,
+# so that `metrics` view of any worker renders all of them.
+
+# installs asyncio reactor, before anything imports the default one
+from daphne.server import Server
+
+import asyncio
+import json
+import logging
+import os
+import selectors
+import signal
+import socket
+import subprocess
+import time
+import typing as tp
+
+from channels.layers import get_channel_layer
+from channels.routing import get_default_application
+from twisted.internet import reactor
+
+from chat.consumers import live_consumers
+from chat import db_async, message_writer, metrics, presence
+from chat.db_executor import db_executor
+
+
+log = logging.getLogger(__name__)
+
+REUSE_PORT = hasattr(socket, 'SO_REUSEPORT')
+# seconds between status reports of a worker
+STATUS_INTERVAL = 5
+# worker, exited sooner after start, is restarted with a delay
+RESPAWN_DELAY = 1
+
+
+def db_connections_per_worker() -> int:
+    """Database connections a worker may hold at once"""
+    count = db_executor.max_workers
+    if db_async.ASYNC_IMPLEMENTATIONS:
+        count += db_async.pool.max_size
+    # sessions of websockets and http views are served by default executor
+    # threads of the event loop, its size is that of asgiref
+    asgi_threads = os.environ.get('ASGI_THREADS')
+    if asgi_threads is not None:
+        count += int(asgi_threads)
+    else:
+        count += min(32, (os.cpu_count() or 1) + 4)
+    return count
+
+
+def listen_socket(host: str, port: int, reuse_port: bool,
+                  listen: bool = True) -> socket.socket:
+    # daphne adopts descriptors of IPv4 sockets only
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    if reuse_port:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+    sock.bind((host, port))
+    if listen:
+        sock.listen(1024)
+    return sock
+
+
+class WorkerServer(Server):
+    """Daphne server, which keeps its listening ports"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.ports = []
+
+    def listen_success(self, port):
+        self.ports.append(port)
+        super().listen_success(port)
+
+
+class Worker:
+    """ASGI server of a single worker process"""
+
+    def __init__(self, *, index: int, sock: socket.socket,
+                 drain_timeout: float, status_fd: tp.Optional[int] = None,
+                 metrics_dir: tp.Optional[str] = None, verbosity: int = 1):
+        """`sock` is listening IPv4 socket, server takes it over"""
+        self.index = index
+        self.drain_timeout = drain_timeout
+        self.status_fd = status_fd
+        if metrics_dir is not None:
+            metrics.registry.export_to(metrics_dir, worker=index,
+                                       pid=os.getpid())
+        if status_fd is not None:
+            # supervisor, which does not read, never stalls the worker
+            os.set_blocking(status_fd, False)
+        self.draining = False
+        self.server = WorkerServer(
+            application=get_default_application(),
+            # adopted descriptor is closed by server, once it stops listening
+            endpoints=[f'fd:fileno={sock.detach()}'],
+            signal_handlers=False,
+            ready_callable=self.ready,
+            verbosity=verbosity
+        )
+
+    def run(self):
+        self.server.run()
+
+    def ready(self):
+        loop = asyncio.get_event_loop()
+        for signum in (signal.SIGTERM, signal.SIGINT):
+            loop.add_signal_handler(signum, self.drain_start)
+        asyncio.ensure_future(self.report_loop())
+
+    def status(self) -> dict:
+        return {'worker': self.index,
+                'pid': os.getpid(),
+                'connections': len(live_consumers),
+                'draining': self.draining}
+
+    def report(self):
+        if self.status_fd is None:
+            return
+        try:
+            os.write(self.status_fd,
+                     (json.dumps(self.status()) + '\n').encode())
+        except (BlockingIOError, BrokenPipeError):
+            pass
+
+    async def report_loop(self):
+        while True:
+            self.report()
+            try:
+                metrics.registry.export()
+            except OSError as e:
+                log.warning(f'Metrics export failed: {e}')
+            await asyncio.sleep(STATUS_INTERVAL)
+
+    def drain_start(self):
+        if not self.draining:
+            self.draining = True
+            asyncio.ensure_future(self.drain())
+
+    async def drain(self):
+        """Stop accepting, close websockets, stop once they are closed"""
+        for port in self.server.ports:
+            port.stopListening()
+        self.report()
+        log.info(f'Worker {self.index} draining {len(live_consumers)} '
+                 f'connections')
+
+        results = await asyncio.gather(*[consumer.drain()
+                                         for consumer in list(live_consumers)],
+                                       return_exceptions=True)
+        for result in results:
+            if isinstance(result, Exception):
+                log.warning(f'Connection drain failed: {result}')
+        deadline = time.monotonic() + self.drain_timeout
+        while live_consumers and time.monotonic() < deadline:
+            await asyncio.sleep(.1)
+        if presence.presence_batcher is not None:
+            await presence.presence_batcher.flush(get_channel_layer())
+        # after presence, which may queue service messages
+        if message_writer.message_writer is not None:
+            await message_writer.message_writer.drain()
+        reactor.stop()
+
+
+class WorkerProcess:
+    """Worker process, as seen by supervisor"""
+
+    def __init__(self, index: int, process: subprocess.Popen,
+                 status_fd: int):
+        self.index = index
+        self.process = process
+        self.status_fd = status_fd
+        self.status: tp.Optional[dict] = None
+        self.started = time.monotonic()
+        # worker is stopped on purpose, not to be replaced
+        self.retiring = False
+        self._buffer = b''
+
+    def read_status(self):
+        try:
+            data = os.read(self.status_fd, 65536)
+        except BlockingIOError:
+            return
+        *lines, self._buffer = (self._buffer + data).split(b'\n')
+        for line in lines:
+            self.status = json.loads(line)
+
+
+class Supervisor:
+    """Runs worker processes, replaces ones, which exit"""
+
+    def __init__(self, *, workers: int,
+                 command: tp.Callable[[int, int], tp.List[str]],
+                 pass_fds: tp.Sequence[int] = (),
+                 drain_timeout: float = 10,
+                 report_interval: float = 60,
+                 metrics_dir: tp.Optional[str] = None,
+                 out: tp.Callable[[str], None] = print):
+        """`command(index, status_fd)` is command line of worker process"""
+        self.count = workers
+        self.command = command
+        self.pass_fds = tuple(pass_fds)
+        self.drain_timeout = drain_timeout
+        self.report_interval = report_interval
+        self.metrics_dir = metrics_dir
+        self.out = out
+        self.workers: tp.List[WorkerProcess] = []
+        self.selector = selectors.DefaultSelector()
+        self._stopping = False
+        self._restarting = False
+        self._reported = time.monotonic()
+
+    def spawn(self, index: int) -> WorkerProcess:
+        read_fd, write_fd = os.pipe()
+        os.set_blocking(read_fd, False)
+        process = subprocess.Popen(self.command(index, write_fd),
+                                   pass_fds=(write_fd, *self.pass_fds))
+        os.close(write_fd)
+        worker = WorkerProcess(index, process, read_fd)
+        self.workers.append(worker)
+        self.selector.register(read_fd, selectors.EVENT_READ, worker)
+        return worker
+
+    def poll(self, timeout: float):
+        """Read worker reports, replace exited workers"""
+        for key, _ in self.selector.select(timeout):
+            key.data.read_status()
+
+        for worker in list(self.workers):
+            code = worker.process.poll()
+            if code is None:
+                continue
+            worker.read_status()
+            self.selector.unregister(worker.status_fd)
+            os.close(worker.status_fd)
+            self.workers.remove(worker)
+            if self.metrics_dir is not None:
+                # exited worker is not rendered anymore
+                path = metrics.export_path(self.metrics_dir,
+                                           worker.process.pid)
+                for stale in (path, f'{path}.tmp'):
+                    if os.path.exists(stale):
+                        os.remove(stale)
+            if worker.retiring or self._stopping:
+                continue
+
+            self.out(f'Worker {worker.index} (pid {worker.process.pid}) '
+                     f'exited with code {code}, restarting')
+            uptime = time.monotonic() - worker.started
+            if uptime < RESPAWN_DELAY:
+                time.sleep(RESPAWN_DELAY - uptime)
+            self.spawn(worker.index)
+
+        if self.report_interval and \
+                time.monotonic() - self._reported >= self.report_interval:
+            self.report()
+
+    def wait(self, predicate: tp.Callable[[], bool], timeout: float) -> bool:
+        """Keep polling, until predicate holds or timeout passes"""
+        deadline = time.monotonic() + timeout
+        while not predicate():
+            if time.monotonic() >= deadline:
+                return False
+            self.poll(.1)
+        return True
+
+    def retire(self, workers: tp.List[WorkerProcess]):
+        """Drain workers, kill ones, not stopped in time"""
+        for worker in workers:
+            worker.retiring = True
+            worker.process.terminate()
+        # supervisor waits a little longer, than workers drain
+        if not self.wait(lambda: all(w not in self.workers for w in workers),
+                         self.drain_timeout + 5):
+            for worker in workers:
+                if worker in self.workers:
+                    log.warning(f'Worker {worker.index} did not drain, '
+                                f'killed')
+                    worker.process.kill()
+            self.wait(lambda: all(w not in self.workers for w in workers),
+                      self.drain_timeout)
+
+    def restart(self):
+        """Replace workers one by one, each new one starts before old drains"""
+        for old in [w for w in self.workers if not w.retiring]:
+            new = self.spawn(old.index)
+            self.wait(lambda: new.status is not None or
+                      new not in self.workers, self.drain_timeout)
+            self.retire([old])
+        self.out('Workers restarted')
+
+    def report(self):
+        self._reported = time.monotonic()
+        statuses = [w.status for w in self.workers if w.status is not None]
+        total = sum(status['connections'] for status in statuses)
+        self.out(f'{len(self.workers)} workers, {total} connections')
+        for status in sorted(statuses, key=lambda s: s['worker']):
+            draining = ', draining' if status['draining'] else ''
+            self.out(f"  worker {status['worker']} (pid {status['pid']}): "
+                     f"{status['connections']} connections{draining}")
+
+    def _stop(self, signum, frame):
+        self._stopping = True
+
+    def _restart(self, signum, frame):
+        self._restarting = True
+
+    def run(self):
+        signal.signal(signal.SIGTERM, self._stop)
+        signal.signal(signal.SIGINT, self._stop)
+        if hasattr(signal, 'SIGHUP'):
+            signal.signal(signal.SIGHUP, self._restart)
+
+        for index in range(self.count):
+            self.spawn(index)
+        while not self._stopping:
+            self.poll(.5)
+            if self._restarting:
+                self._restarting = False
+                self.restart()
+
+        self.out('Draining workers')
+        self.retire(list(self.workers))
@@ -72,15 +72,63 @@ TEMPLATES = [
 ASGI_APPLICATION = 'web_chat.routing.application'
 WSGI_APPLICATION = 'web_chat.wsgi.application'
 
+# Channel layer of chat workers: 'redis' -- groups and channels are spread
+# over CHAT_REDIS_HOSTS by hash ring, every worker must list the same hosts;
+# 'local' -- in-process fan-out without Redis, only for deployments, where
+# a single process serves all sockets.
+CHAT_CHANNEL_LAYER = 'redis'
+CHAT_REDIS_HOSTS = [('redis', 6379)]
+
 CHANNEL_LAYERS = {
     'default': {
-        'BACKEND': 'channels_redis.core.RedisChannelLayer',
-        'CONFIG': {
-            'hosts': [('redis', 6379)]
-        }
-    }
+        'redis': {
+            'BACKEND': 'chat.layers.ShardedRedisChannelLayer',
+            'CONFIG': {
+                'hosts': CHAT_REDIS_HOSTS
+            }
+        },
+        'local': {
+            'BACKEND': 'chat.layers.LocalChannelLayer',
+        },
+    }[CHAT_CHANNEL_LAYER]
 }
 
+# JSON library used to encode websocket frames: 'json', 'ujson' or 'orjson'.
+# Falls back to stdlib 'json' if selected one is not installed.
+CHAT_JSON_BACKEND = 'json'
+
+# Allow clients to negotiate binary MessagePack frames by `chat.msgpack`
+# websocket subprotocol. JSON text frames are used otherwise.
+CHAT_BINARY_TRANSPORT = True
+
+# Rooms, which any user may create by opening them, besides the default one.
+# Other rooms are created by staff users, by opening them or in admin.
+CHAT_ROOMS_ALLOWED = []
+
+# Write-behind persistence of chat messages (PostgreSQL only, other databases
+# fall back to saving each message): messages are broadcast before they are
+# saved, saving is done by batches of CHAT_WRITE_BEHIND_BATCH_SIZE or every
+# CHAT_WRITE_BEHIND_INTERVAL seconds.
+# Queued messages are lost if worker is killed, keep disabled if every
+# message must be durable before it is shown.
+CHAT_WRITE_BEHIND = False
+CHAT_WRITE_BEHIND_BATCH_SIZE = 100
+CHAT_WRITE_BEHIND_INTERVAL = 0.5
+# Failed batch is retried so many times, then saved message by message,
+# messages, which still fail, are logged to `chat.message_writer.dead_letter`.
+CHAT_WRITE_BEHIND_RETRIES = 3
+# Messages over that many queued ones are saved right away, not queued.
+CHAT_WRITE_BEHIND_QUEUE_MAX = 10000
+
+# Collect runtime metrics of chat workers, exposed at /metrics in
+# Prometheus text format.
+CHAT_METRICS = True
+# /metrics is served to staff users and requests from these addresses only.
+CHAT_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+# Directory, `runchat` workers share their metrics through, each one is
+# rendered with its `worker` and `pid` labels. Temporary one, if not set.
+CHAT_METRICS_DIR = None
+
 
 # Database
 # https://docs.djangoproject.com/en/3.0/ref/settings/#databases
@@ -93,9 +141,76 @@ DATABASES = {
         'PASSWORD' : 'postgres',
         'HOST' : 'db',
         'PORT' : '5432',
+        # keep connections of database executor threads open between calls
+        'CONN_MAX_AGE': 60,
     }
 }
 
+# Database calls of chat workers are run by dedicated pool of threads.
+# Each thread holds own connection, so CHAT_DB_EXECUTOR_WORKERS times number
+# of workers should fit into Postgres `max_connections`. Calls over
+# CHAT_DB_EXECUTOR_QUEUE waiting ones, or not done within
+# CHAT_DB_EXECUTOR_TIMEOUT seconds, fail and connection is closed with
+# "try again later" code.
+CHAT_DB_EXECUTOR_WORKERS = 10
+CHAT_DB_EXECUTOR_QUEUE = 1000
+CHAT_DB_EXECUTOR_TIMEOUT = 10
+
+# Database connections, all `runchat` workers may hold together, it refuses
+# to start more workers. Each worker holds up to CHAT_DB_EXECUTOR_WORKERS
+# connections of executor threads, CHAT_DB_ASYNC_POOL_MAX_SIZE of asyncpg
+# pool, if CHAT_DB_ASYNC is enabled, and one per thread of event loop's
+# default executor, which serves sessions and http views: ASGI_THREADS
+# environment variable, or CPUs + 4 up to 32. With CONN_MAX_AGE idle ones
+# are kept open as well. Postgres `max_connections` is 100 by default,
+# leave some to migrations, admin and other clients. None disables the check.
+CHAT_DB_CONNECTIONS_MAX = 80
+
+# Run hot path queries natively on the event loop with asyncpg pool of
+# CHAT_DB_ASYNC_POOL_MIN_SIZE..CHAT_DB_ASYNC_POOL_MAX_SIZE connections,
+# instead of database executor threads. Requires `asyncpg` and PostgreSQL.
+# Calls, which get no connection within CHAT_DB_EXECUTOR_TIMEOUT, fail as
+# executor ones do.
+CHAT_DB_ASYNC = False
+CHAT_DB_ASYNC_POOL_MIN_SIZE = 2
+CHAT_DB_ASYNC_POOL_MAX_SIZE = 10
+
+# Presence changes are broadcast to room as one `online.delta` event every
+# CHAT_PRESENCE_DELTA_INTERVAL seconds, 0 sends `online.connect` and
+# `online.disconnect` per change immediately. CHAT_PRESENCE_SERVICE_MESSAGES
+# is 'transient' -- "Users ... joined" message per broadcast, not saved,
+# 'stored' -- message per change, saved to history, or 'none'.
+CHAT_PRESENCE_DELTA_INTERVAL = 1
+CHAT_PRESENCE_SERVICE_MESSAGES = 'transient'
+
+# Frames queued per connection, while client is slow to receive them. On
+# overflow CHAT_OUTBOUND_POLICY applies: 'drop_oldest' frame,
+# 'coalesce_presence' -- drop oldest, but also keep only the latest presence
+# frame per user, or 'disconnect' the client with code 4013 (try again later).
+CHAT_OUTBOUND_QUEUE_SIZE = 1000
+CHAT_OUTBOUND_POLICY = 'coalesce_presence'
+
+# Received frames over CHAT_FRAME_SIZE_MAX characters (bytes for binary
+# frames) close connection with code 4009 unparsed.
+CHAT_FRAME_SIZE_MAX = 64 * 1024
+
+# Token bucket limits of received events: RATE per second, up to BURST at
+# once. User limit is shared by workers through Redis of the channel layer.
+# Zero rate disables limit.
+CHAT_RATE_LIMIT_CONNECTION_RATE = 5
+CHAT_RATE_LIMIT_CONNECTION_BURST = 20
+CHAT_RATE_LIMIT_USER_RATE = 10
+CHAT_RATE_LIMIT_USER_BURST = 40
+
+# PostgreSQL messages table is partitioned by month. `chatpartitions ensure`
+# creates partitions of current and CHAT_PARTITIONS_AHEAD next months, run
+# it at least monthly. `chatpartitions archive` writes months before the
+# last CHAT_RETENTION_MONTHS ones to gzipped JSONL files in CHAT_ARCHIVE_DIR
+# and removes them from database, None keeps messages forever.
+CHAT_PARTITIONS_AHEAD = 2
+CHAT_RETENTION_MONTHS = None
+CHAT_ARCHIVE_DIR = os.path.join(BASE_DIR, 'archive')
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -18,10 +18,12 @@ from django.urls import path, include, re_path
 from django.conf.urls.static import serve
 from django.contrib.staticfiles.urls import staticfiles_urlpatterns
 
+import chat.views
 from . import settings
 
 urlpatterns = [
     path('', include('chat.urls')),
     path('admin/', admin.site.urls),
+    path('metrics', chat.views.metrics, name='metrics'),
     # re_path(r'^static/(?:.*)$', serve, {'document_root': settings.STATIC_ROOT})
 ] + staticfiles_urlpatterns()
\ No newline at end of file